@@ -18,5 +18,7 @@ EMAIL_CONFIG = {
 MODEL_CONFIG = {
     "model": "llama-3.3-70b-versatile",
     "temperature": 0.7,
-    "max_tokens": 7000
+    "max_tokens": 7000,
+    # Prompt plus completion tokens the model accepts
+    "context_window": 131072
 }
\ No newline at end of file
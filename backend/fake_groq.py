@@ -0,0 +1,269 @@
+"""
+Local stand-in for Groq's OpenAI-compatible /v1/chat/completions endpoint.
+
+Used for load testing the RespondX API without spending Groq quota:
+
+    python fake_groq.py --port 9000 --latency-dist lognormal --latency-ms 400 --error-429-rate 0.02
+    GROQ_BASE_URL=http://localhost:9000/openai/v1 GROQ_API_KEY=fake uvicorn main:app
+
+Latency, token throughput, rate limits and error injection are configurable from the command line.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from threading import Lock
+from typing import Dict, Any
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Default settings (overridden from the command line)
+settings = {
+    "latency_dist": "lognormal",     # fixed, uniform, normal, lognormal, exponential
+    "latency_ms": 300.0,             # mean time to first token
+    "latency_jitter_ms": 150.0,      # spread (stddev / half-width depending on distribution)
+    "tokens_per_second": 400.0,      # generation throughput after the first token
+    "completion_tokens": 180,        # mean completion length
+    "error_429_rate": 0.0,
+    "error_5xx_rate": 0.0,
+    "retry_after": 2,
+    "rpm_limit": 1000,
+    "tpm_limit": 300000,
+    "cached_prompt_ratio": 0.0,      # fraction of prompt tokens reported as provider-cached
+}
+
+app = FastAPI(title="Fake Groq API", docs_url=None, redoc_url=None)
+
+# Sliding one-minute budget, reported through x-ratelimit-* headers like Groq does
+class MinuteBudget:
+    def __init__(self):
+        self._lock = Lock()
+        self._window_start = time.time()
+        self._requests = 0
+        self._tokens = 0
+        self.stats = {
+            'requests': 0,
+            'streamed': 0,
+            'injected_429': 0,
+            'injected_5xx': 0,
+            'limited_429': 0
+        }
+
+    def _roll(self, now: float):
+        if now - self._window_start >= 60:
+            self._window_start = now
+            self._requests = 0
+            self._tokens = 0
+
+    def consume(self, tokens: int) -> bool:
+        now = time.time()
+        with self._lock:
+            self._roll(now)
+            if self._requests + 1 > settings["rpm_limit"] or self._tokens + tokens > settings["tpm_limit"]:
+                return False
+            self._requests += 1
+            self._tokens += tokens
+            return True
+
+    def headers(self) -> Dict[str, str]:
+        now = time.time()
+        with self._lock:
+            self._roll(now)
+            reset = max(0.0, 60 - (now - self._window_start))
+            return {
+                "x-ratelimit-limit-requests": str(settings["rpm_limit"]),
+                "x-ratelimit-limit-tokens": str(settings["tpm_limit"]),
+                "x-ratelimit-remaining-requests": str(max(0, settings["rpm_limit"] - self._requests)),
+                "x-ratelimit-remaining-tokens": str(max(0, settings["tpm_limit"] - self._tokens)),
+                "x-ratelimit-reset-requests": f"{reset:.2f}s",
+                "x-ratelimit-reset-tokens": f"{reset:.2f}s",
+            }
+
+budget = MinuteBudget()
+
+def sample_latency() -> float:
+    """Draw a time-to-first-token in seconds from the configured distribution"""
+    mean = settings["latency_ms"]
+    spread = settings["latency_jitter_ms"]
+    dist = settings["latency_dist"]
+
+    if dist == "fixed":
+        value = mean
+    elif dist == "uniform":
+        value = random.uniform(mean - spread, mean + spread)
+    elif dist == "normal":
+        value = random.gauss(mean, spread)
+    elif dist == "exponential":
+        value = random.expovariate(1 / mean) if mean > 0 else 0
+    else:
+        # Lognormal with the requested mean and standard deviation
+        sigma2 = math.log(1 + (spread / mean) ** 2) if mean > 0 else 0
+        mu = math.log(mean) - sigma2 / 2 if mean > 0 else 0
+        value = random.lognormvariate(mu, math.sqrt(sigma2)) if mean > 0 else 0
+
+    return max(0.0, value) / 1000
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+def build_completion_text(messages: list, completion_tokens: int) -> str:
+    """Produce output shaped like what each RespondX endpoint expects"""
+    system_prompt = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    filler = " ".join(
+        random.choice(["thanks", "update", "project", "meeting", "schedule", "review", "details", "follow", "team", "next"])
+        for _ in range(max(1, completion_tokens))
+    )
+
+    if "email analyst" in system_prompt:
+        return json.dumps({
+            "summary": f"Fake summary: {filler[:200]}",
+            "sentiment_analysis": {"overall": "neutral", "tone_shifts": []},
+            "topics": {"main": [{"label": "project", "subtopics": ["timeline"]}]},
+            "named_entities": {
+                "people": ["Alex"], "companies": ["Acme"], "dates": [], "mobile_numbers": [],
+                "email_addresses": [], "locations": []
+            }
+        })
+
+    if "email composer" in system_prompt:
+        return f"Subject: Fake subject line\n\nHello,\n\n{filler}\n\nBest regards,\nYour Name"
+
+    return f"Thank you for your email.\n\n{filler}\n\nRegards,\nYour Name"
+
+def build_usage(prompt_tokens: int, completion_tokens: int) -> Dict[str, Any]:
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    cached = int(prompt_tokens * settings["cached_prompt_ratio"])
+    if cached:
+        usage["prompt_tokens_details"] = {"cached_tokens": cached}
+    return usage
+
+def error_response(status_code: int, message: str, headers: Dict[str, str]) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={"error": {"message": message, "type": "fake_groq_error"}},
+        headers=headers
+    )
+
+@app.post("/openai/v1/chat/completions")
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    payload = await request.json()
+    messages = payload.get("messages", [])
+    max_tokens = int(payload.get("max_tokens") or 1024)
+    stream = bool(payload.get("stream"))
+
+    budget.stats['requests'] += 1
+    prompt_tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+    completion_tokens = max(1, min(max_tokens, int(random.expovariate(1 / settings["completion_tokens"]))))
+
+    # Error injection
+    roll = random.random()
+    if roll < settings["error_429_rate"]:
+        budget.stats['injected_429'] += 1
+        headers = {**budget.headers(), "retry-after": str(settings["retry_after"])}
+        return error_response(429, "Rate limit reached (injected)", headers)
+    if roll < settings["error_429_rate"] + settings["error_5xx_rate"]:
+        budget.stats['injected_5xx'] += 1
+        return error_response(random.choice([500, 502, 503]), "Upstream error (injected)", budget.headers())
+
+    if not budget.consume(prompt_tokens + max_tokens):
+        budget.stats['limited_429'] += 1
+        headers = {**budget.headers(), "retry-after": str(settings["retry_after"])}
+        return error_response(429, "Rate limit reached for requests or tokens", headers)
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    model = payload.get("model", "fake-model")
+    text = build_completion_text(messages, completion_tokens)
+    usage = build_usage(prompt_tokens, completion_tokens)
+    rate_headers = budget.headers()
+
+    await asyncio.sleep(sample_latency())
+
+    if not stream:
+        await asyncio.sleep(completion_tokens / settings["tokens_per_second"])
+        return JSONResponse(
+            content={
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "length" if completion_tokens >= max_tokens else "stop"
+                }],
+                "usage": usage,
+                "x_groq": {"id": completion_id}
+            },
+            headers=rate_headers
+        )
+
+    budget.stats['streamed'] += 1
+
+    async def event_stream():
+        # Split on word boundaries so roughly one chunk is one token
+        pieces = re.findall(r"\S+\s*", text)
+        delay = 1 / settings["tokens_per_second"]
+        for content in pieces:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(delay)
+
+        final = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "x_groq": {"id": completion_id, "usage": usage}
+        }
+        yield f"data: {json.dumps(final)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=rate_headers)
+
+@app.get("/stats")
+async def fake_stats():
+    return {"settings": settings, "stats": budget.stats}
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fake Groq chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "normal", "lognormal", "exponential"],
+                        default=settings["latency_dist"])
+    parser.add_argument("--latency-ms", type=float, default=settings["latency_ms"])
+    parser.add_argument("--latency-jitter-ms", type=float, default=settings["latency_jitter_ms"])
+    parser.add_argument("--tokens-per-second", type=float, default=settings["tokens_per_second"])
+    parser.add_argument("--completion-tokens", type=int, default=settings["completion_tokens"])
+    parser.add_argument("--error-429-rate", type=float, default=settings["error_429_rate"])
+    parser.add_argument("--error-5xx-rate", type=float, default=settings["error_5xx_rate"])
+    parser.add_argument("--retry-after", type=int, default=settings["retry_after"])
+    parser.add_argument("--rpm-limit", type=int, default=settings["rpm_limit"])
+    parser.add_argument("--tpm-limit", type=int, default=settings["tpm_limit"])
+    parser.add_argument("--cached-prompt-ratio", type=float, default=settings["cached_prompt_ratio"])
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_args()
+    for name in settings:
+        settings[name] = getattr(args, name)
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
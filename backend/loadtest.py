@@ -0,0 +1,269 @@
+"""
+Open-loop asyncio load generator for the RespondX API.
+
+Drives /generate, /analyze-thread and /api/compose at a target request rate and reports
+latency percentiles, throughput, cache hit rate and circuit breaker transitions:
+
+    python fake_groq.py --port 9000 &
+    GROQ_BASE_URL=http://localhost:9000/openai/v1 GROQ_API_KEY=fake uvicorn main:app --port 8000 &
+    python loadtest.py --base-url http://localhost:8000 --rps 25 --duration 60 --repeat-ratio 0.3
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from collections import defaultdict
+from typing import Dict, Any, List, Optional
+
+import aiohttp
+
+SAMPLE_EMAILS = [
+    "Hi, I'd like to schedule a meeting to discuss the project timeline for Q3.",
+    "Thanks for your proposal. Can you provide more details about the pricing tiers?",
+    "Could you send over the latest version of the design document before Friday?",
+    "We noticed an issue with the last invoice. Can you take a look and confirm the amount?",
+    "Congratulations on the launch! Let us know if you need any help with the rollout.",
+    "Unfortunately I can't make it to tomorrow's call. Could we move it to Thursday?",
+    "Please find attached the contract. Let me know if you have any questions.",
+    "Following up on my previous email about the partnership opportunity.",
+]
+
+COMPOSE_PROMPTS = [
+    "Ask the team for status updates on the migration before the Friday deadline",
+    "Thank the client for the productive meeting and summarize next steps",
+    "Decline the vendor's offer politely and keep the door open for future work",
+    "Request a budget review meeting with finance next week",
+    "Apologize for the delayed shipment and share the new delivery date",
+]
+
+SENDERS = [("Alex Kim", "alex@acme.com"), ("Priya Shah", "priya@globex.com"), ("Sam Lee", "sam@initech.com")]
+
+def make_thread(message_count: int) -> Dict[str, Any]:
+    """Build a thread payload in the same shape content.js sends"""
+    text = ""
+    for index in range(1, message_count + 1):
+        name, email = random.choice(SENDERS)
+        body = " ".join(random.choice(SAMPLE_EMAILS) for _ in range(random.randint(1, 4)))
+        text += f"\n----- Email {index} from {name} <{email}> (Mon, Jan {index} 2024) -----\n\n{body}\n\n"
+    return {"completeThreadText": text, "emailCount": message_count}
+
+def make_payload(endpoint: str) -> Dict[str, Any]:
+    if endpoint == "/generate":
+        return {"prompt": random.choice(SAMPLE_EMAILS), "useCustomPrompt": False}
+    if endpoint == "/analyze-thread":
+        return {"thread": make_thread(random.randint(2, 8)), "autoTruncate": True}
+    return {
+        "prompt": random.choice(COMPOSE_PROMPTS),
+        "tone": random.choice(["professional", "friendly", "formal"]),
+        "length": random.choice(["brief", "short", "medium"]),
+    }
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+class LoadTestResults:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.status_counts: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.cached: Dict[str, int] = defaultdict(int)
+        self.completed: Dict[str, int] = defaultdict(int)
+        self.client_errors: Dict[str, int] = defaultdict(int)
+        self.breaker_transitions: List[Dict[str, Any]] = []
+        self.metrics_samples: List[Dict[str, Any]] = []
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def record(self, endpoint: str, status: int, latency: float, cached: bool):
+        self.latencies[endpoint].append(latency)
+        self.status_counts[endpoint][status] += 1
+        self.completed[endpoint] += 1
+        if cached:
+            self.cached[endpoint] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        endpoints = {}
+        all_latencies = []
+        for endpoint, values in self.latencies.items():
+            ordered = sorted(values)
+            all_latencies.extend(values)
+            ok = sum(count for status, count in self.status_counts[endpoint].items() if status < 400)
+            endpoints[endpoint] = {
+                "requests": self.completed[endpoint],
+                "ok": ok,
+                "status_counts": dict(self.status_counts[endpoint]),
+                "client_errors": self.client_errors[endpoint],
+                "p50_ms": round(percentile(ordered, 50) * 1000, 1),
+                "p95_ms": round(percentile(ordered, 95) * 1000, 1),
+                "p99_ms": round(percentile(ordered, 99) * 1000, 1),
+                "max_ms": round(ordered[-1] * 1000, 1) if ordered else 0.0,
+                "cache_hit_rate": round(self.cached[endpoint] / max(1, ok), 3),
+            }
+
+        ordered = sorted(all_latencies)
+        total = sum(self.completed.values())
+        return {
+            "duration_s": round(elapsed, 2),
+            "requests": total,
+            "throughput_rps": round(total / max(elapsed, 1e-9), 2),
+            "p50_ms": round(percentile(ordered, 50) * 1000, 1),
+            "p95_ms": round(percentile(ordered, 95) * 1000, 1),
+            "p99_ms": round(percentile(ordered, 99) * 1000, 1),
+            "cache_hit_rate": round(sum(self.cached.values()) / max(1, total), 3),
+            "endpoints": endpoints,
+            "circuit_breaker_transitions": self.breaker_transitions,
+            "server_metrics": self.metrics_samples[-1] if self.metrics_samples else None,
+        }
+
+async def send_request(session: aiohttp.ClientSession, base_url: str, endpoint: str,
+                       payload: Dict[str, Any], results: LoadTestResults):
+    start = time.perf_counter()
+    try:
+        async with session.post(f"{base_url}{endpoint}", json=payload) as response:
+            body = await response.read()
+            latency = time.perf_counter() - start
+            cached = False
+            if response.status == 200:
+                try:
+                    cached = bool(json.loads(body).get("cached"))
+                except (ValueError, AttributeError):
+                    pass
+            results.record(endpoint, response.status, latency, cached)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        results.client_errors[endpoint] += 1
+        results.record(endpoint, 599, time.perf_counter() - start, False)
+
+def breaker_states(metrics: Dict[str, Any]) -> Dict[str, str]:
+    """Map breaker name -> state from a /metrics payload"""
+    breaker = metrics.get("circuit_breaker") or {}
+    if "state" in breaker:
+        return {"groq": breaker["state"]}
+    return {name: stats.get("state") for name, stats in breaker.items() if isinstance(stats, dict)}
+
+async def poll_metrics(session: aiohttp.ClientSession, base_url: str, interval: float,
+                       results: LoadTestResults, stop: asyncio.Event):
+    """Sample /metrics to track circuit breaker transitions and concurrency"""
+    last_states: Dict[str, str] = {}
+    while not stop.is_set():
+        try:
+            async with session.get(f"{base_url}/metrics") as response:
+                if response.status == 200:
+                    metrics = await response.json()
+                    offset = round(time.time() - results.started_at, 2)
+                    results.metrics_samples.append({"t": offset, **metrics})
+                    for name, state in breaker_states(metrics).items():
+                        previous = last_states.get(name)
+                        if previous is not None and previous != state:
+                            results.breaker_transitions.append(
+                                {"t": offset, "breaker": name, "from": previous, "to": state}
+                            )
+                        last_states[name] = state
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    aliases = {"generate": "/generate", "analyze": "/analyze-thread", "compose": "/api/compose"}
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[aliases.get(name.strip(), name.strip())] = float(weight or 1)
+    return weights
+
+async def run_load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    results = LoadTestResults()
+    mix = parse_mix(args.mix)
+    endpoints, weights = list(mix.keys()), list(mix.values())
+    history: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.max_in_flight)
+    stop = asyncio.Event()
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        poller = asyncio.create_task(poll_metrics(session, args.base_url, args.metrics_interval, results, stop))
+        tasks = set()
+        interval = 1 / args.rps
+        next_send = time.perf_counter()
+        deadline = next_send + args.duration
+
+        # Open loop: requests are issued on schedule regardless of how fast the server answers
+        while next_send < deadline:
+            endpoint = random.choices(endpoints, weights)[0]
+            if history[endpoint] and random.random() < args.repeat_ratio:
+                payload = random.choice(history[endpoint])
+            else:
+                payload = make_payload(endpoint)
+                history[endpoint].append(payload)
+
+            task = asyncio.create_task(send_request(session, args.base_url, endpoint, payload, results))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+        if tasks:
+            await asyncio.gather(*tasks)
+        results.finished_at = time.time()
+        stop.set()
+        await poller
+
+    return results.summary()
+
+def print_report(summary: Dict[str, Any]):
+    print("=" * 60)
+    print(f"Duration: {summary['duration_s']}s  Requests: {summary['requests']}  "
+          f"Throughput: {summary['throughput_rps']} req/s")
+    print(f"Latency p50/p95/p99: {summary['p50_ms']} / {summary['p95_ms']} / {summary['p99_ms']} ms")
+    print(f"Cache hit rate: {summary['cache_hit_rate']:.1%}")
+    print("-" * 60)
+    for endpoint, stats in summary["endpoints"].items():
+        print(f"{endpoint:<18} n={stats['requests']:<6} ok={stats['ok']:<6} "
+              f"p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms "
+              f"hit={stats['cache_hit_rate']:.1%} statuses={stats['status_counts']}")
+    print("-" * 60)
+    transitions = summary["circuit_breaker_transitions"]
+    if transitions:
+        print("Circuit breaker transitions:")
+        for transition in transitions:
+            print(f"  t={transition['t']}s {transition['breaker']}: {transition['from']} -> {transition['to']}")
+    else:
+        print("Circuit breaker transitions: none")
+    server = summary.get("server_metrics") or {}
+    if server:
+        print(f"Server cache: {server.get('cache')}")
+        print(f"Server concurrency: {server.get('concurrent_requests')}")
+    print("=" * 60)
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="RespondX API load generator")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--rps", type=float, default=10.0, help="Target requests per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="Test duration in seconds")
+    parser.add_argument("--mix", default="generate=0.6,analyze=0.2,compose=0.2",
+                        help="Endpoint weights, e.g. generate=0.6,analyze=0.2,compose=0.2")
+    parser.add_argument("--repeat-ratio", type=float, default=0.3,
+                        help="Probability of resending an earlier payload (exercises the cache)")
+    parser.add_argument("--max-in-flight", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--metrics-interval", type=float, default=1.0)
+    parser.add_argument("--json", dest="json_output", help="Write the summary to this file as JSON")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary = asyncio.run(run_load_test(args))
+    print_report(summary)
+    if args.json_output:
+        with open(args.json_output, "w") as f:
+            json.dump(summary, f, indent=2)
@@ -5,13 +5,30 @@ import json
 import re
 import time
 import hashlib
+import heapq
+import bisect
 import hmac
+import itertools
+import io
+import math
+import queue
+import random
+import sqlite3
+import struct
+import sys
+import textwrap
+import threading
+import unicodedata
+import zlib
 from pathlib import Path
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, List, Iterator, BinaryIO
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 from functools import wraps
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, deque, Counter
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
 import weakref
 import gc
 
@@ -20,16 +37,13 @@ from fastapi import FastAPI, HTTPException, Request, Response, Depends, status,
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field, validator
 import aiohttp
 from dotenv import load_dotenv
 import tiktoken
 
 # Rate limiting without Redis
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
 
 # Configure structured logging
 logging.basicConfig(
@@ -38,153 +52,1266 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Thread-safe in-memory cache implementation
-class ThreadSafeCache:
-    def __init__(self, max_size: int = 10000, default_ttl: int = 300):
+# Serialized cache values: a one-byte codec tag followed by JSON, zlib-compressed above a size threshold
+CACHE_CODEC_JSON = b'J'
+CACHE_CODEC_ZLIB = b'Z'
+
+def encode_cache_value(value: Any, compress_threshold: int = 1024) -> Tuple[bytes, int]:
+    """Serialize a value; returns (blob, uncompressed size)"""
+    data = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if len(data) >= compress_threshold:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return CACHE_CODEC_ZLIB + compressed, len(data)
+    return CACHE_CODEC_JSON + data, len(data)
+
+def decode_cache_blob(blob: bytes) -> Tuple[Any, int]:
+    """Deserialize a blob; returns (value, uncompressed size)"""
+    codec, data = blob[:1], blob[1:]
+    if codec == CACHE_CODEC_ZLIB:
+        data = zlib.decompress(data)
+    elif codec != CACHE_CODEC_JSON:
+        raise ValueError(f"Unknown cache codec {codec!r}")
+    return json.loads(data), len(data)
+
+def decode_cache_value(blob: bytes) -> Any:
+    return decode_cache_blob(blob)[0]
+
+# Count-Min sketch of access frequencies with periodic halving (TinyLFU aging)
+class FrequencySketch:
+    DEPTH = 4
+    MAX_COUNT = 15
+    # Odd multipliers; the top bits of key_hash * seed index each row
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+    HALVE_TABLE = bytes(value >> 1 for value in range(256))
+    
+    def __init__(self, capacity: int):
+        capacity = max(1, capacity)
+        self.width_bits = max(4, (capacity - 1).bit_length())
+        self.width = 1 << self.width_bits
+        self.table = bytearray(self.DEPTH * self.width)
+        # Halve every counter after this many increments so stale popularity fades
+        self.sample_size = 10 * capacity
+        self.additions = 0
+        self.resets = 0
+    
+    def _indexes(self, key: str):
+        key_hash = hash(key) & 0xFFFFFFFFFFFFFFFF
+        shift = 64 - self.width_bits
+        for row, seed in enumerate(self.SEEDS):
+            yield row * self.width + (((key_hash * seed) & 0xFFFFFFFFFFFFFFFF) >> shift)
+    
+    def increment(self, key: str):
+        table = self.table
+        added = False
+        for index in self._indexes(key):
+            if table[index] < self.MAX_COUNT:
+                table[index] += 1
+                added = True
+        
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self.table = bytearray(table.translate(self.HALVE_TABLE))
+                self.additions //= 2
+                self.resets += 1
+    
+    def frequency(self, key: str) -> int:
+        table = self.table
+        return min(table[index] for index in self._indexes(key))
+
+# Cache snapshot file: magic, then per entry a fixed header
+# (key length, value length, created_at, expires_at, hit count) followed by the key and encoded value
+CACHE_SNAPSHOT_MAGIC = b"RXC1"
+CACHE_SNAPSHOT_RECORD = struct.Struct(">IIddI")
+
+# Cache entry with its own expiry and size accounting
+class CacheEntry:
+    __slots__ = ('value', 'created_at', 'expires_at', 'size', 'stored_size', 'raw_size', 'hits')
+    
+    def __init__(self, value: Any, created_at: float, expires_at: float,
+                 size: int = 0, stored_size: int = 0, raw_size: int = 0, hits: int = 0):
+        self.value = value
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.size = size                # estimated resident bytes, key and bookkeeping included
+        self.stored_size = stored_size  # bytes of the stored (possibly compressed) value
+        self.raw_size = raw_size        # bytes of the value serialized but uncompressed
+        self.hits = hits
+
+# One lock-striped partition of ThreadSafeCache
+class _CacheShard:
+    # Expired entries reaped per write, keeps set() O(log n) amortized
+    REAP_BATCH = 16
+    # Upper bounds (bytes) of the stored-size histogram buckets; the last bucket is open-ended
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536)
+    
+    def __init__(self, max_size: int, max_bytes: Optional[int] = None):
         self.max_size = max_size
-        self.default_ttl = default_ttl
-        self._cache = OrderedDict()
-        self._timestamps = {}
-        self._lock = Lock()
-        self._stats = {
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # Min-heap of (expires_at, key); stale items are skipped lazily
+        self.expiry_heap: List[Tuple[float, str]] = []
+        self.lock = Lock()
+        self.bytes = 0
+        self.stored_bytes = 0
+        self.raw_bytes = 0
+        self.compressed_entries = 0
+        self.size_histogram = [0] * (len(self.SIZE_BUCKETS) + 1)
+        # Optional callback(key) on every add/remove, e.g. CacheSearchIndex.mark_dirty
+        self.listener = None
+        self.stats = {
             'hits': 0,
+            'l2_hits': 0,
+            'near_hits': 0,
             'misses': 0,
             'evictions': 0,
+            'expirations': 0,
+            'rejected': 0,
+            'admissions': 0,
+            'admission_rejections': 0,
             'sets': 0
         }
     
-    def _is_expired(self, key: str) -> bool:
-        if key not in self._timestamps:
-            return True
-        return time.time() - self._timestamps[key] > self.default_ttl
-    
-    def _evict_expired(self):
-        """Remove expired entries"""
-        current_time = time.time()
-        expired_keys = [
-            key for key, timestamp in self._timestamps.items()
-            if current_time - timestamp > self.default_ttl
-        ]
+    def _account(self, entry: CacheEntry, sign: int):
+        self.bytes += sign * entry.size
+        self.stored_bytes += sign * entry.stored_size
+        self.raw_bytes += sign * entry.raw_size
+        if entry.raw_size and entry.value[:1] == CACHE_CODEC_ZLIB:
+            self.compressed_entries += sign
+        self.size_histogram[bisect.bisect_right(self.SIZE_BUCKETS, entry.stored_size)] += sign
+    
+    def add(self, key: str, entry: CacheEntry):
+        """Insert at the MRU end; caller holds the lock and has removed any old entry"""
+        self.entries[key] = entry
+        self._account(entry, 1)
+        if self.listener is not None:
+            self.listener(key)
+    
+    def remove(self, key: str) -> Optional[CacheEntry]:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._account(entry, -1)
+            if self.listener is not None:
+                self.listener(key)
+        return entry
+    
+    def pop_lru(self):
+        key, entry = self.entries.popitem(last=False)
+        self._account(entry, -1)
+        if self.listener is not None:
+            self.listener(key)
+    
+    def record_access(self, key: str):
+        """Hook for frequency-aware subclasses; plain LRU needs no history"""
+    
+    def touch(self, key: str):
+        # Move to end (mark as recently used)
+        self.entries.move_to_end(key)
+    
+    def insert(self, key: str, entry: CacheEntry):
+        """Evict LRU until both the entry and byte budgets fit, then add"""
+        while self.entries and (
+            len(self.entries) >= self.max_size
+            or (self.max_bytes is not None and self.bytes + entry.size > self.max_bytes)
+        ):
+            self.pop_lru()
+            self.stats['evictions'] += 1
+        self.add(key, entry)
+    
+    def reset(self):
+        self.entries.clear()
+        self.expiry_heap.clear()
+        self.bytes = self.stored_bytes = self.raw_bytes = self.compressed_entries = 0
+        self.size_histogram = [0] * (len(self.SIZE_BUCKETS) + 1)
+    
+    def reap_expired(self, now: float, limit: Optional[int] = None) -> int:
+        """Pop expired entries off the heap; caller holds the lock"""
+        reaped = 0
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now and (limit is None or reaped < limit):
+            expires_at, key = heapq.heappop(heap)
+            entry = self.entries.get(key)
+            # Skip heap items left behind by overwrites or deletes
+            if entry is not None and entry.expires_at == expires_at:
+                self.remove(key)
+                self.stats['expirations'] += 1
+                reaped += 1
         
-        for key in expired_keys:
-            self._cache.pop(key, None)
-            self._timestamps.pop(key, None)
-            self._stats['evictions'] += 1
+        # Overwrites leave stale heap items behind; rebuild once they dominate
+        if len(heap) > 2 * len(self.entries) + 64:
+            self.expiry_heap = [(entry.expires_at, key) for key, entry in self.entries.items()]
+            heapq.heapify(self.expiry_heap)
+        return reaped
+
+# Shard with W-TinyLFU admission: a small window LRU in front of a segmented main LRU
+class _TinyLFUCacheShard(_CacheShard):
+    WINDOW_RATIO = 0.01
+    PROTECTED_RATIO = 0.8
     
-    def _evict_lru(self):
-        """Remove least recently used items if cache is full"""
-        while len(self._cache) >= self.max_size:
-            oldest_key = next(iter(self._cache))
-            self._cache.pop(oldest_key)
-            self._timestamps.pop(oldest_key, None)
-            self._stats['evictions'] += 1
+    def __init__(self, max_size: int, max_bytes: Optional[int] = None):
+        super().__init__(max_size, max_bytes)
+        self.window_cap = max(1, int(max_size * self.WINDOW_RATIO))
+        self.protected_cap = max(1, int((max_size - self.window_cap) * self.PROTECTED_RATIO))
+        # Key order only; the entries themselves live in self.entries
+        self.window: "OrderedDict[str, None]" = OrderedDict()
+        self.probation: "OrderedDict[str, None]" = OrderedDict()
+        self.protected: "OrderedDict[str, None]" = OrderedDict()
+        self.sketch = FrequencySketch(max_size)
     
-    def get(self, key: str) -> Optional[Any]:
-        with self._lock:
-            if key in self._cache and not self._is_expired(key):
-                # Move to end (mark as recently used)
-                value = self._cache.pop(key)
-                self._cache[key] = value
-                self._stats['hits'] += 1
-                return value
+    def record_access(self, key: str):
+        self.sketch.increment(key)
+    
+    def touch(self, key: str):
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.protected:
+            self.protected.move_to_end(key)
+        elif key in self.probation:
+            # Second hit in main promotes to protected; its overflow drops back to probation
+            del self.probation[key]
+            self.protected[key] = None
+            if len(self.protected) > self.protected_cap:
+                demoted, _ = self.protected.popitem(last=False)
+                self.probation[demoted] = None
+    
+    def add(self, key: str, entry: CacheEntry):
+        super().add(key, entry)
+        self.window[key] = None
+    
+    def remove(self, key: str) -> Optional[CacheEntry]:
+        entry = super().remove(key)
+        if entry is not None:
+            self.window.pop(key, None)
+            self.probation.pop(key, None)
+            self.protected.pop(key, None)
+        return entry
+    
+    def reset(self):
+        super().reset()
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+    
+    def _evict(self, key: str):
+        self.remove(key)
+        self.stats['evictions'] += 1
+    
+    def insert(self, key: str, entry: CacheEntry):
+        self.add(key, entry)
+        
+        while len(self.entries) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            victim = next(iter(self.probation), None) or next(iter(self.protected), None)
+            candidate = next(iter(self.window)) if len(self.window) > self.window_cap or victim is None else None
+            
+            if candidate is None:
+                self._evict(victim)
+            elif victim is None:
+                self._evict(candidate)
+            elif self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+                # The window's oldest entry is more popular than main's weakest: swap them
+                self._evict(victim)
+                del self.window[candidate]
+                self.probation[candidate] = None
+                self.stats['admissions'] += 1
             else:
-                # Remove expired key
-                if key in self._cache:
-                    self._cache.pop(key, None)
-                    self._timestamps.pop(key, None)
-                self._stats['misses'] += 1
-                return None
+                self._evict(candidate)
+                self.stats['admission_rejections'] += 1
+        
+        # Main has room: window overflow moves in without a contest
+        while len(self.window) > self.window_cap:
+            spilled, _ = self.window.popitem(last=False)
+            self.probation[spilled] = None
+
+# Optional persistent second cache tier (SQLite) that survives restarts and cold starts
+class SQLiteCacheTier:
+    WRITE_BATCH = 256
     
-    def set(self, key: str, value: Any, ttl: int = None) -> bool:
+    def __init__(self, path: str, default_ttl: int = 86400, max_entries: int = 50000, queue_size: int = 10000):
+        self.path = path
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._write_queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._lock = Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'writes': 0,
+            'dropped_writes': 0,
+            'evictions': 0,
+            'errors': 0
+        }
+        
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache(expires_at)")
+        conn.commit()
+        
+        # Writes happen on a background thread so the event loop never waits on disk
+        self._writer = threading.Thread(target=self._writer_loop, name="cache-l2-writer", daemon=True)
+        self._writer.start()
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        """Return (encoded value, expires_at) for a live entry. Blocks on disk: request handlers
+        reach it through ThreadSafeCache.get_async / get_similar_async on a worker thread"""
+        try:
+            row = self._connect().execute(
+                "SELECT value, expires_at FROM cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"L2 cache read failed: {e}")
+            with self._lock:
+                self._stats['errors'] += 1
+            return None
+        
         with self._lock:
-            # Clean expired entries periodically
-            if len(self._cache) % 100 == 0:  # Every 100 operations
-                self._evict_expired()
+            self._stats['hits' if row else 'misses'] += 1
+        if row is None:
+            return None
+        return bytes(row[0]), row[1]
+    
+    def _enqueue(self, operation: tuple):
+        try:
+            self._write_queue.put_nowait(operation)
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped_writes'] += 1
+    
+    def set_async(self, key: str, value: Any, created_at: float, blob: Optional[bytes] = None):
+        """Queue a write; pass `blob` when the value is already encoded"""
+        self._enqueue(('set', key, value, created_at, blob))
+    
+    def delete_async(self, key: str):
+        self._enqueue(('delete', key))
+    
+    def clear_async(self):
+        self._enqueue(('clear',))
+    
+    def _apply(self, conn: sqlite3.Connection, operation: tuple):
+        kind = operation[0]
+        if kind == 'set':
+            _, key, value, created_at, blob = operation
+            if blob is None:
+                blob, _ = encode_cache_value(value)
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, blob, created_at, created_at + self.default_ttl)
+            )
+            with self._lock:
+                self._stats['writes'] += 1
+        elif kind == 'delete':
+            conn.execute("DELETE FROM cache WHERE key = ?", (operation[1],))
+        elif kind == 'clear':
+            conn.execute("DELETE FROM cache")
+    
+    def _enforce_bounds(self, conn: sqlite3.Connection):
+        """Drop expired rows, then the soonest-to-expire rows beyond max_entries"""
+        removed = conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),)).rowcount
+        overflow = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            removed += conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires_at LIMIT ?)",
+                (overflow,)
+            ).rowcount
+        if removed:
+            with self._lock:
+                self._stats['evictions'] += removed
+    
+    def _writer_loop(self):
+        conn = self._connect()
+        writes_since_trim = 0
+        while True:
+            operation = self._write_queue.get()
+            if operation is None:
+                break
             
-            # Evict LRU if needed
-            self._evict_lru()
+            # Drain whatever else is queued into the same transaction
+            batch = [operation]
+            stop = False
+            while len(batch) < self.WRITE_BATCH:
+                try:
+                    operation = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if operation is None:
+                    stop = True
+                    break
+                batch.append(operation)
             
-            self._cache[key] = value
-            self._timestamps[key] = time.time()
-            self._stats['sets'] += 1
-            return True
+            try:
+                with conn:
+                    for operation in batch:
+                        self._apply(conn, operation)
+                    writes_since_trim += len(batch)
+                    if writes_since_trim >= 500:
+                        self._enforce_bounds(conn)
+                        writes_since_trim = 0
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                logger.warning(f"L2 cache write failed: {e}")
+                with self._lock:
+                    self._stats['errors'] += 1
+            
+            if stop:
+                break
+        
+        try:
+            with conn:
+                self._enforce_bounds(conn)
+        except sqlite3.Error as e:
+            logger.warning(f"L2 cache trim failed: {e}")
     
-    def delete(self, key: str) -> bool:
+    def close(self):
+        """Flush pending writes and stop the writer thread"""
+        if self._writer.is_alive():
+            self._write_queue.put(None)
+            self._writer.join(timeout=5)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        try:
+            entries = self._connect().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        except sqlite3.Error:
+            entries = None
         with self._lock:
-            if key in self._cache:
-                self._cache.pop(key)
-                self._timestamps.pop(key, None)
-                return True
+            return {
+                **self._stats,
+                'entries': entries,
+                'pending_writes': self._write_queue.qsize(),
+                'max_entries': self.max_entries,
+                'default_ttl': self.default_ttl,
+                'path': self.path
+            }
+
+# SimHash index over cached inputs so near-identical emails can share a cache entry
+class NearDuplicateIndex:
+    FINGERPRINT_BITS = 64
+    SHINGLE_WORDS = 3
+    # Too few shingles make the fingerprint unstable, such inputs only match exactly
+    MIN_SHINGLES = 8
+    
+    def __init__(self, max_distance: int = 3, max_entries: int = 10000):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        # Pigeonhole: two fingerprints within max_distance bits agree exactly on at least one of max_distance + 1 bands
+        band_count = max_distance + 1
+        self._bands = []
+        start = 0
+        for index in range(band_count):
+            width = self.FINGERPRINT_BITS // band_count + (1 if index < self.FINGERPRINT_BITS % band_count else 0)
+            self._bands.append((start, (1 << width) - 1))
+            start += width
+        self._fingerprints: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, int], set] = defaultdict(set)
+        self._lock = Lock()
+        self._stats = {
+            'indexed': 0,
+            'lookups': 0,
+            'candidates_checked': 0,
+            'dropped': 0
+        }
+    
+    @classmethod
+    def fingerprint(cls, text: str) -> Optional[int]:
+        """64-bit SimHash over casefolded word shingles"""
+        words = re.findall(r'\w+', text.casefold())
+        shingle_count = len(words) - cls.SHINGLE_WORDS + 1
+        if shingle_count < cls.MIN_SHINGLES:
+            return None
+        
+        hashes = [
+            hash(" ".join(words[i:i + cls.SHINGLE_WORDS])) & 0xFFFFFFFFFFFFFFFF
+            for i in range(shingle_count)
+        ]
+        
+        # Count set bits column-wise one byte at a time instead of 64 passes per shingle
+        bit_counts = [0] * cls.FINGERPRINT_BITS
+        for byte_index in range(cls.FINGERPRINT_BITS // 8):
+            shift = byte_index * 8
+            for byte_value, count in Counter((h >> shift) & 0xFF for h in hashes).items():
+                while byte_value:
+                    low_bit = byte_value & -byte_value
+                    bit_counts[shift + low_bit.bit_length() - 1] += count
+                    byte_value ^= low_bit
+        
+        half = shingle_count / 2
+        fingerprint = 0
+        for bit, count in enumerate(bit_counts):
+            if count > half:
+                fingerprint |= 1 << bit
+        return fingerprint
+    
+    def _band_keys(self, namespace: str, fingerprint: int):
+        for index, (shift, mask) in enumerate(self._bands):
+            yield (namespace, index, (fingerprint >> shift) & mask)
+    
+    def _remove(self, key: str):
+        """Drop a key from the index; caller holds the lock"""
+        indexed = self._fingerprints.pop(key, None)
+        if indexed is None:
+            return
+        for band_key in self._band_keys(*indexed):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+    
+    def add(self, key: str, namespace: str, text: str) -> bool:
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
             return False
+        with self._lock:
+            self._remove(key)
+            while len(self._fingerprints) >= self.max_entries:
+                self._remove(next(iter(self._fingerprints)))
+                self._stats['dropped'] += 1
+            self._fingerprints[key] = (namespace, fingerprint)
+            for band_key in self._band_keys(namespace, fingerprint):
+                self._buckets[band_key].add(key)
+            self._stats['indexed'] += 1
+        return True
+    
+    def remove(self, key: str):
+        with self._lock:
+            self._remove(key)
     
     def clear(self):
         with self._lock:
-            self._cache.clear()
-            self._timestamps.clear()
+            self._fingerprints.clear()
+            self._buckets.clear()
     
-    def size(self) -> int:
+    def candidates(self, namespace: str, text: str) -> List[Tuple[str, int]]:
+        """Indexed keys within max_distance of text, closest first"""
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            return []
         with self._lock:
-            return len(self._cache)
+            self._stats['lookups'] += 1
+            seen = set()
+            for band_key in self._band_keys(namespace, fingerprint):
+                seen.update(self._buckets.get(band_key, ()))
+            self._stats['candidates_checked'] += len(seen)
+            
+            matches = []
+            for key in seen:
+                distance = bin(self._fingerprints[key][1] ^ fingerprint).count("1")
+                if distance <= self.max_distance:
+                    matches.append((key, distance))
+        matches.sort(key=lambda match: match[1])
+        return matches
     
-    def stats(self) -> Dict[str, Any]:
+    def get_stats(self) -> Dict[str, Any]:
         with self._lock:
-            hit_rate = self._stats['hits'] / max(1, self._stats['hits'] + self._stats['misses'])
             return {
                 **self._stats,
-                'size': len(self._cache),
-                'hit_rate': round(hit_rate, 3),
-                'max_size': self.max_size
+                'entries': len(self._fingerprints),
+                'max_distance': self.max_distance,
+                'bands': len(self._bands)
             }
 
-# In-memory rate limiter
-class InMemoryRateLimiter:
-    def __init__(self):
-        self._requests = defaultdict(list)
+# SHARDS-style spatially sampled ghost caches estimating hit rate across candidate sizes and TTLs
+class MissRatioCurveEstimator:
+    HASH_SPACE = 1 << 24
+    
+    def __init__(self, sizes: List[int], ttls: List[float], sample_rate: float = 0.01):
+        self.sample_rate = min(1.0, max(1.0 / self.HASH_SPACE, sample_rate))
+        self._threshold = int(self.sample_rate * self.HASH_SPACE)
+        self.sizes = sorted(set(max(1, int(size)) for size in sizes))
+        self.ttls = sorted(set(ttls))
+        # A sampled key stream sees sample_rate of the traffic, so each ghost is scaled down to match
+        self._capacities = {size: max(1, round(size * self.sample_rate)) for size in self.sizes}
+        # Ghost entries hold only the fill time; values are never stored
+        self._ghosts: Dict[Tuple[int, float], "OrderedDict[str, float]"] = {
+            (size, ttl): OrderedDict() for size in self.sizes for ttl in self.ttls
+        }
+        self._hits: Dict[Tuple[int, float], int] = defaultdict(int)
+        self._accesses = 0
         self._lock = Lock()
-        self._cleanup_counter = 0
     
-    def is_allowed(self, identifier: str, limit: int, window: int = 60) -> Tuple[bool, int]:
-        current_time = time.time()
+    def sampled(self, key: str) -> bool:
+        return (hash(key) & (self.HASH_SPACE - 1)) < self._threshold
+    
+    def record(self, key: str):
+        """Replay one lookup; a miss is assumed to be followed by a fill, as the endpoints do"""
+        if not self.sampled(key):
+            return
+        now = time.time()
+        with self._lock:
+            self._accesses += 1
+            for (size, ttl), ghost in self._ghosts.items():
+                filled_at = ghost.get(key)
+                if filled_at is not None and now - filled_at < ttl:
+                    ghost.move_to_end(key)
+                    self._hits[(size, ttl)] += 1
+                    continue
+                ghost[key] = now
+                ghost.move_to_end(key)
+                if len(ghost) > self._capacities[size]:
+                    ghost.popitem(last=False)
+    
+    def curve(self) -> Dict[str, Any]:
+        with self._lock:
+            accesses = self._accesses
+            points = [
+                {
+                    'size': size,
+                    'ttl_seconds': ttl,
+                    'hit_rate': round(self._hits[(size, ttl)] / accesses, 4) if accesses else None
+                }
+                for size in self.sizes for ttl in self.ttls
+            ]
+        return {
+            'sample_rate': self.sample_rate,
+            'sampled_accesses': accesses,
+            'estimated_accesses': int(accesses / self.sample_rate),
+            'points': points
+        }
+
+# Inverted word index over cached values for admin search; writers only mark keys dirty
+class CacheSearchIndex:
+    WORD_PATTERN = re.compile(r'\w+')
+    
+    def __init__(self, max_pending: int = 20000):
+        self.max_pending = max_pending
+        # Guards the dirty set, which the request path touches
+        self._lock = Lock()
+        self._dirty: set = set()
+        self._needs_rebuild = False
+        # Guards the postings, which only admin worker threads touch
+        self._index_lock = Lock()
+        self._postings: Dict[str, set] = defaultdict(set)
+        self._terms: Dict[str, set] = {}
+        self._vocabulary: List[str] = []
+        self._vocabulary_stale = False
+        self._stats = {
+            'updates_applied': 0,
+            'rebuilds': 0,
+            'searches': 0
+        }
+    
+    @classmethod
+    def terms_for(cls, value: Any) -> set:
+        return set(cls.WORD_PATTERN.findall(str(value).lower()))
+    
+    def mark_dirty(self, key: str):
+        """O(1) hook called under a shard lock whenever a key is added or removed"""
+        with self._lock:
+            if self._needs_rebuild:
+                return
+            self._dirty.add(key)
+            # Nobody has searched in a long while: cheaper to rebuild than to track every change
+            if len(self._dirty) > self.max_pending:
+                self._dirty.clear()
+                self._needs_rebuild = True
+    
+    def clear(self):
+        with self._index_lock:
+            with self._lock:
+                self._dirty.clear()
+                self._needs_rebuild = False
+            self._postings.clear()
+            self._terms.clear()
+            self._vocabulary = []
+            self._vocabulary_stale = False
+    
+    def _unindex(self, key: str):
+        for term in self._terms.pop(key, ()):
+            keys = self._postings.get(term)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[term]
+                    self._vocabulary_stale = True
+    
+    def sync(self, cache: "ThreadSafeCache"):
+        """Apply pending changes; blocking, run it off the event loop"""
+        with self._index_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                rebuild, self._needs_rebuild = self._needs_rebuild, False
+            
+            if rebuild:
+                self._postings.clear()
+                self._terms.clear()
+                dirty = set(cache.keys())
+                self._stats['rebuilds'] += 1
+            
+            for key in dirty:
+                self._unindex(key)
+                info = cache.entry_info(key)
+                if info is None:
+                    continue
+                terms = self.terms_for(info['value'])
+                self._terms[key] = terms
+                for term in terms:
+                    if term not in self._postings:
+                        self._vocabulary_stale = True
+                    self._postings[term].add(key)
+            self._stats['updates_applied'] += len(dirty)
+    
+    def candidates(self, cache: "ThreadSafeCache", search_term: str) -> Optional[set]:
+        """
+        Superset of the keys whose value contains search_term; None when the query has no words.
+        A word the query starts with may begin mid-word in the value, so it is matched anywhere in a
+        term; every later word follows a non-word character and is matched as a term prefix.
+        """
+        self.sync(cache)
+        needle = search_term.lower()
+        words = self.WORD_PATTERN.findall(needle)
+        if not words:
+            return None
+        leading = words[0] if self.WORD_PATTERN.match(needle) else None
         
+        with self._index_lock:
+            self._stats['searches'] += 1
+            if self._vocabulary_stale:
+                self._vocabulary = sorted(self._postings)
+                self._vocabulary_stale = False
+            
+            result = None
+            # Cheap prefix lookups first; they usually narrow the result before the infix scan
+            for word in sorted(set(words), key=lambda word: word == leading):
+                matches = set()
+                if word == leading:
+                    # "eeting" has to find "meeting", so scan the vocabulary (not the values)
+                    for term in self._vocabulary:
+                        if word in term:
+                            matches |= self._postings[term]
+                else:
+                    # Prefix range in the sorted vocabulary, so "meet" finds "meeting"
+                    index = bisect.bisect_left(self._vocabulary, word)
+                    while index < len(self._vocabulary) and self._vocabulary[index].startswith(word):
+                        matches |= self._postings[self._vocabulary[index]]
+                        index += 1
+                result = matches if result is None else result & matches
+                if not result:
+                    break
+            return result
+    
+    def get_stats(self) -> Dict[str, Any]:
         with self._lock:
-            # Cleanup old entries periodically
-            self._cleanup_counter += 1
-            if self._cleanup_counter % 100 == 0:
-                self._cleanup_old_entries(current_time, window)
+            pending = len(self._dirty)
+            needs_rebuild = self._needs_rebuild
+        with self._index_lock:
+            return {
+                **self._stats,
+                'indexed_keys': len(self._terms),
+                'terms': len(self._postings),
+                'pending_updates': pending,
+                'needs_rebuild': needs_rebuild
+            }
+
+# Thread-safe in-memory cache implementation
+class ThreadSafeCache:
+    # Per-entry bookkeeping beyond key and value: entry object, timestamps, OrderedDict node, heap tuple
+    ENTRY_OVERHEAD = 240
+    SHARD_TYPES = {"lru": _CacheShard, "tinylfu": _TinyLFUCacheShard}
+    
+    def __init__(self, max_size: int = 10000, default_ttl: int = 300, shards: int = 8,
+                 l2: Optional[SQLiteCacheTier] = None, near_index: Optional[NearDuplicateIndex] = None,
+                 max_bytes: Optional[int] = None, compress_threshold: int = 1024,
+                 eviction_policy: str = "lru", mrc: Optional[MissRatioCurveEstimator] = None,
+                 search_index: Optional[CacheSearchIndex] = None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.l2 = l2
+        self.near_index = near_index
+        self.mrc = mrc
+        self.search_index = search_index
+        # A byte budget needs measurable values, so it switches storage to serialized blobs
+        self.max_bytes = max_bytes
+        self.serialize = max_bytes is not None
+        self.compress_threshold = compress_threshold
+        if eviction_policy not in self.SHARD_TYPES:
+            raise ValueError(f"Unknown eviction policy: {eviction_policy}")
+        self.eviction_policy = eviction_policy
+        shard_type = self.SHARD_TYPES[eviction_policy]
+        shard_count = max(1, min(shards, max_size))
+        # Spread capacity so the shard sizes add up to max_size
+        self._shards = [
+            shard_type(
+                max_size // shard_count + (1 if index < max_size % shard_count else 0),
+                max_bytes // shard_count if max_bytes is not None else None
+            )
+            for index in range(shard_count)
+        ]
+        if search_index is not None:
+            for shard in self._shards:
+                shard.listener = search_index.mark_dirty
+    
+    def _shard_for(self, key: str) -> _CacheShard:
+        return self._shards[hash(key) % len(self._shards)]
+    
+    def _decode(self, stored: Any) -> Any:
+        return decode_cache_value(stored) if self.serialize else stored
+    
+    def get(self, key: str) -> Optional[Any]:
+        if self.mrc is not None:
+            self.mrc.record(key)
+        return self._get(key, record_miss=True)
+    
+    async def get_async(self, key: str) -> Optional[Any]:
+        """get() for request handlers: an L1 miss reads L2 on a worker thread, off the event loop"""
+        if self.mrc is not None:
+            self.mrc.record(key)
+        return await self._get_async(key, record_miss=True)
+    
+    def _get(self, key: str, record_miss: bool) -> Optional[Any]:
+        shard, now, value = self._get_l1(key, record_miss)
+        if value is not None or self.l2 is None:
+            return value
+        return self._read_through(shard, key, now, self.l2.get(key), record_miss)
+    
+    async def _get_async(self, key: str, record_miss: bool) -> Optional[Any]:
+        shard, now, value = self._get_l1(key, record_miss)
+        if value is not None or self.l2 is None:
+            return value
+        found = await asyncio.to_thread(self.l2.get, key)
+        return self._read_through(shard, key, now, found, record_miss)
+    
+    def _get_l1(self, key: str, record_miss: bool) -> Tuple[_CacheShard, float, Optional[Any]]:
+        shard = self._shard_for(key)
+        now = time.time()
+        with shard.lock:
+            shard.record_access(key)
+            entry = shard.entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                shard.touch(key)
+                entry.hits += 1
+                shard.stats['hits'] += 1
+                stored = entry.value
+            else:
+                stored = None
+                if entry is not None:
+                    # Remove expired key; its heap item is skipped when reaped
+                    shard.remove(key)
+                    shard.stats['expirations'] += 1
+                if self.l2 is None and record_miss:
+                    shard.stats['misses'] += 1
+        
+        # Decompress outside the shard lock
+        return shard, now, self._decode(stored) if stored is not None else None
+    
+    def _read_through(self, shard: _CacheShard, key: str, now: float,
+                      found: Optional[Tuple[bytes, float]], record_miss: bool) -> Optional[Any]:
+        """Promote an L2 row into L1 without writing back to L2"""
+        if found is None:
+            if record_miss:
+                with shard.lock:
+                    shard.stats['misses'] += 1
+            return None
+        
+        blob, l2_expires_at = found
+        try:
+            value, raw_size = decode_cache_blob(blob)
+        except (ValueError, zlib.error) as e:
+            logger.warning(f"Discarding unreadable L2 cache entry: {e}")
+            self.l2.delete_async(key)
+            if record_miss:
+                with shard.lock:
+                    shard.stats['misses'] += 1
+            return None
+        stored, raw_size = (blob, raw_size) if self.serialize else (value, 0)
+        self._store(shard, key, stored, raw_size, now, min(l2_expires_at, now + self.default_ttl), 'l2_hits')
+        return value
+    
+    def _peek(self, key: str) -> Optional[Any]:
+        """Live L1 value without touching hit/miss stats"""
+        shard = self._shard_for(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None or entry.expires_at <= time.time():
+                return None
+            shard.touch(key)
+            entry.hits += 1
+            stored = entry.value
+        return self._decode(stored)
+    
+    def get_similar(self, key: str, similar: Optional[Tuple[str, str]] = None) -> Optional[Tuple[Any, float]]:
+        """Exact lookup, falling back to the nearest indexed input in `similar` (namespace, text)
+        when given; returns (value, similarity)"""
+        if self.mrc is not None:
+            self.mrc.record(key)
+        value = self._get(key, record_miss=False)
+        if value is not None:
+            return value, 1.0
+        return self._get_near(key, similar)
+    
+    async def get_similar_async(self, key: str, similar: Optional[Tuple[str, str]] = None) -> Optional[Tuple[Any, float]]:
+        """get_similar() for request handlers, reading L2 off the event loop"""
+        if self.mrc is not None:
+            self.mrc.record(key)
+        value = await self._get_async(key, record_miss=False)
+        if value is not None:
+            return value, 1.0
+        return self._get_near(key, similar)
+    
+    def _get_near(self, key: str, similar: Optional[Tuple[str, str]]) -> Optional[Tuple[Any, float]]:
+        shard = self._shard_for(key)
+        if self.near_index is not None and similar is not None:
+            for candidate, distance in self.near_index.candidates(*similar):
+                value = self._peek(candidate)
+                if value is None:
+                    # Evicted or expired since it was indexed
+                    self.near_index.remove(candidate)
+                    continue
+                with shard.lock:
+                    shard.stats['near_hits'] += 1
+                return value, round(1 - distance / NearDuplicateIndex.FINGERPRINT_BITS, 4)
+        
+        with shard.lock:
+            shard.stats['misses'] += 1
+        return None
+    
+    def _store(self, shard: _CacheShard, key: str, stored: Any, raw_size: int,
+               now: float, expires_at: float, stat: str, hits: int = 0) -> bool:
+        if self.serialize:
+            entry = CacheEntry(stored, now, expires_at,
+                               size=sys.getsizeof(stored) + sys.getsizeof(key) + self.ENTRY_OVERHEAD,
+                               stored_size=len(stored), raw_size=raw_size, hits=hits)
+        else:
+            # Shallow size: exact for strings and numbers, a lower bound for containers
+            entry = CacheEntry(stored, now, expires_at,
+                               size=sys.getsizeof(stored) + sys.getsizeof(key) + self.ENTRY_OVERHEAD, hits=hits)
+        
+        with shard.lock:
+            shard.reap_expired(now, limit=_CacheShard.REAP_BATCH)
+            shard.remove(key)
+            # Carried-over popularity (snapshot imports) seeds frequency-aware admission
+            for _ in range(min(hits, FrequencySketch.MAX_COUNT)):
+                shard.record_access(key)
+            
+            if shard.max_bytes is not None and entry.size > shard.max_bytes:
+                shard.stats['rejected'] += 1
+                return False
+            
+            shard.insert(key, entry)
+            if key not in shard.entries:
+                # Lost the admission contest on the way in
+                return False
+            heapq.heappush(shard.expiry_heap, (expires_at, key))
+            shard.stats[stat] += 1
+            return True
+    
+    def set(self, key: str, value: Any, ttl: int = None, similar: Optional[Tuple[str, str]] = None) -> bool:
+        """Store a value; `similar` is an optional (namespace, text) pair to index for near-duplicate lookups"""
+        shard = self._shard_for(key)
+        now = time.time()
+        if self.serialize:
+            stored, raw_size = encode_cache_value(value, self.compress_threshold)
+        else:
+            stored, raw_size = value, 0
+        
+        stored_ok = self._store(shard, key, stored, raw_size, now,
+                                now + (ttl if ttl is not None else self.default_ttl), 'sets')
+        if self.l2 is not None:
+            self.l2.set_async(key, value, now, blob=stored if self.serialize else None)
+        if stored_ok and similar is not None and self.near_index is not None:
+            self.near_index.add(key, *similar)
+        return stored_ok
+    
+    def delete(self, key: str) -> bool:
+        shard = self._shard_for(key)
+        if self.l2 is not None:
+            self.l2.delete_async(key)
+        if self.near_index is not None:
+            self.near_index.remove(key)
+        with shard.lock:
+            return shard.remove(key) is not None
+    
+    def clear(self, include_l2: bool = True):
+        for shard in self._shards:
+            with shard.lock:
+                shard.reset()
+        if self.near_index is not None:
+            self.near_index.clear()
+        if self.search_index is not None:
+            self.search_index.clear()
+        if include_l2 and self.l2 is not None:
+            self.l2.clear_async()
+    
+    def close(self):
+        """Flush pending L2 writes"""
+        if self.l2 is not None:
+            self.l2.close()
+    
+    def purge_expired(self) -> int:
+        """Reap every expired entry (used by the periodic cleanup task)"""
+        now = time.time()
+        reaped = 0
+        for shard in self._shards:
+            with shard.lock:
+                reaped += shard.reap_expired(now)
+        return reaped
+    
+    def entry_info(self, key: str) -> Optional[Dict[str, Any]]:
+        """Metadata for a live entry without touching LRU order or hit stats"""
+        shard = self._shard_for(key)
+        now = time.time()
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None or entry.expires_at <= now:
+                return None
+            stored, created_at, expires_at, size = entry.value, entry.created_at, entry.expires_at, entry.size
+        return {
+            'value': self._decode(stored),
+            'created_at': created_at,
+            'expires_at': expires_at,
+            'size_bytes': size
+        }
+    
+    def snapshot(self) -> List[Tuple[str, Any, float, float]]:
+        """Copy of live (key, value, created_at, expires_at) tuples, one shard lock at a time"""
+        now = time.time()
+        items = []
+        for shard in self._shards:
+            with shard.lock:
+                items.extend(
+                    (key, entry.value, entry.created_at, entry.expires_at)
+                    for key, entry in shard.entries.items()
+                    if entry.expires_at > now
+                )
+        if self.serialize:
+            items = [(key, decode_cache_value(stored), created_at, expires_at)
+                     for key, stored, created_at, expires_at in items]
+        return items
+    
+    def export_records(self) -> Iterator[bytes]:
+        """Stream live L1 entries as length-prefixed snapshot records, one shard at a time"""
+        yield CACHE_SNAPSHOT_MAGIC
+        now = time.time()
+        for shard in self._shards:
+            with shard.lock:
+                items = [
+                    (key, entry.value, entry.created_at, entry.expires_at, entry.hits)
+                    for key, entry in shard.entries.items()
+                    if entry.expires_at > now
+                ]
             
-            # Get requests for this identifier
-            requests = self._requests[identifier]
+            records = []
+            for key, stored, created_at, expires_at, hits in items:
+                blob = stored if self.serialize else encode_cache_value(stored, self.compress_threshold)[0]
+                key_bytes = key.encode('utf-8')
+                records.append(
+                    CACHE_SNAPSHOT_RECORD.pack(len(key_bytes), len(blob), created_at, expires_at, hits)
+                    + key_bytes + blob
+                )
+            if records:
+                yield b"".join(records)
+    
+    def import_records(self, stream: BinaryIO) -> Dict[str, int]:
+        """Load a snapshot written by export_records, skipping entries that have since expired"""
+        if stream.read(len(CACHE_SNAPSHOT_MAGIC)) != CACHE_SNAPSHOT_MAGIC:
+            raise ValueError("Not a cache snapshot")
+        
+        counts = {'loaded': 0, 'expired': 0, 'rejected': 0}
+        now = time.time()
+        while True:
+            header = stream.read(CACHE_SNAPSHOT_RECORD.size)
+            if not header:
+                break
+            if len(header) < CACHE_SNAPSHOT_RECORD.size:
+                raise ValueError("Truncated cache snapshot")
+            key_length, value_length, created_at, expires_at, hits = CACHE_SNAPSHOT_RECORD.unpack(header)
+            key_bytes = stream.read(key_length)
+            blob = stream.read(value_length)
+            if len(key_bytes) < key_length or len(blob) < value_length:
+                raise ValueError("Truncated cache snapshot")
             
-            # Remove old requests outside the window
-            cutoff_time = current_time - window
-            requests[:] = [req_time for req_time in requests if req_time > cutoff_time]
+            if expires_at <= now:
+                counts['expired'] += 1
+                continue
             
-            # Check if under limit
-            if len(requests) < limit:
-                requests.append(current_time)
-                return True, len(requests)
+            key = key_bytes.decode('utf-8')
+            value, raw_size = decode_cache_blob(blob)
+            stored, raw_size = (blob, raw_size) if self.serialize else (value, 0)
+            if self._store(self._shard_for(key), key, stored, raw_size, created_at, expires_at, 'sets', hits=hits):
+                counts['loaded'] += 1
             else:
-                return False, len(requests)
+                counts['rejected'] += 1
+        return counts
+    
+    def keys(self) -> List[str]:
+        """Copy of the L1 keys, one shard lock at a time (expired ones included)"""
+        keys = []
+        for shard in self._shards:
+            with shard.lock:
+                keys.extend(shard.entries)
+        return keys
     
-    def _cleanup_old_entries(self, current_time: float, window: int):
-        """Remove old entries to prevent memory growth"""
-        cutoff_time = current_time - (window * 2)  # Keep some buffer
+    def snapshot_meta(self) -> List[Tuple[str, float, float, int, int]]:
+        """Live (key, created_at, expires_at, size, stored_size) tuples without decoding values"""
+        now = time.time()
+        items = []
+        for shard in self._shards:
+            with shard.lock:
+                items.extend(
+                    (key, entry.created_at, entry.expires_at, entry.size, entry.stored_size)
+                    for key, entry in shard.entries.items()
+                    if entry.expires_at > now
+                )
+        return items
+    
+    def search(self, search_term: str, limit: int = 100) -> List[Tuple[str, Dict[str, Any]]]:
+        """Entries whose value contains search_term (case-insensitive); blocking, run off the event loop"""
+        candidates = None
+        if self.search_index is not None:
+            candidates = self.search_index.candidates(self, search_term)
+        if candidates is None:
+            candidates = self.keys()
         
-        for identifier in list(self._requests.keys()):
-            requests = self._requests[identifier]
-            requests[:] = [req_time for req_time in requests if req_time > cutoff_time]
+        needle = search_term.lower()
+        matches = []
+        for key in sorted(candidates):
+            info = self.entry_info(key)
+            if info is None or needle not in str(info['value']).lower():
+                continue
+            matches.append((key, info))
+            if len(matches) >= limit:
+                break
+        return matches
+    
+    def size(self) -> int:
+        total = 0
+        for shard in self._shards:
+            with shard.lock:
+                total += len(shard.entries)
+        return total
+    
+    def stats(self) -> Dict[str, Any]:
+        totals = defaultdict(int)
+        size = 0
+        memory = defaultdict(int)
+        histogram = [0] * (len(_CacheShard.SIZE_BUCKETS) + 1)
+        for shard in self._shards:
+            with shard.lock:
+                for name, value in shard.stats.items():
+                    totals[name] += value
+                size += len(shard.entries)
+                memory['bytes'] += shard.bytes
+                memory['stored_bytes'] += shard.stored_bytes
+                memory['raw_bytes'] += shard.raw_bytes
+                memory['compressed_entries'] += shard.compressed_entries
+                for index, count in enumerate(shard.size_histogram):
+                    histogram[index] += count
+        
+        hits = totals['hits'] + totals['l2_hits'] + totals['near_hits']
+        hit_rate = hits / max(1, hits + totals['misses'])
+        bucket_labels = [f"<{bound}" for bound in _CacheShard.SIZE_BUCKETS] + [f">={_CacheShard.SIZE_BUCKETS[-1]}"]
+        stats = {
+            **totals,
+            'l1_hits': totals['hits'],
+            'hits': hits,
+            'size': size,
+            'hit_rate': round(hit_rate, 3),
+            'max_size': self.max_size,
+            'shards': len(self._shards),
+            'eviction_policy': self.eviction_policy,
+            'bytes': memory['bytes'],
+            'max_bytes': self.max_bytes,
+            'serialized': self.serialize
+        }
+        if self.serialize:
+            stats.update({
+                'stored_bytes': memory['stored_bytes'],
+                'raw_bytes': memory['raw_bytes'],
+                'compressed_entries': memory['compressed_entries'],
+                'compression_ratio': round(memory['raw_bytes'] / max(1, memory['stored_bytes']), 3),
+                'size_histogram': dict(zip(bucket_labels, histogram))
+            })
+        if self.l2 is not None:
+            stats['l2'] = self.l2.get_stats()
+        if self.near_index is not None:
+            stats['near_index'] = self.near_index.get_stats()
+        if self.search_index is not None:
+            stats['search_index'] = self.search_index.get_stats()
+        return stats
+
+# In-memory GCRA rate limiter: one theoretical arrival time per client, LRU-bounded
+class GCRARateLimiter:
+    def __init__(self, max_clients: int = 100000):
+        self.max_clients = max(1, max_clients)
+        self._tats: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = Lock()
+        self._stats = {
+            'allowed': 0,
+            'limited': 0,
+            'evictions': 0,
+            'adjustments': 0
+        }
+    
+    def is_allowed(self, identifier: str, limit: int, burst: int = None,
+                   period: float = 60, cost: int = 1) -> Tuple[bool, int, float]:
+        """Admit `cost` units at `limit` per `period` with up to `burst` units back to back.
+        Returns (allowed, remaining burst, seconds until the request would be allowed)."""
+        burst = max(1, burst or limit)
+        interval = period / max(1, limit)
+        tolerance = interval * burst
+        # A request bigger than the whole burst still gets through once the bucket is full
+        cost = max(1, min(cost, burst))
+        now = time.monotonic()
+        
+        with self._lock:
+            tat = max(self._tats.get(identifier, now), now)
+            new_tat = tat + interval * cost
+            if new_tat - now > tolerance:
+                self._stats['limited'] += 1
+                return False, 0, new_tat - tolerance - now
             
-            # Remove empty entries
-            if not requests:
-                del self._requests[identifier]
+            self._tats[identifier] = new_tat
+            self._tats.move_to_end(identifier)
+            if len(self._tats) > self.max_clients:
+                # The least recently seen client is almost always idle, so dropping it forgets no debt
+                self._tats.popitem(last=False)
+                self._stats['evictions'] += 1
+            self._stats['allowed'] += 1
+        
+        return True, int((tolerance - (new_tat - now)) // interval), 0.0
+    
+    def adjust(self, identifier: str, limit: int, delta: int, period: float = 60):
+        """Charge (or refund, when negative) units after the fact, e.g. once the real cost is known"""
+        interval = period / max(1, limit)
+        now = time.monotonic()
+        with self._lock:
+            tat = self._tats.get(identifier)
+            if tat is None:
+                return
+            base = max(tat, now) if delta > 0 else tat
+            self._tats[identifier] = max(now, base + interval * delta)
+            self._stats['adjustments'] += 1
     
     def get_stats(self) -> Dict[str, Any]:
         with self._lock:
             return {
-                'tracked_clients': len(self._requests),
-                'total_requests': sum(len(reqs) for reqs in self._requests.values())
+                **self._stats,
+                'tracked_clients': len(self._tats),
+                'max_clients': self.max_clients
             }
 
+def parse_rate_limit_rules(value: str) -> Dict[str, Tuple[int, Optional[int]]]:
+    """Parse "name=limit[:burst],..." into {name: (limit per minute, burst or None)}"""
+    rules = {}
+    for part in value.split(","):
+        name, _, spec = part.strip().rpartition("=")
+        if not name or not spec:
+            continue
+        limit, _, burst = spec.partition(":")
+        rules[name.strip()] = (int(limit), int(burst) if burst else None)
+    return rules
+
 # Enhanced circuit breaker with metrics
 class CircuitBreaker:
     def __init__(self, failure_threshold: int = 5, timeout: int = 60, success_threshold: int = 3):
@@ -221,6 +1348,13 @@ class CircuitBreaker:
             # HALF_OPEN state
             return True
 
+    def is_available(self) -> bool:
+        """Whether can_execute() would let a request through, without counting it"""
+        with self._lock:
+            if self.state != "OPEN":
+                return True
+            return bool(self.last_failure_time and time.time() - self.last_failure_time > self.timeout)
+
     def record_success(self):
         with self._lock:
             if self.state == "HALF_OPEN":
@@ -253,6 +1387,706 @@ class CircuitBreaker:
                 **self._stats
             }
 
+# Long-lived pooled HTTP client for Groq API calls
+class GroqHTTPClient:
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        keepalive_timeout: float = 60,
+        dns_cache_ttl: int = 300,
+        timeout: int = 30
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self._lock = Lock()
+        self._stats = {
+            'sessions_created': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'requests': 0
+        }
+
+    def _build_trace_config(self) -> aiohttp.TraceConfig:
+        """Count new vs reused connections so we can report a reuse ratio"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            with self._lock:
+                self._stats['requests'] += 1
+
+        async def on_connection_create_end(session, context, params):
+            with self._lock:
+                self._stats['connections_created'] += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            with self._lock:
+                self._stats['connections_reused'] += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    async def start(self):
+        """Create the shared session (called from startup_event)"""
+        if self._session is not None and not self._session.closed:
+            return
+        self._connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=self.keepalive_timeout,
+            enable_cleanup_closed=True,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            trace_configs=[self._build_trace_config()]
+        )
+        with self._lock:
+            self._stats['sessions_created'] += 1
+        logger.info(f"Groq HTTP pool started (limit={self.limit}, per_host={self.limit_per_host}, "
+                    f"keepalive={self.keepalive_timeout}s)")
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it lazily if startup didn't run (e.g. serverless)"""
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+
+    async def close(self):
+        """Close the shared session (called from shutdown_event)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("Groq HTTP pool closed")
+        self._session = None
+        self._connector = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        connector = self._connector
+        idle = 0
+        acquired = 0
+        if connector is not None and not connector.closed:
+            # aiohttp doesn't expose pool occupancy publicly
+            idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+            acquired = len(getattr(connector, '_acquired', ()))
+
+        with self._lock:
+            total_connections = self._stats['connections_created'] + self._stats['connections_reused']
+            reuse_ratio = self._stats['connections_reused'] / max(1, total_connections)
+            return {
+                'active': self._session is not None and not self._session.closed,
+                'open_connections': idle + acquired,
+                'idle_connections': idle,
+                'acquired_connections': acquired,
+                'reuse_ratio': round(reuse_ratio, 3),
+                'limit': self.limit,
+                'limit_per_host': self.limit_per_host,
+                'keepalive_timeout': self.keepalive_timeout,
+                **self._stats
+            }
+
+# Adaptive concurrency limit (AIMD driven by latency and overload signals)
+class AdaptiveConcurrencyLimiter:
+    def __init__(
+        self,
+        initial_limit: int = 20,
+        min_limit: int = 2,
+        max_limit: int = 50,
+        backoff_ratio: float = 0.9,
+        latency_tolerance: float = 3.0,
+        smoothing: float = 0.2,
+        overhead_tokens: int = 64
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        # Fixed per-call cost (time to first token) expressed in completion tokens
+        self.overhead_tokens = overhead_tokens
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._waiters = deque()
+        self._round_trip_ewma: Optional[float] = None
+        self._latency_ewma: Optional[float] = None
+        self._baseline_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._lock = Lock()
+        self._stats = {
+            'acquired': 0,
+            'queued': 0,
+            'increases': 0,
+            'decreases': 0,
+            'overload_signals': 0
+        }
+    
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+    
+    async def acquire(self):
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            self._stats['acquired'] += 1
+            return
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._stats['queued'] += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was handed over just as we were cancelled - give it back
+                self.release()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            raise
+        self._stats['acquired'] += 1
+    
+    def release(self):
+        self._in_flight = max(0, self._in_flight - 1)
+        self._wake_waiters()
+    
+    def _wake_waiters(self):
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+    
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+    
+    def record_sample(self, latency: float, overloaded: bool = False, completion_tokens: int = 0):
+        """Feed one upstream call outcome into the limit (additive increase, multiplicative decrease).
+        Latency is compared per generated token, so long completions don't read as congestion."""
+        with self._lock:
+            if self._round_trip_ewma is None:
+                self._round_trip_ewma = latency
+            else:
+                self._round_trip_ewma += self.smoothing * (latency - self._round_trip_ewma)
+            
+            if not overloaded:
+                sample = latency / (max(0, completion_tokens) + self.overhead_tokens)
+                if self._latency_ewma is None:
+                    self._latency_ewma = sample
+                else:
+                    self._latency_ewma += self.smoothing * (sample - self._latency_ewma)
+                # Baseline drifts up slowly so it can recover after Groq gets permanently slower
+                if self._baseline_latency is None:
+                    self._baseline_latency = sample
+                else:
+                    self._baseline_latency = min(sample, self._baseline_latency * 1.01)
+                
+                # Latency gradient: queueing upstream shows up as EWMA far above the baseline
+                overloaded = self._latency_ewma > self._baseline_latency * self.latency_tolerance
+            else:
+                self._stats['overload_signals'] += 1
+            
+            now = time.monotonic()
+            if overloaded:
+                # Decrease at most once per round trip so a burst of failures doesn't collapse the limit
+                if now - self._last_decrease >= (self._round_trip_ewma or 1.0):
+                    new_limit = max(self.min_limit, self._limit * self.backoff_ratio)
+                    if new_limit < self._limit:
+                        self._stats['decreases'] += 1
+                    self._limit = new_limit
+                    self._last_decrease = now
+            elif self._in_flight >= self._limit / 2:
+                # Only grow while the current limit is actually being used
+                new_limit = min(self.max_limit, self._limit + 1 / self._limit)
+                if int(new_limit) > int(self._limit):
+                    self._stats['increases'] += 1
+                self._limit = new_limit
+        
+        self._wake_waiters()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'in_flight': self._in_flight,
+                'queue_depth': len(self._waiters),
+                'available': max(0, self.limit - self._in_flight),
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'round_trip_ewma_ms': round(self._round_trip_ewma * 1000, 1) if self._round_trip_ewma is not None else None,
+                'latency_ewma_ms_per_token': round(self._latency_ewma * 1000, 3) if self._latency_ewma is not None else None,
+                'baseline_latency_ms_per_token': round(self._baseline_latency * 1000, 3) if self._baseline_latency is not None else None,
+                **self._stats
+            }
+
+# Retry scheduling: full-jitter backoff, server reset hints and a global retry budget
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse Groq reset values like '2m59.56s', '7.66s' or '120ms' into seconds"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    multipliers = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    return sum(float(amount) * multipliers[unit] for amount, unit in parts)
+
+def retry_hint_from_headers(headers) -> Optional[float]:
+    """Seconds the server asked us to wait, from Retry-After or exhausted x-ratelimit-reset-* budgets"""
+    if not headers:
+        return None
+    
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        seconds = parse_reset_duration(retry_after)
+        if seconds is not None:
+            return seconds
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    
+    hints = []
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if reset is not None:
+                hints.append(reset)
+    return max(hints) if hints else None
+
+class RetryScheduler:
+    def __init__(
+        self,
+        base_delay: float = 0.5,
+        max_delay: float = 10.0,
+        max_server_wait: float = 30.0,
+        budget_ratio: float = 0.2,
+        min_retries_per_second: float = 1.0,
+        budget_window: int = 10
+    ):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_server_wait = max_server_wait
+        self.budget_ratio = budget_ratio
+        self.min_retries_per_second = min_retries_per_second
+        self.budget_window = budget_window
+        # One [second, first_attempts, retries] bucket per second over the budget window
+        self._buckets = deque()
+        self._lock = Lock()
+        self._stats = {
+            'first_attempts': 0,
+            'retries': 0,
+            'retries_denied_budget': 0,
+            'retries_denied_server_wait': 0,
+            'server_hinted_delays': 0,
+            'total_backoff_seconds': 0.0
+        }
+    
+    def _current_bucket(self) -> list:
+        now = int(time.monotonic())
+        while self._buckets and self._buckets[0][0] <= now - self.budget_window:
+            self._buckets.popleft()
+        if not self._buckets or self._buckets[-1][0] != now:
+            self._buckets.append([now, 0, 0])
+        return self._buckets[-1]
+    
+    def record_first_attempt(self):
+        with self._lock:
+            self._current_bucket()[1] += 1
+            self._stats['first_attempts'] += 1
+    
+    def schedule_retry(self, attempt: int, headers=None) -> Optional[float]:
+        """
+        Backoff before the next attempt, or None if the retry is refused.
+        Only retries the budget admits are counted towards the retry and backoff stats.
+        """
+        hint = retry_hint_from_headers(headers)
+        if hint is not None and hint > self.max_server_wait:
+            with self._lock:
+                self._stats['retries_denied_server_wait'] += 1
+            return None
+        
+        if hint is not None:
+            # Honour the hint, spreading clients out by up to one base delay
+            delay = hint + random.uniform(0, self.base_delay)
+        else:
+            # Full jitter: uniform between zero and the capped exponential backoff
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        
+        # Allow a retry only while retries stay under budget_ratio of first attempts
+        with self._lock:
+            bucket = self._current_bucket()
+            first_attempts = sum(b[1] for b in self._buckets)
+            retries = sum(b[2] for b in self._buckets)
+            allowance = first_attempts * self.budget_ratio + self.min_retries_per_second * self.budget_window
+            if retries + 1 > allowance:
+                self._stats['retries_denied_budget'] += 1
+                return None
+            bucket[2] += 1
+            self._stats['retries'] += 1
+            self._stats['total_backoff_seconds'] += delay
+            if hint is not None:
+                self._stats['server_hinted_delays'] += 1
+        return delay
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._current_bucket()
+            first_attempts = sum(b[1] for b in self._buckets)
+            retries = sum(b[2] for b in self._buckets)
+            return {
+                **self._stats,
+                'total_backoff_seconds': round(self._stats['total_backoff_seconds'], 2),
+                'window_first_attempts': first_attempts,
+                'window_retries': retries,
+                'window_retry_ratio': round(retries / max(1, first_attempts), 3),
+                'retries_denied': self._stats['retries_denied_budget'] + self._stats['retries_denied_server_wait'],
+                'budget_ratio': self.budget_ratio
+            }
+
+# Client-side view of Groq's per-key request/token budgets (x-ratelimit-* headers)
+class GroqRateLimitGovernor:
+    KINDS = ("requests", "tokens")
+    
+    def __init__(self, max_wait: float = 30.0):
+        self.max_wait = max_wait
+        self._limit = {kind: None for kind in self.KINDS}
+        self._remaining = {kind: None for kind in self.KINDS}
+        self._reset_at = {kind: None for kind in self.KINDS}
+        self._queue_lock: Optional[asyncio.Lock] = None
+        self._waiting = 0
+        self._lock = Lock()
+        self._stats = {
+            'admitted': 0,
+            'delayed': 0,
+            'wait_timeouts': 0,
+            'total_wait_seconds': 0.0,
+            'header_updates': 0
+        }
+    
+    def update_from_headers(self, headers):
+        """Adopt Groq's authoritative remaining budget from a response"""
+        if not headers:
+            return
+        now = time.monotonic()
+        with self._lock:
+            updated = False
+            for kind in self.KINDS:
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                try:
+                    if limit is not None:
+                        self._limit[kind] = int(float(limit))
+                    if remaining is not None:
+                        self._remaining[kind] = int(float(remaining))
+                        updated = True
+                except ValueError:
+                    continue
+                if reset is not None:
+                    self._reset_at[kind] = now + reset
+            if updated:
+                self._stats['header_updates'] += 1
+    
+    def _refresh(self, now: float):
+        """Assume the window refilled once its reset time has passed"""
+        for kind in self.KINDS:
+            reset_at = self._reset_at[kind]
+            if reset_at is not None and now >= reset_at:
+                self._remaining[kind] = self._limit[kind]
+                self._reset_at[kind] = None
+    
+    def _try_reserve(self, cost: Dict[str, int], now: float) -> Optional[float]:
+        """Reserve budget and return None, or return how long to wait for the next reset"""
+        with self._lock:
+            self._refresh(now)
+            wait = 0.0
+            for kind in self.KINDS:
+                remaining = self._remaining[kind]
+                if remaining is None:
+                    continue
+                # A request bigger than the whole window can only ever go when the window is full
+                needed = min(cost[kind], self._limit[kind] or cost[kind])
+                if remaining < needed:
+                    reset_at = self._reset_at[kind]
+                    wait = max(wait, (reset_at - now) if reset_at is not None else 1.0)
+            if wait > 0:
+                return wait
+            
+            for kind in self.KINDS:
+                if self._remaining[kind] is not None:
+                    self._remaining[kind] -= cost[kind]
+            self._stats['admitted'] += 1
+            return None
+    
+    def estimate_wait(self, estimated_tokens: int) -> float:
+        """Seconds until a request of this size would fit, without reserving anything"""
+        now = time.monotonic()
+        with self._lock:
+            self._refresh(now)
+            wait = 0.0
+            for kind, cost in (("requests", 1), ("tokens", estimated_tokens)):
+                remaining = self._remaining[kind]
+                if remaining is None:
+                    continue
+                if remaining < min(cost, self._limit[kind] or cost):
+                    reset_at = self._reset_at[kind]
+                    wait = max(wait, (reset_at - now) if reset_at is not None else 1.0)
+            return wait
+    
+    async def acquire(self, estimated_tokens: int) -> float:
+        """Hold the caller locally until the estimated request fits the remaining budget"""
+        if self._queue_lock is None:
+            self._queue_lock = asyncio.Lock()
+        cost = {"requests": 1, "tokens": estimated_tokens}
+        start = time.monotonic()
+        
+        self._waiting += 1
+        try:
+            # FIFO: only the head of the queue polls the budget
+            async with self._queue_lock:
+                delayed = False
+                while True:
+                    now = time.monotonic()
+                    wait = self._try_reserve(cost, now)
+                    if wait is None:
+                        break
+                    if now - start + wait > self.max_wait:
+                        # Let Groq decide; the retry scheduler handles a resulting 429
+                        with self._lock:
+                            self._stats['wait_timeouts'] += 1
+                            self._stats['admitted'] += 1
+                        break
+                    delayed = True
+                    await asyncio.sleep(min(wait, 1.0))
+        finally:
+            self._waiting -= 1
+        
+        waited = time.monotonic() - start
+        if delayed:
+            with self._lock:
+                self._stats['delayed'] += 1
+                self._stats['total_wait_seconds'] += waited
+        return waited
+    
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            self._refresh(now)
+            return {
+                'limit': dict(self._limit),
+                'remaining': dict(self._remaining),
+                'reset_in_seconds': {
+                    kind: round(max(0.0, reset_at - now), 2) if reset_at is not None else None
+                    for kind, reset_at in self._reset_at.items()
+                },
+                'waiting': self._waiting,
+                **self._stats,
+                'total_wait_seconds': round(self._stats['total_wait_seconds'], 2)
+            }
+
+# One Groq account/endpoint with its own breaker, rate-limit state and latency EWMA
+class GroqUpstream:
+    def __init__(self, name: str, api_key: str, base_url: str, weight: float = 1.0,
+                 governor_max_wait: float = 30.0, smoothing: float = 0.2):
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.weight = max(weight, 0.01)
+        self.smoothing = smoothing
+        self.circuit_breaker = CircuitBreaker()
+        self.rate_governor = GroqRateLimitGovernor(max_wait=governor_max_wait)
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self._lock = Lock()
+        self._stats = {
+            'requests': 0,
+            'failures': 0
+        }
+    
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/chat/completions"
+    
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "User-Agent": "RespondX-API/2.0"
+        }
+    
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+            self._stats['requests'] += 1
+    
+    def end(self, latency: float, failed: bool = False):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            if failed:
+                self._stats['failures'] += 1
+            elif self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma += self.smoothing * (latency - self.latency_ewma)
+    
+    def load_score(self, estimated_tokens: int) -> Tuple[float, float]:
+        """Lower is better: (seconds until the rate budget fits, weighted expected queueing latency)"""
+        budget_wait = self.rate_governor.estimate_wait(estimated_tokens)
+        with self._lock:
+            latency = self.latency_ewma if self.latency_ewma is not None else 1.0
+            return budget_wait, (self.in_flight + 1) * latency / self.weight
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                'base_url': self.base_url,
+                'weight': self.weight,
+                'in_flight': self.in_flight,
+                'latency_ewma_ms': round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+                **self._stats
+            }
+        return {
+            **stats,
+            **self.circuit_breaker.get_stats(),
+            'rate_budget': self.rate_governor.get_stats()
+        }
+
+# Least-loaded routing across Groq upstreams with failover on open breakers
+class GroqRouter:
+    def __init__(self, upstreams: List[GroqUpstream]):
+        if not upstreams:
+            raise ValueError("At least one Groq upstream is required")
+        self.upstreams = upstreams
+        self._lock = Lock()
+        self._stats = {
+            'routed': 0,
+            'failovers': 0,
+            'no_upstream_available': 0
+        }
+    
+    def choose(self, estimated_tokens: int = 0, exclude: Tuple[GroqUpstream, ...] = ()) -> Optional[GroqUpstream]:
+        """Pick the least-loaded healthy upstream, preferring ones not already tried by this request"""
+        healthy = [u for u in self.upstreams if u.circuit_breaker.is_available()]
+        candidates = [u for u in healthy if u not in exclude] or healthy
+        if not candidates:
+            with self._lock:
+                self._stats['no_upstream_available'] += 1
+            return None
+        
+        upstream = min(candidates, key=lambda u: u.load_score(estimated_tokens))
+        with self._lock:
+            self._stats['routed'] += 1
+            if exclude:
+                self._stats['failovers'] += 1
+        return upstream
+    
+    def has_alternative(self, exclude: Tuple[GroqUpstream, ...]) -> bool:
+        return any(u not in exclude and u.circuit_breaker.is_available() for u in self.upstreams)
+    
+    def breaker_stats(self) -> Dict[str, Any]:
+        return {u.name: u.circuit_breaker.get_stats() for u in self.upstreams}
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            **stats,
+            'upstreams': {u.name: u.get_stats() for u in self.upstreams}
+        }
+
+def build_groq_upstreams(api_keys: List[str], base_urls: List[str], weights: List[float],
+                         governor_max_wait: float) -> List[GroqUpstream]:
+    """Pair keys with base URLs; a single key or URL is shared by every upstream"""
+    count = max(len(api_keys), len(base_urls))
+    if len(api_keys) not in (1, count) or len(base_urls) not in (1, count):
+        raise ValueError("GROQ_API_KEYS and GROQ_BASE_URLS must have the same length (or one entry)")
+    
+    upstreams = []
+    for index in range(count):
+        api_key = api_keys[index] if len(api_keys) > 1 else api_keys[0]
+        base_url = base_urls[index] if len(base_urls) > 1 else base_urls[0]
+        weight = weights[index] if index < len(weights) else 1.0
+        host = base_url.split("://", 1)[-1].split("/", 1)[0]
+        upstreams.append(GroqUpstream(
+            name=f"{host}#{index}",
+            api_key=api_key,
+            base_url=base_url,
+            weight=weight,
+            governor_max_wait=governor_max_wait
+        ))
+    return upstreams
+
+# Single-flight coalescing of identical in-flight async calls
+class SingleFlight:
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._lock = Lock()
+        self._stats = {
+            'calls': 0,
+            'executions': 0,
+            'coalesced': 0,
+            'shared_errors': 0
+        }
+    
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Mark the exception as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+    
+    async def do(self, key: str, fn) -> Any:
+        """Run fn() once per key; concurrent callers with the same key await the same result or error"""
+        task = self._in_flight.get(key)
+        is_follower = task is not None
+        
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['coalesced' if is_follower else 'executions'] += 1
+        
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t, key=key: self._forget(key, t))
+        
+        try:
+            # Shield so one caller disconnecting doesn't cancel the call for everyone else
+            return await asyncio.shield(task)
+        except Exception:
+            if is_follower:
+                with self._lock:
+                    self._stats['shared_errors'] += 1
+            raise
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            coalesce_ratio = self._stats['coalesced'] / max(1, self._stats['calls'])
+            return {
+                **self._stats,
+                'in_flight': len(self._in_flight),
+                'coalesce_ratio': round(coalesce_ratio, 3)
+            }
+
 # Your original working approach - simplified and cleaned up
 current_dir = Path(__file__).parent
 logger.info(f"Current directory: {current_dir}")
@@ -276,7 +2110,7 @@ for key, value in os.environ.items():
         logger.info(f"{key}: {value[:10]}..." if value else f"{key}: None")
 
 # Get the API key (your working method)
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+GROQ_API_KEY = os.getenv("GROQ_API_KEY") or os.getenv("GROQ_API_KEYS", "").split(",")[0].strip() or None
 
 # Your original validation with better error messages
 if not GROQ_API_KEY:
@@ -295,11 +2129,89 @@ else:
 # Create a simple config dictionary (instead of a function)
 config = {
     "GROQ_API_KEY": GROQ_API_KEY,
+    # Point at a local stand-in (see fake_groq.py) for load testing
+    "GROQ_BASE_URL": os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1").rstrip("/"),
+    # Optional pools for multi-account routing (comma separated, paired by position)
+    "GROQ_API_KEYS": [k.strip() for k in os.getenv("GROQ_API_KEYS", GROQ_API_KEY).split(",") if k.strip()],
+    "GROQ_BASE_URLS": [u.strip().rstrip("/") for u in os.getenv("GROQ_BASE_URLS", "").split(",") if u.strip()],
+    "GROQ_UPSTREAM_WEIGHTS": [float(w) for w in os.getenv("GROQ_UPSTREAM_WEIGHTS", "").split(",") if w.strip()],
     "API_SECRET_KEY": os.getenv("API_SECRET_KEY", "default-secret"),
+    # Bearer token for the state-changing /admin/cache routes (export, import, snapshot, warm);
+    # falls back to API_SECRET_KEY (the default secret is never accepted)
+    "ADMIN_API_TOKEN": os.getenv("ADMIN_API_TOKEN", ""),
     "RATE_LIMIT_PER_MINUTE": int(os.getenv("RATE_LIMIT_PER_MINUTE", "100")),
+    # Requests a client may send back to back before being paced; defaults to a full minute's allowance
+    "RATE_LIMIT_BURST": int(os.getenv("RATE_LIMIT_BURST", "0")) or None,
+    # Endpoints with their own limit and bucket ("path=limit[:burst],..."); others share the default.
+    # A rule also covers the path's /stream variant, and both draw from one bucket.
+    "RATE_LIMIT_ENDPOINTS": parse_rate_limit_rules(os.getenv("RATE_LIMIT_ENDPOINTS", "/api/compose=50")),
+    # Clients sending a listed X-API-Key get its limit on every endpoint instead of the per-IP one
+    "RATE_LIMIT_API_KEYS": parse_rate_limit_rules(os.getenv("RATE_LIMIT_API_KEYS", "")),
+    "RATE_LIMIT_MAX_CLIENTS": int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000")),
+    # Texts at least this long are tokenized on a worker thread rather than the event loop
+    "TOKENIZER_OFFLOAD_CHARS": int(os.getenv("TOKENIZER_OFFLOAD_CHARS", "8192")),
+    "TOKENIZER_THREADS": int(os.getenv("TOKENIZER_THREADS", "2")),
+    # Optional cap on /analyze-thread prompt tokens below the context window (e.g. a low Groq TPM tier); 0 = none
+    "THREAD_PROMPT_TOKEN_LIMIT": int(os.getenv("THREAD_PROMPT_TOKEN_LIMIT", "0")),
+    # Threads over the context budget are analyzed as chunks plus a merge pass; a positive value
+    # also chunks threads over this many tokens (N+1 Groq calls instead of one)
+    "THREAD_MAP_REDUCE_TOKENS": int(os.getenv("THREAD_MAP_REDUCE_TOKENS", "0")),
+    # Smallest chunk size; chunks grow so a thread never needs more than THREAD_MAP_MAX_CHUNKS
+    "THREAD_CHUNK_TOKENS": int(os.getenv("THREAD_CHUNK_TOKENS", "6000")),
+    "THREAD_MAP_MAX_CHUNKS": int(os.getenv("THREAD_MAP_MAX_CHUNKS", "8")),
+    # Chunk analyses in flight across all requests
+    "THREAD_MAP_CONCURRENCY": int(os.getenv("THREAD_MAP_CONCURRENCY", "8")),
+    # max_tokens per request class = this percentile of observed completion lengths times the headroom
+    "COMPLETION_SIZING_PERCENTILE": float(os.getenv("COMPLETION_SIZING_PERCENTILE", "0.99")),
+    "COMPLETION_SIZING_HEADROOM": float(os.getenv("COMPLETION_SIZING_HEADROOM", "1.25")),
+    "COMPLETION_SIZING_MIN_SAMPLES": int(os.getenv("COMPLETION_SIZING_MIN_SAMPLES", "20")),
+    # Rendered system prompts kept per option combination
+    "PROMPT_MEMO_MAX_ENTRIES": int(os.getenv("PROMPT_MEMO_MAX_ENTRIES", "1024")),
+    # Leading characters of each Groq prompt fingerprinted to count distinct cacheable prefixes
+    "PROMPT_PREFIX_FINGERPRINT_CHARS": int(os.getenv("PROMPT_PREFIX_FINGERPRINT_CHARS", "1024")),
+    # Per-client budget of Groq prompt + completion tokens per minute; 0 disables
+    "TOKEN_QUOTA_PER_MINUTE": int(os.getenv("TOKEN_QUOTA_PER_MINUTE", "30000")),
+    "TOKEN_QUOTA_BURST": int(os.getenv("TOKEN_QUOTA_BURST", "0")) or None,
+    # Token budgets for configured X-API-Keys ("key=tokens[:burst],...")
+    "TOKEN_QUOTA_API_KEYS": parse_rate_limit_rules(os.getenv("TOKEN_QUOTA_API_KEYS", "")),
     "MAX_CONCURRENT_REQUESTS": int(os.getenv("MAX_CONCURRENT_REQUESTS", "50")),
+    "MIN_CONCURRENT_REQUESTS": int(os.getenv("MIN_CONCURRENT_REQUESTS", "2")),
+    "INITIAL_CONCURRENT_REQUESTS": int(os.getenv("INITIAL_CONCURRENT_REQUESTS", "20")),
+    "RETRY_BASE_DELAY": float(os.getenv("RETRY_BASE_DELAY", "0.5")),
+    "RETRY_MAX_DELAY": float(os.getenv("RETRY_MAX_DELAY", "10")),
+    "RETRY_MAX_SERVER_WAIT": float(os.getenv("RETRY_MAX_SERVER_WAIT", "30")),
+    "RETRY_BUDGET_RATIO": float(os.getenv("RETRY_BUDGET_RATIO", "0.2")),
+    "RETRY_BUDGET_MIN_PER_SECOND": float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "1")),
+    "RATE_GOVERNOR_MAX_WAIT": float(os.getenv("RATE_GOVERNOR_MAX_WAIT", "30")),
     "CACHE_TTL_SECONDS": int(os.getenv("CACHE_TTL_SECONDS", "300")),
     "CACHE_MAX_SIZE": int(os.getenv("CACHE_MAX_SIZE", "5000")),
+    "CACHE_MAX_BYTES": int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    "CACHE_COMPRESS_THRESHOLD": int(os.getenv("CACHE_COMPRESS_THRESHOLD", "1024")),
+    "CACHE_SHARDS": int(os.getenv("CACHE_SHARDS", "8")),
+    # "lru" or "tinylfu" (frequency-aware admission, opt-in)
+    "CACHE_EVICTION_POLICY": os.getenv("CACHE_EVICTION_POLICY", "lru").lower(),
+    # Fraction of keys replayed through the miss-ratio-curve ghost caches; 0 disables
+    "CACHE_MRC_SAMPLE_RATE": float(os.getenv("CACHE_MRC_SAMPLE_RATE", "0.01")),
+    # Max SimHash bit distance for serving near-duplicate inputs from cache; negative disables
+    "CACHE_NEAR_DUP_DISTANCE": int(os.getenv("CACHE_NEAR_DUP_DISTANCE", "-1")),
+    # Only /generate prompts up to this long (canonical characters) may be answered by a near-duplicate
+    "CACHE_NEAR_DUP_MAX_CHARS": int(os.getenv("CACHE_NEAR_DUP_MAX_CHARS", "2000")),
+    "COMPOSE_CACHE_TTL_SECONDS": int(os.getenv("COMPOSE_CACHE_TTL_SECONDS", "1800")),
+    "COMPOSE_CACHE_MAX_SIZE": int(os.getenv("COMPOSE_CACHE_MAX_SIZE", "1000")),
+    "COMPOSE_CACHE_MAX_BYTES": int(os.getenv("COMPOSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    # Persistent L2 cache file; empty disables it (on Vercel only /tmp is writable)
+    "CACHE_L2_PATH": os.getenv("CACHE_L2_PATH", ""),
+    "CACHE_L2_TTL_SECONDS": int(os.getenv("CACHE_L2_TTL_SECONDS", "86400")),
+    "CACHE_L2_MAX_ENTRIES": int(os.getenv("CACHE_L2_MAX_ENTRIES", "50000")),
+    # Response cache snapshot loaded at startup and written at shutdown; empty disables it
+    "CACHE_SNAPSHOT_PATH": os.getenv("CACHE_SNAPSHOT_PATH", ""),
+    # JSONL (or JSON array) of {"endpoint": ..., "payload": ...} requests replayed by /admin/cache/warm
+    "CACHE_WARM_CORPUS_PATH": os.getenv("CACHE_WARM_CORPUS_PATH", ""),
+    "CACHE_WARM_CONCURRENCY": int(os.getenv("CACHE_WARM_CONCURRENCY", "4")),
+    "HTTP_POOL_LIMIT": int(os.getenv("HTTP_POOL_LIMIT", "100")),
+    "HTTP_POOL_LIMIT_PER_HOST": int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20")),
+    "HTTP_KEEPALIVE_TIMEOUT": float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60")),
+    "HTTP_DNS_CACHE_TTL": int(os.getenv("HTTP_DNS_CACHE_TTL", "300")),
     "PORT": int(os.getenv("PORT", "8000")),
     "ENVIRONMENT": os.getenv("ENVIRONMENT", "development")
 }
@@ -336,33 +2248,500 @@ except Exception as e:
     logger.error(f"Configuration loading failed: {e}")
     raise
 
+def build_l2_cache_tier() -> Optional[SQLiteCacheTier]:
+    if not config["CACHE_L2_PATH"]:
+        return None
+    try:
+        return SQLiteCacheTier(
+            config["CACHE_L2_PATH"],
+            default_ttl=config["CACHE_L2_TTL_SECONDS"],
+            max_entries=config["CACHE_L2_MAX_ENTRIES"]
+        )
+    except sqlite3.Error as e:
+        logger.warning(f"L2 cache disabled, could not open {config['CACHE_L2_PATH']}: {e}")
+        return None
+
+# Candidate sizes and TTLs simulated around the configured ones
+MRC_SIZE_FACTORS = (0.1, 0.25, 0.5, 1, 2, 4)
+MRC_TTL_FACTORS = (0.25, 0.5, 1, 2, 4, 12)
+
+def build_mrc_estimator(max_size: int, default_ttl: int) -> Optional[MissRatioCurveEstimator]:
+    if config["CACHE_MRC_SAMPLE_RATE"] <= 0:
+        return None
+    # Small caches need a higher rate for the 1x ghost to hold a meaningful number of keys
+    sample_rate = max(config["CACHE_MRC_SAMPLE_RATE"], min(1.0, 100 / max(1, max_size)))
+    return MissRatioCurveEstimator(
+        sizes=[max_size * factor for factor in MRC_SIZE_FACTORS],
+        ttls=[default_ttl * factor for factor in MRC_TTL_FACTORS],
+        sample_rate=sample_rate
+    )
+
 # Initialize global components
 response_cache = ThreadSafeCache(
     max_size=config["CACHE_MAX_SIZE"], 
-    default_ttl=config["CACHE_TTL_SECONDS"]
+    default_ttl=config["CACHE_TTL_SECONDS"],
+    shards=config["CACHE_SHARDS"],
+    max_bytes=config["CACHE_MAX_BYTES"],
+    compress_threshold=config["CACHE_COMPRESS_THRESHOLD"],
+    eviction_policy=config["CACHE_EVICTION_POLICY"],
+    search_index=CacheSearchIndex(max_pending=config["CACHE_MAX_SIZE"]),
+    mrc=build_mrc_estimator(config["CACHE_MAX_SIZE"], config["CACHE_TTL_SECONDS"]),
+    l2=build_l2_cache_tier(),
+    near_index=NearDuplicateIndex(
+        max_distance=config["CACHE_NEAR_DUP_DISTANCE"],
+        max_entries=config["CACHE_MAX_SIZE"]
+    ) if config["CACHE_NEAR_DUP_DISTANCE"] >= 0 else None
+)
+compose_cache = ThreadSafeCache(
+    max_size=config["COMPOSE_CACHE_MAX_SIZE"],
+    default_ttl=config["COMPOSE_CACHE_TTL_SECONDS"],
+    shards=config["CACHE_SHARDS"],
+    max_bytes=config["COMPOSE_CACHE_MAX_BYTES"],
+    compress_threshold=config["CACHE_COMPRESS_THRESHOLD"]
+)
+rate_limiter = GCRARateLimiter(max_clients=config["RATE_LIMIT_MAX_CLIENTS"])
+token_quota_limiter = GCRARateLimiter(max_clients=config["RATE_LIMIT_MAX_CLIENTS"])
+groq_router = GroqRouter(build_groq_upstreams(
+    api_keys=config["GROQ_API_KEYS"],
+    base_urls=config["GROQ_BASE_URLS"] or [config["GROQ_BASE_URL"]],
+    weights=config["GROQ_UPSTREAM_WEIGHTS"],
+    governor_max_wait=config["RATE_GOVERNOR_MAX_WAIT"]
+))
+groq_concurrency_limiter = AdaptiveConcurrencyLimiter(
+    initial_limit=config["INITIAL_CONCURRENT_REQUESTS"],
+    min_limit=config["MIN_CONCURRENT_REQUESTS"],
+    max_limit=config["MAX_CONCURRENT_REQUESTS"]
+)
+groq_retry_scheduler = RetryScheduler(
+    base_delay=config["RETRY_BASE_DELAY"],
+    max_delay=config["RETRY_MAX_DELAY"],
+    max_server_wait=config["RETRY_MAX_SERVER_WAIT"],
+    budget_ratio=config["RETRY_BUDGET_RATIO"],
+    min_retries_per_second=config["RETRY_BUDGET_MIN_PER_SECOND"]
+)
+llm_singleflight = SingleFlight()
+groq_http_client = GroqHTTPClient(
+    limit=config["HTTP_POOL_LIMIT"],
+    limit_per_host=config["HTTP_POOL_LIMIT_PER_HOST"],
+    keepalive_timeout=config["HTTP_KEEPALIVE_TIMEOUT"],
+    dns_cache_ttl=config["HTTP_DNS_CACHE_TTL"]
 )
-rate_limiter = InMemoryRateLimiter()
-groq_circuit_breaker = CircuitBreaker()
-concurrent_requests = asyncio.Semaphore(config["MAX_CONCURRENT_REQUESTS"])
 
 # Token counting with cache
-token_cache = ThreadSafeCache(max_size=1000, default_ttl=3600)  # 1 hour TTL
+token_cache = ThreadSafeCache(max_size=1000, default_ttl=3600, mrc=build_mrc_estimator(1000, 3600))  # 1 hour TTL
+
+class TokenizerService:
+    """Resolves tiktoken encoders once, caches counts and keeps large encodes off the event loop"""
+    # Models tiktoken doesn't know, by name prefix. Llama 3's vocabulary extends cl100k_base,
+    # so its counts are a close approximation for budgeting.
+    ENCODING_PREFIXES = (
+        ("llama", "cl100k_base"),
+        ("meta-llama", "cl100k_base"),
+        ("mixtral", "cl100k_base"),
+        ("gemma", "cl100k_base"),
+        ("qwen", "cl100k_base"),
+        ("deepseek", "cl100k_base"),
+    )
+    DEFAULT_ENCODING = "cl100k_base"
+    
+    def __init__(self, cache: ThreadSafeCache, offload_chars: int = 8192, threads: int = 2):
+        self.cache = cache
+        self.offload_chars = offload_chars
+        self.threads = max(1, threads)
+        self._encodings: Dict[str, Any] = {}       # encoding name -> tiktoken Encoding
+        self._model_encodings: Dict[str, str] = {}  # model name -> encoding name
+        self._static: Dict[str, int] = {}           # fixed prompt text -> token count
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="tokenizer")
+        self._lock = Lock()
+        self._stats = {
+            'counts': 0,
+            'static_hits': 0,
+            'cache_hits': 0,
+            'encodes': 0,
+            'offloaded': 0,
+            'batches': 0
+        }
+    
+    def encoding_name(self, model: Optional[str] = None) -> str:
+        model = model or MODEL_CONFIG['model']
+        name = self._model_encodings.get(model)
+        if name is not None:
+            return name
+        
+        lowered = model.lower()
+        name = next((enc for prefix, enc in self.ENCODING_PREFIXES if lowered.startswith(prefix)), None)
+        if name is None:
+            try:
+                name = tiktoken.encoding_for_model(model).name
+            except KeyError:
+                name = self.DEFAULT_ENCODING
+        self._model_encodings[model] = name
+        return name
+    
+    def encoder(self, model: Optional[str] = None):
+        name = self.encoding_name(model)
+        enc = self._encodings.get(name)
+        if enc is None:
+            with self._lock:
+                enc = self._encodings.get(name)
+                if enc is None:
+                    enc = tiktoken.get_encoding(name)
+                    self._encodings[name] = enc
+        return enc
+    
+    def preload(self, models: List[str], static_texts: Optional[List[str]] = None):
+        """Load encoders and count fixed prompt text up front (blocking; run at startup)"""
+        for model in models:
+            self.encoder(model)
+        for text in static_texts or []:
+            self._static[text] = self._encode_count(text, models[0] if models else None)
+    
+    def _key(self, text: str, encoding: str) -> str:
+        # str hashes are computed in C and cached on the object; length guards against collisions
+        return f"{encoding}:{hash(text) & 0xFFFFFFFFFFFFFFFF:016x}:{len(text)}"
+    
+    def _encode_count(self, text: str, model: Optional[str]) -> int:
+        self._stats['encodes'] += 1
+        return len(self.encoder(model).encode(text, disallowed_special=()))
+    
+    def _lookup(self, text: str, model: Optional[str]) -> Tuple[Optional[int], str]:
+        self._stats['counts'] += 1
+        count = self._static.get(text)
+        if count is not None:
+            self._stats['static_hits'] += 1
+            return count, ""
+        key = self._key(text, self.encoding_name(model))
+        count = self.cache.get(key)
+        if count is not None:
+            self._stats['cache_hits'] += 1
+        return count, key
+    
+    def count(self, text: str, model: Optional[str] = None) -> int:
+        """Token count, encoding inline on a miss"""
+        count, key = self._lookup(text, model)
+        if count is None:
+            count = self._encode_count(text, model)
+            self.cache.set(key, count)
+        return count
+    
+    async def count_async(self, text: str, model: Optional[str] = None) -> int:
+        """Token count that encodes large texts on the tokenizer pool instead of the event loop"""
+        count, key = self._lookup(text, model)
+        if count is None:
+            if len(text) >= self.offload_chars:
+                self._stats['offloaded'] += 1
+                loop = asyncio.get_running_loop()
+                count = await loop.run_in_executor(self._executor, self._encode_count, text, model)
+            else:
+                count = self._encode_count(text, model)
+            self.cache.set(key, count)
+        return count
+    
+    def count_batch(self, texts: List[str], model: Optional[str] = None) -> List[int]:
+        """Token counts for several texts, encoding all misses in one encode_batch call"""
+        counts: List[Optional[int]] = []
+        misses: Dict[str, List[int]] = {}
+        keys: Dict[str, str] = {}
+        for index, text in enumerate(texts):
+            count, key = self._lookup(text, model)
+            counts.append(count)
+            if count is None:
+                misses.setdefault(text, []).append(index)
+                keys[text] = key
+        
+        if misses:
+            self._stats['batches'] += 1
+            self._stats['encodes'] += len(misses)
+            pending = list(misses)
+            encoded = self.encoder(model).encode_batch(pending, num_threads=self.threads, disallowed_special=())
+            for text, tokens in zip(pending, encoded):
+                self.cache.set(keys[text], len(tokens))
+                for index in misses[text]:
+                    counts[index] = len(tokens)
+        return counts
+    
+    async def count_batch_async(self, texts: List[str], model: Optional[str] = None) -> List[int]:
+        if sum(len(text) for text in texts) < self.offload_chars:
+            return self.count_batch(texts, model)
+        self._stats['offloaded'] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.count_batch, texts, model)
+    
+    def static_count(self, text: str) -> Optional[int]:
+        return self._static.get(text)
+    
+    async def run(self, func, *args):
+        """Run tokenizer-heavy work on the tokenizer pool"""
+        self._stats['offloaded'] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    def close(self):
+        self._executor.shutdown(wait=False)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            'encodings': sorted(self._encodings),
+            'models': dict(self._model_encodings),
+            'static_prompts': len(self._static),
+            'static_tokens': sum(self._static.values())
+        }
+
+tokenizer_service = TokenizerService(
+    token_cache,
+    offload_chars=config["TOKENIZER_OFFLOAD_CHARS"],
+    threads=config["TOKENIZER_THREADS"]
+)
+
+def count_tokens_cached(text: str, model: Optional[str] = None) -> int:
+    return tokenizer_service.count(text, model)
+
+async def estimate_request_tokens(payload: dict) -> int:
+    """Upper bound of what a chat completion counts against Groq's TPM: prompt plus max_tokens"""
+    messages = payload.get("messages", [])
+    counts = await tokenizer_service.count_batch_async(
+        [str(message.get("content", "")) for message in messages], payload.get("model")
+    )
+    prompt_tokens = sum(counts) + 4 * len(messages)  # per-message framing overhead
+    return prompt_tokens + int(payload.get("max_tokens") or MODEL_CONFIG['max_tokens'])
+
+# Rendered prompt plus its token count, shared by every request with the same options
+class RenderedPrompt:
+    __slots__ = ('text', 'tokens', 'messages')
+    
+    def __init__(self, text: str, tokens: int, messages: Optional[List[Dict[str, str]]] = None):
+        self.text = text
+        self.tokens = tokens          # tokens of text, or of all messages when present
+        self.messages = messages      # fixed chat prefix (system prompt and few-shot turns), if any
+
+# Bounded LRU of rendered prompts keyed by the options that shape them
+class PromptMemo:
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[tuple, RenderedPrompt]" = OrderedDict()
+        self._lock = Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0
+        }
+    
+    def get_or_render(self, key: tuple, render) -> RenderedPrompt:
+        """Return the memoized prompt for `key`; `render` returns the text or a list of chat messages"""
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return rendered
+            self._stats['misses'] += 1
+        
+        # Render outside the lock; a concurrent miss on the same key just renders twice
+        output = render()
+        if isinstance(output, str):
+            rendered = RenderedPrompt(output, tokenizer_service.count(output))
+        else:
+            counts = tokenizer_service.count_batch([message["content"] for message in output])
+            rendered = RenderedPrompt(output[0]["content"], sum(counts) + 4 * len(output), output)
+        
+        with self._lock:
+            self._entries[key] = rendered
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return rendered
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hit_rate': round(self._stats['hits'] / total, 3) if total else 0.0
+            }
+
+prompt_memo = PromptMemo(max_entries=config["PROMPT_MEMO_MAX_ENTRIES"])
+prompt_footprint_report: Optional[Dict[str, Any]] = None
+
+# Fingerprints the leading window of each prompt sent to Groq and tallies provider-cached prompt tokens.
+# Groq only reuses a cached prefix when the prompt starts with exactly the same tokens, so few distinct
+# fingerprints per request class means the static-prefix layout is doing its job.
+class PromptCacheMonitor:
+    def __init__(self, prefix_chars: int = 1024, max_fingerprints: int = 1000):
+        self.prefix_chars = max(1, prefix_chars)
+        self.max_fingerprints = max(1, max_fingerprints)
+        self._fingerprints: "OrderedDict[str, List[Any]]" = OrderedDict()  # digest -> [class, requests]
+        self._classes: Dict[str, Dict[str, int]] = defaultdict(lambda: {
+            'requests': 0,
+            'distinct_prefixes': 0,
+            'usage_reports': 0,
+            'prompt_tokens': 0,
+            'cached_tokens': 0
+        })
+        self._lock = Lock()
+        self._stats = {
+            'requests': 0,
+            'repeated_prefixes': 0,
+            'distinct_prefixes': 0,
+            'evicted_fingerprints': 0,
+            'usage_reports': 0,
+            'cached_reports': 0,
+            'prompt_tokens': 0,
+            'cached_tokens': 0
+        }
+
+    def fingerprint(self, messages: List[Dict[str, Any]]) -> str:
+        """Digest of the first `prefix_chars` characters of the serialized conversation"""
+        window = []
+        remaining = self.prefix_chars
+        for message in messages:
+            part = f"{message.get('role')}\x1f{message.get('content', '')}\x1e"
+            window.append(part[:remaining])
+            remaining -= len(part)
+            if remaining <= 0:
+                break
+        return hashlib.blake2b("".join(window).encode("utf-8"), digest_size=8).hexdigest()
+
+    def record_prefix(self, size_class: Optional[str], messages: List[Dict[str, Any]]):
+        digest = self.fingerprint(messages)
+        size_class = size_class or "other"
+        with self._lock:
+            self._stats['requests'] += 1
+            self._classes[size_class]['requests'] += 1
+            entry = self._fingerprints.get(digest)
+            if entry is not None:
+                entry[1] += 1
+                self._fingerprints.move_to_end(digest)
+                self._stats['repeated_prefixes'] += 1
+                return
+            # Counts first sightings; after an eviction a returning prefix is counted again
+            self._fingerprints[digest] = [size_class, 1]
+            self._stats['distinct_prefixes'] += 1
+            self._classes[size_class]['distinct_prefixes'] += 1
+            while len(self._fingerprints) > self.max_fingerprints:
+                self._fingerprints.popitem(last=False)
+                self._stats['evicted_fingerprints'] += 1
+
+    def record_usage(self, size_class: Optional[str], usage: Optional[Dict[str, Any]]):
+        """Add a Groq `usage` block, including `prompt_tokens_details.cached_tokens` when reported"""
+        if not usage:
+            return
+        prompt_tokens = int(usage.get('prompt_tokens') or 0)
+        cached_tokens = int((usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0)
+        with self._lock:
+            for stats in (self._stats, self._classes[size_class or "other"]):
+                stats['usage_reports'] += 1
+                stats['prompt_tokens'] += prompt_tokens
+                stats['cached_tokens'] += cached_tokens
+            if cached_tokens:
+                self._stats['cached_reports'] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            top = sorted(self._fingerprints.items(), key=lambda item: item[1][1], reverse=True)[:10]
+            return {
+                **self._stats,
+                'prefix_chars': self.prefix_chars,
+                'tracked_fingerprints': len(self._fingerprints),
+                'cached_token_ratio': round(self._stats['cached_tokens'] / self._stats['prompt_tokens'], 3)
+                if self._stats['prompt_tokens'] else 0.0,
+                'classes': {
+                    name: {
+                        **stats,
+                        'cached_token_ratio': round(stats['cached_tokens'] / stats['prompt_tokens'], 3)
+                        if stats['prompt_tokens'] else 0.0
+                    }
+                    for name, stats in self._classes.items()
+                },
+                'top_prefixes': [
+                    {'fingerprint': digest, 'class': size_class, 'requests': requests}
+                    for digest, (size_class, requests) in top
+                ]
+            }
 
-def count_tokens_cached(text: str, model: str = "llama3-8b-8192") -> int:
-    cache_key = hashlib.md5(f"{text}:{model}".encode()).hexdigest()
+prompt_cache_monitor = PromptCacheMonitor(prefix_chars=config["PROMPT_PREFIX_FINGERPRINT_CHARS"])
+
+# Learns per-request-class completion lengths so Groq reserves only what a reply will use
+class CompletionSizer:
+    def __init__(self, percentile: float = 0.99, headroom: float = 1.25, min_samples: int = 20,
+                 window: int = 500, floor: int = 64):
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.window = window
+        self.floor = floor
+        self._samples: Dict[str, deque] = {}
+        self._limits: Dict[str, int] = {}
+        self._truncated: Dict[str, int] = defaultdict(int)
+        self._lock = Lock()
     
-    cached_count = token_cache.get(cache_key)
-    if cached_count is not None:
-        return cached_count
+    def max_tokens_for(self, size_class: str, cap: Optional[int] = None) -> int:
+        """Learned max_tokens for a class, or the configured cap until it has enough samples"""
+        cap = cap or MODEL_CONFIG['max_tokens']
+        limit = self._limits.get(size_class)
+        return cap if limit is None else min(limit, cap)
     
-    try:
-        enc = tiktoken.encoding_for_model(model)
-    except KeyError:
-        enc = tiktoken.get_encoding("cl100k_base")
+    def record(self, size_class: str, completion_tokens: int, max_tokens: int, truncated: bool = False):
+        if truncated:
+            # The real length is unknown but at least the limit; overshoot so the limit grows
+            self._truncated[size_class] += 1
+            completion_tokens = max(completion_tokens, int(max_tokens * self.headroom * self.headroom))
+        
+        with self._lock:
+            samples = self._samples.get(size_class)
+            if samples is None:
+                samples = self._samples[size_class] = deque(maxlen=self.window)
+            samples.append(completion_tokens)
+            if len(samples) >= self.min_samples:
+                ordered = sorted(samples)
+                high = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+                self._limits[size_class] = max(self.floor, int(high * self.headroom) + 16)
     
-    count = len(enc.encode(text))
-    token_cache.set(cache_key, count)
-    return count
+    def get_table(self) -> Dict[str, Any]:
+        with self._lock:
+            classes = {name: list(samples) for name, samples in self._samples.items()}
+        table = {}
+        for name, samples in sorted(classes.items()):
+            ordered = sorted(samples)
+            table[name] = {
+                'samples': len(ordered),
+                'p50_completion_tokens': ordered[len(ordered) // 2],
+                'max_completion_tokens': ordered[-1],
+                'truncated': self._truncated[name],
+                'max_tokens': self.max_tokens_for(name),
+                'learned': name in self._limits
+            }
+        return {
+            'cap': MODEL_CONFIG['max_tokens'],
+            'percentile': self.percentile,
+            'headroom': self.headroom,
+            'min_samples': self.min_samples,
+            'classes': table
+        }
+
+completion_sizer = CompletionSizer(
+    percentile=config["COMPLETION_SIZING_PERCENTILE"],
+    headroom=config["COMPLETION_SIZING_HEADROOM"],
+    min_samples=config["COMPLETION_SIZING_MIN_SAMPLES"]
+)
+
+def get_completion_class(endpoint: str, data: Optional[Dict[str, Any]] = None) -> str:
+    """Request class whose completions share a length distribution"""
+    data = data or {}
+    if endpoint.startswith("/api/compose"):
+        length = getattr(data.get('length'), 'value', data.get('length')) or 'medium'
+        response_type = getattr(data.get('responseType'), 'value', data.get('responseType')) or 'general'
+        return f"/api/compose:{length}:{response_type}"
+    if endpoint.startswith("/generate"):
+        return "/generate:custom" if data.get('useCustomPrompt') and data.get('customPrompt') else "/generate:auto"
+    return endpoint
 
 # Default configurations
 USER_INFO = {
@@ -382,7 +2761,8 @@ EMAIL_CONFIG = {
 MODEL_CONFIG = {
     "model": "llama-3.3-70b-versatile",
     "temperature": 0.7,
-    "max_tokens": 500
+    "max_tokens": 500,
+    "context_window": 131072
 }
 
 # Try to import custom config
@@ -411,6 +2791,8 @@ class PromptRequest(BaseModel):
 class ThreadAnalysisRequest(BaseModel):
     thread: Dict[str, Any]
     autoTruncate: bool = True
+    # None: chunked map-reduce analysis for threads over the context budget (or THREAD_MAP_REDUCE_TOKENS)
+    mapReduce: Optional[bool] = None
     
     @validator('thread')
     def validate_thread(cls, v):
@@ -435,16 +2817,83 @@ def sanitize_input(text: str) -> str:
     for pattern in dangerous_patterns:
         sanitized = re.sub(pattern, '', sanitized, flags=re.IGNORECASE | re.DOTALL)
     
-    return sanitized.strip()
+    return sanitized.strip()
+
+# Cosmetic noise stripped before cache keying so trivially different emails still hit
+ZERO_WIDTH_PATTERN = re.compile('[\u00ad\u200b-\u200f\u2060\ufeff]')
+THREAD_SEPARATOR_PATTERN = re.compile(r'(^-{5} Email \d+ from .*-{5}$)', re.MULTILINE)
+QUOTED_HEADER_PATTERN = re.compile(
+    r'^\s*(?:on\b.{0,300}?\bwrote:|-{2,}\s*(?:original|forwarded) message\s*-{2,}|from:\s.+\n\s*sent:\s.+)\s*$',
+    re.IGNORECASE | re.MULTILINE
+)
+MOBILE_SIGNATURE_PATTERN = re.compile(
+    r'^\s*(?:sent from my \w[\w ]*|sent from (?:mail|outlook|yahoo mail) for \w[\w ]*|get outlook for \w[\w ]*)\s*$',
+    re.IGNORECASE | re.MULTILINE
+)
+TRACKING_URL_PATTERN = re.compile(
+    r'https?://\S*(?:[?&]utm_[a-z]+=|/track(?:ing)?/|/pixel|/open\?|list-manage\.com/track|mailtrack)\S*',
+    re.IGNORECASE
+)
+
+def canonicalize_email_text(text: str) -> str:
+    """Normalize unicode and whitespace and drop signatures, quoted history and tracking URLs"""
+    text = ZERO_WIDTH_PATTERN.sub('', unicodedata.normalize('NFKC', text))
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    
+    # content.js joins thread messages with separator lines; clean each message on its own
+    parts = THREAD_SEPARATOR_PATTERN.split(text)
+    cleaned = []
+    for part in parts:
+        if THREAD_SEPARATOR_PATTERN.fullmatch(part):
+            cleaned.append(part)
+            continue
+        quoted = QUOTED_HEADER_PATTERN.search(part)
+        if quoted:
+            part = part[:quoted.start()]
+        part = "\n".join(line for line in part.split("\n") if not line.lstrip().startswith(">"))
+        part = MOBILE_SIGNATURE_PATTERN.sub('', part)
+        part = TRACKING_URL_PATTERN.sub('', part)
+        cleaned.append(part)
+    
+    return " ".join(" ".join(cleaned).split())
 
-def get_cache_key(request_data: dict) -> str:
-    cache_data = {
-        'prompt': request_data.get('prompt', ''),
+def get_cache_namespace(request_data: dict) -> str:
+    """Hash of everything except the email text; near-duplicate matches never cross namespaces"""
+    namespace_data = {
+        'kind': 'thread' if request_data.get('thread') is not None else 'prompt',
         'customPrompt': request_data.get('customPrompt'),
         'useCustomPrompt': request_data.get('useCustomPrompt', False),
-        'receiverEmail': request_data.get('receiverEmail', '')
+        'receiverEmail': request_data.get('receiverEmail', ''),
+        'userPreferences': request_data.get('userPreferences')
     }
-    return hashlib.md5(json.dumps(cache_data, sort_keys=True).encode()).hexdigest()
+    return hashlib.md5(json.dumps(namespace_data, sort_keys=True).encode()).hexdigest()
+
+def get_cache_text(request_data: dict) -> str:
+    """Canonical email text a request is keyed on"""
+    thread = request_data.get('thread')
+    if thread is None:
+        return canonicalize_email_text(request_data.get('prompt', ''))
+    if not isinstance(thread, str):
+        thread = json.dumps(thread, sort_keys=True)
+    return canonicalize_email_text(thread)
+
+def get_cache_identity(request_data: dict) -> Tuple[str, str, str]:
+    """(cache key, namespace, canonical text) for a request"""
+    namespace = get_cache_namespace(request_data)
+    text = get_cache_text(request_data)
+    return hashlib.md5(f"{namespace}:{text}".encode()).hexdigest(), namespace, text
+
+def get_near_duplicate_scope(request_data: dict, namespace: str, text: str) -> Optional[Tuple[str, str]]:
+    """(namespace, text) for near-duplicate lookup, or None when only an exact match is acceptable.
+    Threads never qualify: one new message barely moves the fingerprint but changes the answer."""
+    if request_data.get('thread') is not None or len(text) > config["CACHE_NEAR_DUP_MAX_CHARS"]:
+        return None
+    if THREAD_SEPARATOR_PATTERN.search(request_data.get('prompt') or ''):
+        return None
+    return namespace, text
+
+def get_cache_key(request_data: dict) -> str:
+    return get_cache_identity(request_data)[0]
 
 # Custom exception classes
 class GroqAPIError(Exception):
@@ -462,11 +2911,6 @@ app = FastAPI(
     redoc_url="/redoc" if os.getenv("ENVIRONMENT") == "development" else None
 )
 
-# Custom rate limiter using our in-memory implementation
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
 # CORS configuration
 # CORS configuration for RespondX Chrome Extension
 ALLOWED_ORIGINS = [
@@ -512,42 +2956,181 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "HEAD", "OPTIONS"],
     allow_headers=["*"],
+    # Lets the extension read its remaining request and token budgets
+    expose_headers=["Retry-After", "X-RateLimit-Limit", "X-RateLimit-Remaining",
+                    "X-TokenQuota-Limit", "X-TokenQuota-Remaining", "X-TokenQuota-Estimate"],
     max_age=3600,
 )
 
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
+# Endpoints that spend Groq quota and are therefore rate limited
+RATE_LIMITED_PATHS = {"/generate", "/generate/stream", "/analyze-thread", "/api/compose", "/api/compose/stream"}
+# System prompt and instructions wrapped around the request's own text, charged up front
+TOKEN_QUOTA_PROMPT_OVERHEAD = 400
+
+def get_client_ip(request: Request) -> str:
+    return request.client.host if request.client else "127.0.0.1"
+
+def get_client_identity(request: Request, client_ip: str) -> Tuple[str, Optional[str]]:
+    """Bucket key for a client plus its API key, if it sent a configured one"""
+    api_key = request.headers.get("x-api-key")
+    # Keys are only trusted when configured, so rotating made-up keys cannot dodge the per-IP limits
+    if api_key and (api_key in config["RATE_LIMIT_API_KEYS"] or api_key in config["TOKEN_QUOTA_API_KEYS"]):
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16], api_key
+    return "ip:" + client_ip, None
+
+def resolve_rate_limit(path: str, client: str, api_key: Optional[str]) -> Tuple[str, int, Optional[int]]:
+    """Pick the bucket key, per-minute limit and burst for a request to `path`"""
+    if api_key in config["RATE_LIMIT_API_KEYS"]:
+        limit, burst = config["RATE_LIMIT_API_KEYS"][api_key]
+    else:
+        limit, burst = config["RATE_LIMIT_PER_MINUTE"], config["RATE_LIMIT_BURST"]
+    
+    # Streaming and non-streaming variants of an endpoint share its rule and bucket
+    base_path = path[:-len("/stream")] if path.endswith("/stream") else path
+    rule = config["RATE_LIMIT_ENDPOINTS"].get(base_path) or config["RATE_LIMIT_ENDPOINTS"].get(path)
+    if rule is not None:
+        if api_key not in config["RATE_LIMIT_API_KEYS"]:
+            limit, burst = rule
+        return f"{client}|{base_path}", limit, burst
+    return client, limit, burst
+
+def resolve_token_quota(api_key: Optional[str]) -> Tuple[int, Optional[int]]:
+    """Tokens per minute and burst for a client"""
+    if api_key in config["TOKEN_QUOTA_API_KEYS"]:
+        return config["TOKEN_QUOTA_API_KEYS"][api_key]
+    return config["TOKEN_QUOTA_PER_MINUTE"], config["TOKEN_QUOTA_BURST"]
+
+async def estimate_body_tokens(body: bytes, path: str) -> int:
+    """Up-front token cost of a request: its text fields, prompt scaffolding and the expected completion"""
+    try:
+        data = json.loads(body) if body else {}
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        data = {}
+    
+    texts = []
+    pending = [data]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, str):
+            texts.append(item)
+        elif isinstance(item, dict):
+            pending.extend(item.values())
+        elif isinstance(item, list):
+            pending.extend(item)
+    
+    prompt_tokens = await tokenizer_service.count_async("\n".join(texts)) if texts else 0
+    size_class = get_completion_class(path, data if isinstance(data, dict) else None)
+    return prompt_tokens + TOKEN_QUOTA_PROMPT_OVERHEAD + completion_sizer.max_tokens_for(size_class)
+
+def with_body_replay(request: Request, body: bytes):
+    """
+    Let the endpoint read a body the middleware already consumed (Starlette 0.27 does not cache it).
+    The body is replayed once; later receive() calls go to the server so disconnects still arrive.
+    """
+    original_receive = request._receive
+    replayed = False
+    
+    async def receive():
+        nonlocal replayed
+        if replayed:
+            return await original_receive()
+        replayed = True
+        return {"type": "http.request", "body": body, "more_body": False}
+    request._receive = receive
+
+def settle_token_usage(client: str, quota: int, charged: int, usage: Dict[str, int]):
+    """Replace the up-front estimate with Groq's reported usage"""
+    # Without a usage report for every call the estimate stands
+    if usage['calls'] == usage['reported']:
+        actual = usage['prompt_tokens'] + usage['completion_tokens']
+        token_quota_limiter.adjust(client, quota, actual - charged, 60)
+
+async def settle_token_quota(body_iterator, client: str, quota: int, charged: int, usage: Dict[str, int]):
+    """Pass the response through, then settle the token quota"""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        settle_token_usage(client, quota, charged, usage)
+
+admin_bearer = HTTPBearer(auto_error=False)
+
+async def require_admin(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = Depends(admin_bearer)):
+    """Guarded admin routes need ADMIN_API_TOKEN (or API_SECRET_KEY) as a bearer token or X-Admin-Token header"""
+    expected = config["ADMIN_API_TOKEN"] or config["API_SECRET_KEY"]
+    if not expected or expected == "default-secret":
+        raise HTTPException(status_code=403, detail="Admin API disabled: set ADMIN_API_TOKEN or API_SECRET_KEY")
+    supplied = credentials.credentials if credentials else request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(supplied.encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
 # Security and logging middleware
 @app.middleware("http")
 async def security_and_logging_middleware(request: Request, call_next):
     start_time = time.time()
-    client_ip = get_remote_address(request)
+    client_ip = get_client_ip(request)
     
     # Log request
     logger.info(f"Request: {request.method} {request.url.path} from {client_ip}")
     
-    # Basic rate limiting check
-    if request.url.path in ["/generate", "/analyze-thread"]:
-        allowed, current_requests = rate_limiter.is_allowed(
-            client_ip, 
-            config["RATE_LIMIT_PER_MINUTE"], 
-            60
-        )
+    rate_headers = {}
+    token_usage = None
+    if request.url.path in RATE_LIMITED_PATHS:
+        client, api_key = get_client_identity(request, client_ip)
+        bucket, limit, burst = resolve_rate_limit(request.url.path, client, api_key)
+        allowed, remaining, retry_after = rate_limiter.is_allowed(bucket, limit, burst, 60)
+        rate_headers = {"X-RateLimit-Limit": str(limit), "X-RateLimit-Remaining": str(remaining)}
         
         if not allowed:
-            logger.warning(f"Rate limit exceeded for {client_ip}: {current_requests} requests")
+            retry_seconds = max(1, math.ceil(retry_after))
+            logger.warning(f"Rate limit exceeded for {bucket}: {limit} requests per minute")
             return JSONResponse(
                 status_code=429,
                 content={
-                    "detail": f"Rate limit exceeded: {current_requests} requests in the last minute",
-                    "retry_after": 60
+                    "detail": f"Rate limit exceeded: {limit} requests per minute",
+                    "retry_after": retry_seconds
                 },
-                headers={"Retry-After": "60"}
+                headers={**rate_headers, "Retry-After": str(retry_seconds)}
             )
+        
+        quota, quota_burst = resolve_token_quota(api_key)
+        if quota > 0:
+            body = await request.body()
+            with_body_replay(request, body)
+            estimate = await estimate_body_tokens(body, request.url.path)
+            allowed, remaining, retry_after = token_quota_limiter.is_allowed(client, quota, quota_burst, 60, estimate)
+            rate_headers.update({
+                "X-TokenQuota-Limit": str(quota),
+                "X-TokenQuota-Remaining": str(remaining),
+                "X-TokenQuota-Estimate": str(estimate)
+            })
+            
+            if not allowed:
+                retry_seconds = max(1, math.ceil(retry_after))
+                logger.warning(f"Token quota exceeded for {client}: ~{estimate} tokens requested, {quota} per minute")
+                return JSONResponse(
+                    status_code=429,
+                    content={
+                        "detail": f"Token quota exceeded: {quota} tokens per minute",
+                        "retry_after": retry_seconds
+                    },
+                    headers={**rate_headers, "Retry-After": str(retry_seconds)}
+                )
+            
+            token_usage = {'calls': 0, 'reported': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+            groq_usage_accumulator.set(token_usage)
     
     # Process request
     response = await call_next(request)
     
+    response.headers.update(rate_headers)
+    if token_usage is not None:
+        response.body_iterator = settle_token_quota(
+            response.body_iterator, client, quota, min(estimate, quota_burst or quota), token_usage
+        )
+    
     # Add security headers
     response.headers["X-Content-Type-Options"] = "nosniff"
     response.headers["X-Frame-Options"] = "DENY"
@@ -565,13 +3148,18 @@ async def cleanup_caches():
     """Periodic cleanup of caches and rate limiter"""
     while True:
         try:
+            # Reap expired cache entries
+            expired = response_cache.purge_expired() + compose_cache.purge_expired() + token_cache.purge_expired()
+            if expired:
+                logger.info(f"Purged {expired} expired cache entries")
+            
             # Trigger garbage collection
             gc.collect()
             
             # Log cache stats
             cache_stats = response_cache.stats()
             rate_stats = rate_limiter.get_stats()
-            circuit_stats = groq_circuit_breaker.get_stats()
+            circuit_stats = groq_router.breaker_stats()
             
             logger.info(f"Cache stats: {cache_stats}")
             logger.info(f"Rate limiter stats: {rate_stats}")
@@ -583,78 +3171,230 @@ async def cleanup_caches():
             logger.error(f"Cache cleanup error: {e}")
             await asyncio.sleep(60)  # Retry in 1 minute
 
+# Groq usage of the current request, summed across its calls to reconcile token quotas
+groq_usage_accumulator: ContextVar[Optional[Dict[str, int]]] = ContextVar("groq_usage_accumulator", default=None)
+
+def record_groq_usage(usage: Optional[Dict[str, Any]], completed: bool = True):
+    """Add one Groq call (and its `usage` block, if any) to the current request's tally"""
+    tally = groq_usage_accumulator.get()
+    if tally is None:
+        return
+    if completed:
+        tally['calls'] += 1
+    if usage:
+        tally['reported'] += 1
+        tally['prompt_tokens'] += int(usage.get('prompt_tokens') or 0)
+        tally['completion_tokens'] += int(usage.get('completion_tokens') or 0)
+
 # Optimized Groq API request handler
-async def make_groq_request(payload: dict, max_retries: int = 3) -> dict:
-    if not groq_circuit_breaker.can_execute():
+async def make_groq_request(payload: dict, max_retries: int = 3, size_class: Optional[str] = None) -> dict:
+    session = await groq_http_client.get_session()
+    groq_retry_scheduler.record_first_attempt()
+    estimated_tokens = await estimate_request_tokens(payload)
+    prompt_cache_monitor.record_prefix(size_class, payload.get("messages", []))
+    tried_upstreams: Tuple[GroqUpstream, ...] = ()
+    
+    for attempt in range(max_retries):
+        is_last_attempt = attempt == max_retries - 1
+        
+        # Fail over away from upstreams this request already hit
+        upstream = groq_router.choose(estimated_tokens, exclude=tried_upstreams)
+        if upstream is None or not upstream.circuit_breaker.can_execute():
+            raise HTTPException(
+                status_code=503, 
+                detail="Service temporarily unavailable due to high error rate"
+            )
+        tried_upstreams += (upstream,)
+        
+        # Queue locally rather than spend a round trip on a predictable 429
+        await upstream.rate_governor.acquire(estimated_tokens)
+        
+        # Hold a concurrency slot only for the HTTP exchange, never while backing off
+        async with groq_concurrency_limiter:
+            attempt_start = time.monotonic()
+            response_received = False
+            upstream.begin()
+            try:
+                async with session.post(
+                    upstream.url,
+                    json=payload,
+                    headers=upstream.headers(),
+                    timeout=aiohttp.ClientTimeout(total=30 + (attempt * 10))
+                ) as response:
+                    response_text = await response.text()
+                    latency = time.monotonic() - attempt_start
+                    overloaded = response.status == 429 or response.status >= 500
+                    response_received = True
+                    upstream.end(latency, failed=overloaded)
+                    upstream.rate_governor.update_from_headers(response.headers)
+                    completion_tokens = 0
+                    if response.status == 200:
+                        result = json.loads(response_text)
+                        completion_tokens = int((result.get("usage") or {}).get("completion_tokens") or 0)
+                    groq_concurrency_limiter.record_sample(latency, overloaded=overloaded,
+                                                           completion_tokens=completion_tokens)
+                    
+                    if response.status == 200:
+                        upstream.circuit_breaker.record_success()
+                        usage = result.get("usage")
+                        record_groq_usage(usage)
+                        prompt_cache_monitor.record_usage(size_class, usage)
+                        if size_class and usage:
+                            finish_reason = (result.get("choices") or [{}])[0].get("finish_reason")
+                            completion_sizer.record(size_class, int(usage.get("completion_tokens") or 0),
+                                                    payload["max_tokens"], truncated=finish_reason == "length")
+                        return result
+                    
+                    # Parse error
+                    try:
+                        error_data = json.loads(response_text)
+                        error_message = error_data.get("error", {}).get("message", "Unknown error")
+                    except json.JSONDecodeError:
+                        error_message = response_text[:200]
+                    
+                    # Other 4xx responses won't succeed on a retry
+                    if not overloaded:
+                        raise GroqAPIError(response.status, error_message)
+                    
+                    if response.status >= 500:
+                        upstream.circuit_breaker.record_failure()
+                    
+                    wait_time = None if is_last_attempt else groq_retry_scheduler.schedule_retry(attempt, response.headers)
+                    if wait_time is None:
+                        raise GroqAPIError(response.status, error_message)
+                    
+                    logger.warning(f"Groq upstream {upstream.name} returned {response.status}, retrying")
+                        
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Network error on attempt {attempt + 1} ({upstream.name}): {e}")
+                upstream.circuit_breaker.record_failure()
+                groq_concurrency_limiter.record_sample(time.monotonic() - attempt_start, overloaded=True)
+                wait_time = None if is_last_attempt else groq_retry_scheduler.schedule_retry(attempt)
+                if wait_time is None:
+                    raise HTTPException(status_code=503, detail=f"Service unavailable: {str(e)}")
+            finally:
+                # Balance begin() on every exit, including cancellation before headers arrive
+                if not response_received:
+                    upstream.end(time.monotonic() - attempt_start, failed=True)
+        
+        # Another healthy upstream can take the retry right away
+        if not groq_router.has_alternative(tried_upstreams):
+            await asyncio.sleep(wait_time)
+    
+    raise HTTPException(status_code=503, detail="Service unavailable after all retries")
+
+# Streaming Groq API request handler (Server-Sent Events from Groq)
+async def stream_groq_request(payload: dict, size_class: Optional[str] = None):
+    """
+    Yield content deltas from a streaming Groq completion.
+    Streams are not retried - once tokens have been relayed the request can't be replayed transparently.
+    """
+    # Streams still earn retry budget for the non-streaming traffic they share an upstream with
+    groq_retry_scheduler.record_first_attempt()
+    estimated_tokens = await estimate_request_tokens(payload)
+    upstream = groq_router.choose(estimated_tokens)
+    if upstream is None or not upstream.circuit_breaker.can_execute():
         raise HTTPException(
             status_code=503, 
             detail="Service temporarily unavailable due to high error rate"
         )
     
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json",
-        "User-Agent": "RespondX-API/2.0"  # Move User-Agent here
-    }
+    stream_payload = {**payload, "stream": True}
+    prompt_cache_monitor.record_prefix(size_class, payload.get("messages", []))
+    await upstream.rate_governor.acquire(estimated_tokens)
     
-    async with concurrent_requests:
-        connector = aiohttp.TCPConnector(
-            limit=100,
-            limit_per_host=20,
-            ttl_dns_cache=300,
-            use_dns_cache=True,
-        )
-        
-        timeout = aiohttp.ClientTimeout(total=30)
-        
-        # Remove session-level headers
-        async with aiohttp.ClientSession(
-            connector=connector,
-            timeout=timeout
-        ) as session:
+    async with groq_concurrency_limiter:
+        session = await groq_http_client.get_session()
+        request_start = time.monotonic()
+        response_received = False
+        upstream.begin()
+        try:
+            async with session.post(
+                upstream.url,
+                json=stream_payload,
+                headers=upstream.headers(),
+                # No total timeout for long generations, but fail if Groq goes quiet
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+            ) as response:
+                # Time to response headers is the latency signal for streams
+                latency = time.monotonic() - request_start
+                overloaded = response.status == 429 or response.status >= 500
+                response_received = True
+                upstream.end(latency, failed=overloaded)
+                upstream.rate_governor.update_from_headers(response.headers)
+                groq_concurrency_limiter.record_sample(latency, overloaded=overloaded)
+                
+                if response.status != 200:
+                    response_text = await response.text()
+                    try:
+                        error_data = json.loads(response_text)
+                        error_message = error_data.get("error", {}).get("message", "Unknown error")
+                    except json.JSONDecodeError:
+                        error_message = response_text[:200]
+                    if response.status >= 500:
+                        upstream.circuit_breaker.record_failure()
+                    raise GroqAPIError(response.status, error_message)
+                
+                record_groq_usage(None)
+                finish_reason = None
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    
+                    try:
+                        chunk = json.loads(data)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Skipping malformed stream chunk from {upstream.name}: {data[:200]}")
+                        continue
+                    choices = chunk.get("choices") or []
+                    if choices:
+                        finish_reason = choices[0].get("finish_reason") or finish_reason
+                    # Groq reports usage on the final chunk under x_groq
+                    usage = chunk.get("usage") or (chunk.get("x_groq") or {}).get("usage")
+                    if usage:
+                        record_groq_usage(usage, completed=False)
+                        prompt_cache_monitor.record_usage(size_class, usage)
+                        if size_class:
+                            completion_sizer.record(size_class, int(usage.get("completion_tokens") or 0),
+                                                    payload["max_tokens"], truncated=finish_reason == "length")
+                    if not choices:
+                        continue
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        yield delta
             
-            for attempt in range(max_retries):
-                try:
-                    async with session.post(
-                        "https://api.groq.com/openai/v1/chat/completions",
-                        json=payload,
-                        headers=headers,  # All headers together
-                        timeout=aiohttp.ClientTimeout(total=30 + (attempt * 10))
-                    ) as response:
-                        response_text = await response.text()
-                        
-                        if response.status == 200:
-                            groq_circuit_breaker.record_success()
-                            return json.loads(response_text)
-                        
-                        if response.status == 429:  # Rate limited
-                            wait_time = min(2 ** attempt + (attempt * 0.1), 30)
-                            logger.warning(f"Rate limited by Groq, waiting {wait_time}s")
-                            await asyncio.sleep(wait_time)
-                            continue
-                        
-                        # Parse error
-                        try:
-                            error_data = json.loads(response_text)
-                            error_message = error_data.get("error", {}).get("message", "Unknown error")
-                        except json.JSONDecodeError:
-                            error_message = response_text[:200]
-                        
-                        if attempt == max_retries - 1:
-                            groq_circuit_breaker.record_failure()
-                            raise GroqAPIError(response.status, error_message)
-                        
-                        if response.status >= 500:
-                            await asyncio.sleep(min(2 ** attempt, 10))
-                            
-                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                    logger.error(f"Network error on attempt {attempt + 1}: {e}")
-                    if attempt == max_retries - 1:
-                        groq_circuit_breaker.record_failure()
-                        raise HTTPException(status_code=503, detail=f"Service unavailable: {str(e)}")
-                    await asyncio.sleep(min(2 ** attempt, 10))
-    
-    raise HTTPException(status_code=503, detail="Service unavailable after all retries")
+            upstream.circuit_breaker.record_success()
+            
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Network error while streaming ({upstream.name}): {e}")
+            if not response_received:
+                groq_concurrency_limiter.record_sample(time.monotonic() - request_start, overloaded=True)
+            upstream.circuit_breaker.record_failure()
+            raise HTTPException(status_code=503, detail=f"Service unavailable: {str(e)}")
+        finally:
+            # Balance begin() on every exit, including cancellation before headers arrive
+            if not response_received:
+                upstream.end(time.monotonic() - request_start, failed=True)
+
+def format_sse(event: str, data: dict) -> str:
+    """Serialize one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(event_stream) -> StreamingResponse:
+    return StreamingResponse(
+        event_stream,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            # Marks the body as already encoded so GZipMiddleware doesn't buffer the stream
+            "Content-Encoding": "identity"
+        }
+    )
 
 # Add these imports to your existing main.py file (after your existing imports)
 from enum import Enum
@@ -762,6 +3502,7 @@ class ComposeRequest(BaseModel):
     includeThreadSummary: bool = Field(default=False, description="Include thread summary")
     referencePastMessages: bool = Field(default=False, description="Reference past messages")
     autoInsert: bool = Field(default=False, description="Auto-insert into Gmail")
+    bypassCache: bool = Field(default=False, description="Skip cached results (regenerate)")
     
     # 🔥 NEW: User preferences from frontend
     userPreferences: Optional[UserPreferences] = Field(None, description="User signature preferences")
@@ -782,45 +3523,29 @@ class ComposeResponse(BaseModel):
     cached: bool = Field(..., description="Whether response was cached")
     metadata: Optional[Dict[str, Any]] = Field(None, description="Additional metadata")
 
-# Add this language mapping at the top of your build_compose_prompt function
+# Compose prompt fragments, compiled once at import
+COMPOSE_LANGUAGE_INSTRUCTIONS = {
+    "english": "Write the email in English. If user input contains Hinglish (Hindi-English mix), understand the meaning and write the email in proper English. If user explicitly requests a different language in their natural input (e.g., 'hindi bhasha mein' means write in PROPER HINDI SCRIPT देवनागरी, 'marathi mein likho' means write in PROPER MARATHI SCRIPT), follow that specific request instead",
+    "spanish": "Write the email in Spanish (Español). If user input contains Hinglish, understand the meaning and translate to Spanish. If user explicitly requests a different language in their natural input, follow that specific request instead", 
+    "french": "Write the email in French (Français). If user input contains Hinglish, understand the meaning and translate to French. If user explicitly requests a different language in their natural input, follow that specific request instead", 
+    "german": "Write the email in German (Deutsch). If user input contains Hinglish, understand the meaning and translate to German. If user explicitly requests a different language in their natural input, follow that specific request instead",
+    "italian": "Write the email in Italian (Italiano). If user input contains Hinglish, understand the meaning and translate to Italian. If user explicitly requests a different language in their natural input, follow that specific request instead",
+    "portuguese": "Write the email in Portuguese (Português). If user input contains Hinglish, understand the meaning and translate to Portuguese. If user explicitly requests a different language in their natural input, follow that specific request instead",
+    "chinese": "Write the email in Chinese (中文). If user input contains Hinglish, understand the meaning and translate to Chinese. If user explicitly requests a different language in their natural input, follow that specific request instead",
+    "japanese": "Write the email in Japanese (日本語). If user input contains Hinglish, understand the meaning and translate to Japanese. If user explicitly requests a different language in their natural input, follow that specific request instead",
+    "hindi": "Write the email in PROPER HINDI using देवनागरी script (हिंदी भाषा में). If user input contains Hinglish, understand the meaning and write in PURE HINDI SCRIPT, NOT Hinglish. If user explicitly requests a different language in their natural input, follow that specific request instead"
+}
 
-def build_compose_prompt(compose_request: ComposeRequest, user_info: dict) -> str:
-    """
-    Build a comprehensive system prompt for email composition with proper formatting
-    Now includes dynamic signature handling based on user preferences AND proper structure formatting
-    """
-    
-    # 🔥 NEW: Enhanced language-specific instructions with proper script handling
-    language_instructions = {
-        "english": "Write the email in English. If user input contains Hinglish (Hindi-English mix), understand the meaning and write the email in proper English. If user explicitly requests a different language in their natural input (e.g., 'hindi bhasha mein' means write in PROPER HINDI SCRIPT देवनागरी, 'marathi mein likho' means write in PROPER MARATHI SCRIPT), follow that specific request instead",
-        "spanish": "Write the email in Spanish (Español). If user input contains Hinglish, understand the meaning and translate to Spanish. If user explicitly requests a different language in their natural input, follow that specific request instead", 
-        "french": "Write the email in French (Français). If user input contains Hinglish, understand the meaning and translate to French. If user explicitly requests a different language in their natural input, follow that specific request instead", 
-        "german": "Write the email in German (Deutsch). If user input contains Hinglish, understand the meaning and translate to German. If user explicitly requests a different language in their natural input, follow that specific request instead",
-        "italian": "Write the email in Italian (Italiano). If user input contains Hinglish, understand the meaning and translate to Italian. If user explicitly requests a different language in their natural input, follow that specific request instead",
-        "portuguese": "Write the email in Portuguese (Português). If user input contains Hinglish, understand the meaning and translate to Portuguese. If user explicitly requests a different language in their natural input, follow that specific request instead",
-        "chinese": "Write the email in Chinese (中文). If user input contains Hinglish, understand the meaning and translate to Chinese. If user explicitly requests a different language in their natural input, follow that specific request instead",
-        "japanese": "Write the email in Japanese (日本語). If user input contains Hinglish, understand the meaning and translate to Japanese. If user explicitly requests a different language in their natural input, follow that specific request instead",
-        "hindi": "Write the email in PROPER HINDI using देवनागरी script (हिंदी भाषा में). If user input contains Hinglish, understand the meaning and write in PURE HINDI SCRIPT, NOT Hinglish. If user explicitly requests a different language in their natural input, follow that specific request instead"
-    }
-    
-    # Get language instruction
-    language_instruction = language_instructions.get(compose_request.language, "Write the email in English. If user input contains Hinglish, understand the meaning and write in proper English. If user explicitly requests a different language in their natural input, follow that specific request instead")
-    
-    # Check if we have real user preferences
-    has_user_preferences = (
-        compose_request.userPreferences and 
-        compose_request.userPreferences.hasPreferences
-    )
-    
-    # 🔥 IMPROVED: Add structure-specific formatting instructions
-    structure_instructions = {
-        "standard": """
+COMPOSE_DEFAULT_LANGUAGE_INSTRUCTION = "Write the email in English. If user input contains Hinglish, understand the meaning and write in proper English. If user explicitly requests a different language in their natural input, follow that specific request instead"
+
+COMPOSE_STRUCTURE_INSTRUCTIONS = {
+    "standard": """
 STRUCTURE: STANDARD
 - Use natural paragraph flow
 - Organize content logically without special formatting
 - Keep paragraphs well-separated with line breaks
 """,
-        "bullets": """
+    "bullets": """
 STRUCTURE: BULLET POINTS (MANDATORY)
 - Use bullet points (•) for all lists and key points
 - Format action items as: • [Task description] - Assigned to [Person] - Due: [Date]
@@ -836,7 +3561,7 @@ Action Items:
 • Complete project plan - Assigned to John - Due: Friday
 • Review budget proposal - Assigned to Sarah - Due: Monday
 """,
-        "numbered": """
+    "numbered": """
 STRUCTURE: NUMBERED LISTS (MANDATORY)
 - Use numbered lists (1., 2., 3.) for all organized content
 - Format action items as: 1. [Task description] - Assigned to [Person] - Due: [Date]
@@ -853,7 +3578,7 @@ Action Items:
 2. Review budget proposal - Assigned to Sarah - Due: Monday
 3. Schedule follow-up meeting - Assigned to Michael - Due: Wednesday
 """,
-        "sections": """
+    "sections": """
 STRUCTURE: CLEAR SECTIONS (MANDATORY)
 - Use bold section headers followed by content
 - Organize content under clear headings
@@ -868,13 +3593,54 @@ STRUCTURE: CLEAR SECTIONS (MANDATORY)
 **Next Steps:**
 [Content about upcoming actions]
 """
-    }
-    
-    # Get structure instruction
-    structure_instruction = structure_instructions.get(compose_request.structure, structure_instructions["standard"])
-    
-    # MANDATORY FORMATTING INSTRUCTIONS - Always at the top
-    formatting_instructions = f"""
+}
+
+COMPOSE_LENGTH_GUIDELINES = {
+    "brief": """
+LENGTH: BRIEF (50-100 words total)
+- Use exactly 1-2 body paragraphs
+- Maximum 2 sentences per paragraph
+- Keep it concise but properly formatted with line breaks
+- Structure: Subject → Greeting → Body (1-2 paragraphs) → Closing → Signature
+""",
+    "short": """
+LENGTH: SHORT (75-150 words total)
+- Use exactly 1-2 body paragraphs
+- Maximum 2-3 sentences per paragraph
+- Keep it concise but properly formatted with line breaks
+- Structure: Subject → Greeting → Body (1-2 paragraphs) → Closing → Signature
+""",
+    "medium": """
+LENGTH: MEDIUM (150-250 words total)
+- Use exactly 2-3 body paragraphs
+- 2-3 sentences per paragraph
+- Balanced detail with proper paragraph separation
+- Structure: Subject → Greeting → Body (2-3 paragraphs) → Closing → Signature
+""",
+    "detailed": """
+LENGTH: DETAILED (250+ words total)
+- Use exactly 3-4 body paragraphs
+- 3-4 sentences per paragraph
+- Comprehensive content with clear paragraph structure
+- Structure: Subject → Greeting → Body (3-4 paragraphs) → Closing → Signature
+"""
+}
+
+COMPOSE_TONE_GUIDELINES = {
+    "professional": "Use formal business language, polite and respectful tone",
+    "friendly": "Use warm, approachable language while maintaining professionalism",
+    "casual": "Use relaxed, conversational tone but still appropriate for email",
+    "formal": "Use very formal, traditional business language and structure",
+    "concise": "Use brief, direct language while remaining professional",
+    "enthusiastic": "Use energetic, positive language while maintaining professionalism",
+    "neutral": "Use balanced, objective language without strong emotional tone"
+}
+
+# Instructions and examples shared by every compose request. The system prompt starts with this
+# text verbatim so Groq can serve it from its prompt cache; per-request options follow it.
+COMPOSE_PROMPT_PREFIX = """
+You are a professional email composer. Your task is to write well-formatted emails that follow proper structure and formatting.
+
 MANDATORY FORMATTING REQUIREMENTS:
 - ALWAYS start your response with "Subject: [your subject line]" 
 - Use proper line breaks (\\n) between sections
@@ -882,8 +3648,7 @@ MANDATORY FORMATTING REQUIREMENTS:
 - Always separate greeting, body, closing, and signature with line breaks
 - Each paragraph should be on its own line
 - Add blank lines between major sections
-
-{structure_instruction}
+- Apply the STRUCTURE given in the request options at the end of these instructions
 
 EXACT FORMAT STRUCTURE REQUIRED:
 Subject: [Compelling and specific subject line based on email content]
@@ -931,60 +3696,48 @@ Please review these action items and confirm your availability to complete them
 
 Best regards,
 Your Name
+
+INPUT HANDLING: Understand Hinglish (Hindi-English mix) input and convert appropriately
+
+LANGUAGE SELECTION LOGIC: 
+  1. Check user prompt for explicit language requests (e.g., "hindi bhasha mein", "write in Spanish")
+  2. If found, use that language (overrides dropdown)
+  3. If not found, use the dropdown language given in the request options
+  4. Default fallback: English
+
+CRITICAL REMINDERS:
+1. ALWAYS start with "Subject: [your subject line]" on the first line
+2. NEVER write the email as a single paragraph or single line
+3. ALWAYS use line breaks between paragraphs
+4. ALWAYS separate greeting, body, closing, and signature
+5. Follow the exact format structure shown in examples above
+6. Each paragraph must be on its own line with blank lines between sections
+7. MANDATORY: Apply the structure formatting specified in the request options
+8. LANGUAGE PRIORITY SYSTEM (CRITICAL):
+   - IF user explicitly requests a language in their prompt text → Use THAT language (overrides dropdown)
+     Examples: "hindi bhasha mein", "marathi mein likho", "write in Spanish"
+   - IF no explicit language request in prompt → Use the dropdown language from the request options
+   - IF neither specified → Default to English
+   
+   Detect explicit requests like:
+   - "hindi bhasha mein" → Write in PROPER HINDI (हिंदी में, not Hinglish)
+   - "marathi mein likho" → Write in PROPER MARATHI  
+   - "mail gujarati bhasha mein" → Write in PROPER GUJARATI
+   - "write in [language]" → Write in that language
+   - "[language] mein likho/chahiye/dena" → Write in that PROPER language
+9. INPUT PROCESSING: If user input contains Hinglish (Hindi+English mix), understand the meaning and write the email appropriately
+10. LANGUAGE CLARITY: 
+    - Hindi = Write in देवनागरी script (हिंदी भाषा में)
+    - Marathi = Write in देवनागरी script (मराठी भाषा में)
+    - Gujarati = Write in ગુજરાતી script
+    - Do NOT use Roman script when Indian languages are requested
+11. Follow the signature instruction in the request options
+
+When user requests "hindi bhasha mein" or similar, write in PROPER SCRIPT (देवनागरी for Hindi), NOT Hinglish.
 """
-    
-    # Length-specific guidelines
-    length_guidelines = {
-        "brief": """
-LENGTH: BRIEF (50-100 words total)
-- Use exactly 1-2 body paragraphs
-- Maximum 2 sentences per paragraph
-- Keep it concise but properly formatted with line breaks
-- Structure: Subject → Greeting → Body (1-2 paragraphs) → Closing → Signature
-""",
-        "short": """
-LENGTH: SHORT (75-150 words total)
-- Use exactly 1-2 body paragraphs
-- Maximum 2-3 sentences per paragraph
-- Keep it concise but properly formatted with line breaks
-- Structure: Subject → Greeting → Body (1-2 paragraphs) → Closing → Signature
-""",
-        "medium": """
-LENGTH: MEDIUM (150-250 words total)
-- Use exactly 2-3 body paragraphs
-- 2-3 sentences per paragraph
-- Balanced detail with proper paragraph separation
-- Structure: Subject → Greeting → Body (2-3 paragraphs) → Closing → Signature
-""",
-        "detailed": """
-LENGTH: DETAILED (250+ words total)
-- Use exactly 3-4 body paragraphs
-- 3-4 sentences per paragraph
-- Comprehensive content with clear paragraph structure
-- Structure: Subject → Greeting → Body (3-4 paragraphs) → Closing → Signature
-"""
-    }
-    
-    # Tone guidelines
-    tone_guidelines = {
-        "professional": "Use formal business language, polite and respectful tone",
-        "friendly": "Use warm, approachable language while maintaining professionalism",
-        "casual": "Use relaxed, conversational tone but still appropriate for email",
-        "formal": "Use very formal, traditional business language and structure",
-        "concise": "Use brief, direct language while remaining professional",
-        "enthusiastic": "Use energetic, positive language while maintaining professionalism",
-        "neutral": "Use balanced, objective language without strong emotional tone"
-    }
-    
-    # Get specific guidelines
-    length_instruction = length_guidelines.get(compose_request.length, length_guidelines["medium"])
-    tone_instruction = tone_guidelines.get(compose_request.tone, "professional")
-    
-    # Build sections based on user preferences
-    greeting_instruction = "Include appropriate greeting" if compose_request.includeGreeting else "Skip greeting and start with main content"
-    closing_instruction = "Include appropriate closing" if compose_request.includeClosing else "Skip closing"
-    
-    # 🔥 NEW: Dynamic signature instruction based on preferences
+
+def compose_signature_instruction(compose_request: ComposeRequest, user_info: dict, has_user_preferences: bool) -> str:
+    """Signature line for the compose prompt, from saved preferences or the template user info"""
     if compose_request.includeSignature:
         if has_user_preferences:
             # Use real user data
@@ -1010,28 +3763,40 @@ LENGTH: DETAILED (250+ words total)
     else:
         signature_instruction = "Skip signature"
     
-    emoji_instruction = "Include appropriate emojis throughout the email" if compose_request.useEmojis else "Do not use any emojis"
+    return signature_instruction
+
+def render_compose_prompt(tone, length, language, voice, complexity, structure, include_greeting: bool,
+                          include_closing: bool, signature_instruction: str, use_emojis: bool,
+                          subject_line: Optional[str], opening_sentence: Optional[str],
+                          closing_line: Optional[str], has_user_preferences: bool) -> str:
+    """Render the compose system prompt: the shared static prefix followed by this request's options"""
+    language_instruction = COMPOSE_LANGUAGE_INSTRUCTIONS.get(language, COMPOSE_DEFAULT_LANGUAGE_INSTRUCTION)
+    structure_instruction = COMPOSE_STRUCTURE_INSTRUCTIONS.get(structure, COMPOSE_STRUCTURE_INSTRUCTIONS["standard"])
+    length_instruction = COMPOSE_LENGTH_GUIDELINES.get(length, COMPOSE_LENGTH_GUIDELINES["medium"])
+    tone_instruction = COMPOSE_TONE_GUIDELINES.get(tone, "professional")
     
-    # Build the complete system prompt
-    system_prompt = f"""
-You are a professional email composer. Your task is to write well-formatted emails that follow proper structure and formatting.
-
-{formatting_instructions}
+    # Build sections based on user preferences
+    greeting_instruction = "Include appropriate greeting" if include_greeting else "Skip greeting and start with main content"
+    closing_instruction = "Include appropriate closing" if include_closing else "Skip closing"
+    emoji_instruction = "Include appropriate emojis throughout the email" if use_emojis else "Do not use any emojis"
+    
+    # Everything that varies per request goes after the prefix, so the prefix stays byte-identical
+    request_options = f"""
+REQUEST OPTIONS:
+{structure_instruction}
+STRUCTURE REQUIREMENT (CRITICAL):
+- Structure type: {structure}
+- YOU MUST follow the {structure.upper()} structure guidelines shown above
+- This is MANDATORY - do not ignore structure formatting requirements
 
 EMAIL REQUIREMENTS:
 {length_instruction}
 
 TONE & STYLE:
-- Tone: {compose_request.tone} - {tone_instruction}
-- Language: {compose_request.language} - {language_instruction}
-- Voice: {compose_request.voice} person
-- Complexity: {compose_request.complexity}
-- INPUT HANDLING: Understand Hinglish (Hindi-English mix) input and convert appropriately
-- LANGUAGE SELECTION LOGIC: 
-  1. Check user prompt for explicit language requests (e.g., "hindi bhasha mein", "write in Spanish")
-  2. If found, use that language (overrides dropdown)
-  3. If not found, use dropdown selection: {compose_request.language}
-  4. Default fallback: English
+- Tone: {tone} - {tone_instruction}
+- Language (dropdown selection): {language} - {language_instruction}
+- Voice: {voice} person
+- Complexity: {complexity}
 
 CONTENT REQUIREMENTS:
 - {greeting_instruction}
@@ -1039,59 +3804,92 @@ CONTENT REQUIREMENTS:
 - {signature_instruction}
 - {emoji_instruction}
 
-STRUCTURE REQUIREMENT (CRITICAL):
-- Structure type: {compose_request.structure}
-- YOU MUST follow the {compose_request.structure.upper()} structure guidelines shown above
-- This is MANDATORY - do not ignore structure formatting requirements
-
 CUSTOM ELEMENTS:
-- Subject Line: {compose_request.subjectLine if compose_request.subjectLine else "Generate appropriate subject"}
-- Opening: {compose_request.openingSentence if compose_request.openingSentence else "Use natural opening"}
-- Closing: {compose_request.closingLine if compose_request.closingLine else "Use appropriate closing"}
+- Subject Line: {subject_line if subject_line else "Generate appropriate subject"}
+- Opening: {opening_sentence if opening_sentence else "Use natural opening"}
+- Closing: {closing_line if closing_line else "Use appropriate closing"}
 
 SIGNATURE INFORMATION:
-{'- Using REAL user preferences from saved settings' if has_user_preferences else '- Using template signature information'}
+{'- Using REAL user preferences from saved settings; use the EXACT signature information provided above' if has_user_preferences else '- Using template signature information; use an appropriate signature format'}
 
-CRITICAL REMINDERS:
-1. ALWAYS start with "Subject: [your subject line]" on the first line
-2. NEVER write the email as a single paragraph or single line
-3. ALWAYS use line breaks between paragraphs
-4. ALWAYS separate greeting, body, closing, and signature
-5. Follow the exact format structure shown in examples above
-6. Each paragraph must be on its own line with blank lines between sections
-7. MANDATORY: Apply the {compose_request.structure.upper()} structure formatting as specified
-8. LANGUAGE PRIORITY SYSTEM (CRITICAL):
-   - IF user explicitly requests a language in their prompt text → Use THAT language (overrides dropdown)
-     Examples: "hindi bhasha mein", "marathi mein likho", "write in Spanish"
-   - IF no explicit language request in prompt → Use dropdown selection ({compose_request.language})
-   - IF neither specified → Default to English
-   
-   Detect explicit requests like:
-   - "hindi bhasha mein" → Write in PROPER HINDI (हिंदी में, not Hinglish)
-   - "marathi mein likho" → Write in PROPER MARATHI  
-   - "mail gujarati bhasha mein" → Write in PROPER GUJARATI
-   - "write in [language]" → Write in that language
-   - "[language] mein likho/chahiye/dena" → Write in that PROPER language
-9. INPUT PROCESSING: If user input contains Hinglish (Hindi+English mix), understand the meaning and write the email appropriately
-10. LANGUAGE CLARITY: 
-    - Hindi = Write in देवनागरी script (हिंदी भाषा में)
-    - Marathi = Write in देवनागरी script (मराठी भाषा में)
-    - Gujarati = Write in ગુજરાતી script
-    - Do NOT use Roman script when Indian languages are requested
-{'11. Use the EXACT signature information provided above' if has_user_preferences else '11. Use appropriate signature format'}
+Write a properly formatted email that follows all these requirements, especially the {structure.upper()} structure formatting.
+"""
+    
+    return COMPOSE_PROMPT_PREFIX + request_options
 
-Write a properly formatted email that follows all these requirements, especially the {compose_request.structure.upper()} structure formatting. 
+def get_compose_prompt(compose_request: ComposeRequest, user_info: dict) -> RenderedPrompt:
+    """Memoized compose system prompt with its token count"""
+    # Check if we have real user preferences
+    has_user_preferences = bool(
+        compose_request.userPreferences and 
+        compose_request.userPreferences.hasPreferences
+    )
+    signature_instruction = compose_signature_instruction(compose_request, user_info, has_user_preferences)
+    options = (
+        compose_request.tone, compose_request.length, compose_request.language, compose_request.voice,
+        compose_request.complexity, compose_request.structure, compose_request.includeGreeting,
+        compose_request.includeClosing, signature_instruction, compose_request.useEmojis,
+        compose_request.subjectLine, compose_request.openingSentence, compose_request.closingLine,
+        has_user_preferences
+    )
+    return prompt_memo.get_or_render(("compose",) + options, lambda: render_compose_prompt(*options))
 
-LANGUAGE SELECTION PRIORITY:
-1. FIRST: Check if user explicitly requests a language in their prompt (e.g., "hindi bhasha mein", "write in Spanish")
-2. SECOND: If no explicit request, use dropdown selection ({compose_request.language})
-3. THIRD: If neither specified, default to English
+def build_compose_prompt(compose_request: ComposeRequest, user_info: dict) -> str:
+    """
+    Build a comprehensive system prompt for email composition with proper formatting
+    Now includes dynamic signature handling based on user preferences AND proper structure formatting
+    """
+    return get_compose_prompt(compose_request, user_info).text
 
-When user requests "hindi bhasha mein" or similar, write in PROPER SCRIPT (देवनागरी for Hindi), NOT Hinglish.
-"""
+def build_prompt_footprint() -> Dict[str, Any]:
+    """Token counts of every prompt fragment and of the compose prompt for each option combination"""
+    base = ComposeRequest(prompt="footprint")
+    user_info = select_compose_user_info(base)
+    signature_instruction = compose_signature_instruction(base, user_info, False)
     
-    return system_prompt
-
+    combinations = list(itertools.product(StructureEnum, LengthEnum, ToneEnum, LanguageEnum))
+    prompts = [
+        render_compose_prompt(tone, length, language, base.voice, base.complexity, structure,
+                              base.includeGreeting, base.includeClosing, signature_instruction, base.useEmojis,
+                              None, None, None, False)
+        for structure, length, tone, language in combinations
+    ]
+    counts = tokenizer_service.count_batch(prompts)
+    
+    def fragment_counts(fragments: Dict[str, str]) -> Dict[str, int]:
+        return dict(zip(fragments, tokenizer_service.count_batch(list(fragments.values()))))
+    
+    signature = (USER_INFO['full_name'], USER_INFO['email'], USER_INFO['linkedin'], USER_INFO['mobile'])
+    reply_prefixes = {
+        mode: sum(tokenizer_service.count_batch([message["content"] for message in messages])) + 4 * len(messages)
+        for mode, messages in (("auto", REPLY_PROMPT_PREFIXES[False]), ("custom", REPLY_PROMPT_PREFIXES[True]))
+    }
+    reply_signatures = {
+        mode: tokenizer_service.count(render_reply_signature(custom_mode, EMAIL_CONFIG['default_closing'], *signature)) + 4
+        for mode, custom_mode in (("auto", False), ("custom", True))
+    }
+    return {
+        "compose_prefix_tokens": tokenizer_service.count(COMPOSE_PROMPT_PREFIX),
+        "compose_fragments": {
+            "structure": fragment_counts(COMPOSE_STRUCTURE_INSTRUCTIONS),
+            "length": fragment_counts(COMPOSE_LENGTH_GUIDELINES),
+            "tone": fragment_counts(COMPOSE_TONE_GUIDELINES),
+            "language": fragment_counts(COMPOSE_LANGUAGE_INSTRUCTIONS)
+        },
+        "compose_combinations": [
+            {"structure": structure.value, "length": length.value, "tone": tone.value,
+             "language": language.value, "tokens": count}
+            for (structure, length, tone, language), count in zip(combinations, counts)
+        ],
+        "compose_tokens": {
+            "min": min(counts),
+            "max": max(counts),
+            "mean": round(sum(counts) / len(counts), 1)
+        },
+        "reply_prefix_tokens": reply_prefixes,
+        "reply_signature_tokens": reply_signatures,
+        "analysis_prompt_tokens": tokenizer_service.count(THREAD_ANALYSIS_PROMPT)
+    }
 
 # Helper function to generate subject line
 def generate_subject_line(prompt: str, response_type: str, custom_subject: Optional[str] = None) -> str:
@@ -1156,12 +3954,125 @@ def extract_subject_from_email(email_content: str) -> tuple[str, str]:
         print(f"📧 Extracted subject from AI: '{extracted_subject}'")
         return extracted_subject, clean_body
     
-    # If no subject found in content, return None and original body
-    print("📧 No subject found in AI content")
-    return None, email_content.strip()
+    # If no subject found in content, return None and original body
+    print("📧 No subject found in AI content")
+    return None, email_content.strip()
+
+def select_compose_user_info(compose_request: ComposeRequest) -> dict:
+    """Pick signature details from saved preferences or fall back to template data"""
+    if compose_request.userPreferences and compose_request.userPreferences.hasPreferences:
+        # Use the actual user preferences from auto-reply system
+        selected_user_info = {
+            "full_name": compose_request.userPreferences.full_name or "Your Name",
+            "email": compose_request.userPreferences.email or "your.email@company.com",
+            "linkedin": compose_request.userPreferences.linkedin or "https://www.linkedin.com/in/yourprofile",
+            "mobile": compose_request.userPreferences.mobile or "+1 (555) 123-4567"
+        }
+        print(f"✅ Using saved user preferences: {selected_user_info}")
+    else:
+        # Fallback logic (same as before)
+        user_identity = compose_request.recipientContext or ""
+        if "pramodsbaviskar7@gmail.com" in user_identity or "pramod baviskar" in user_identity:
+            selected_user_info = USER_INFO
+        else:
+            selected_user_info = {
+                "full_name": "Your Name",
+                "email": "your.email@company.com",
+                "linkedin": "https://www.linkedin.com/in/yourprofile",
+                "mobile": "+1 (555) 123-4567"
+            }
+        print(f"📝 Using fallback user info: {selected_user_info}")
+    return selected_user_info
+
+def build_compose_payload(compose_request: ComposeRequest, prompt_text: str) -> dict:
+    """Build the Groq chat completion payload for a compose request"""
+    selected_user_info = select_compose_user_info(compose_request)
+    
+    # Build the system prompt with the determined user info
+    system_prompt = build_compose_prompt(compose_request, selected_user_info)
+    
+    # DEBUG: Log the system prompt to see if parameters are being used
+    print(f"📝 System prompt snippet: {system_prompt[:200]}...")
+    
+    # Create user message
+    user_message = f"Write an email about: {prompt_text}"
+    if compose_request.recipientContext:
+        user_message += f"\nRecipient: {compose_request.recipientContext}"
+    
+    # Prepare API request
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    
+    return {
+        "messages": messages,
+        "model": MODEL_CONFIG['model'],
+        "temperature": MODEL_CONFIG['temperature'], 
+        "max_tokens": completion_sizer.max_tokens_for(get_completion_class("/api/compose", compose_request.dict()))
+    }
+
+def build_compose_response_data(
+    raw_email_content: str,
+    compose_request: ComposeRequest,
+    prompt_text: str,
+    cached: bool = False
+) -> dict:
+    """Split the AI output into subject/body and attach compose metadata"""
+    # 🔥 EXTRACT SUBJECT FROM AI RESPONSE
+    extracted_subject, clean_email_body = extract_subject_from_email(raw_email_content)
+    
+    # 🔥 USE EXTRACTED SUBJECT OR FALLBACK
+    if extracted_subject:
+        final_subject = extracted_subject
+        print(f"✅ Using AI-extracted subject: '{final_subject}'")
+    else:
+        # Fallback to old method if extraction fails
+        final_subject = generate_subject_line(
+            prompt_text, 
+            compose_request.responseType,
+            compose_request.subjectLine
+        )
+        clean_email_body = raw_email_content  # Use original content if no subject extracted
+        print(f"🔄 Using fallback subject: '{final_subject}'")
+    
+    print("final_subject:", final_subject)
+    print("final_email_body length:", len(clean_email_body))
+    
+    has_user_preferences = bool(compose_request.userPreferences and compose_request.userPreferences.hasPreferences)
+    return {
+        "subject": final_subject,  # 🔥 NOW USES AI-EXTRACTED SUBJECT
+        "body": clean_email_body,  # 🔥 CLEAN BODY WITH PROPER SIGNATURE
+        "cached": cached,
+        "metadata": {
+            "tone": compose_request.tone,
+            "length": compose_request.length,
+            "language": compose_request.language,
+            "subjectSource": "ai_extracted" if extracted_subject else "fallback",
+            "signatureSource": "user_preferences" if has_user_preferences else "template",
+            "word_count": len(clean_email_body.split()),
+            "character_count": len(clean_email_body),
+            "hasUserPreferences": has_user_preferences
+        }
+    }
+
+# Fields that never change the generated email
+COMPOSE_CACHE_IGNORED_FIELDS = {'formStateId', 'timestamp', 'bypassCache', 'autoInsert', 'userPreferences', 'prompt'}
+
+def get_compose_cache_key(compose_request: ComposeRequest, prompt_text: str) -> str:
+    """Key on a canonical form of everything that shapes the prompt"""
+    cache_data = compose_request.dict(exclude=COMPOSE_CACHE_IGNORED_FIELDS)
+    cache_data['prompt'] = " ".join(unicodedata.normalize('NFKC', prompt_text).split())
+    for field in ('recipientContext', 'subjectLine', 'openingSentence', 'closingLine'):
+        if cache_data.get(field):
+            cache_data[field] = " ".join(cache_data[field].split())
+    # Only saved preferences reach the signature, so hash them alone
+    preferences = compose_request.userPreferences
+    preference_data = preferences.dict() if preferences and preferences.hasPreferences else None
+    cache_data['userPreferences'] = hashlib.md5(json.dumps(preference_data, sort_keys=True).encode()).hexdigest()
+    return hashlib.md5(json.dumps(cache_data, sort_keys=True, default=str).encode()).hexdigest()
 
 @app.post("/api/compose", response_model=ComposeResponse)
-@limiter.limit("50/minute")  # Adjust rate limit as needed
 async def compose_email(
     request: Request, 
     compose_request: ComposeRequest, 
@@ -1183,102 +4094,41 @@ async def compose_email(
         print(f"🎯 includeSignature: {compose_request.includeSignature}")
         print(f"🎯 userPreferences: {compose_request.userPreferences}")
         
-        # 🔥 NEW: Determine user info based on preferences
-        if compose_request.userPreferences and compose_request.userPreferences.hasPreferences:
-            # Use the actual user preferences from auto-reply system
-            selected_user_info = {
-                "full_name": compose_request.userPreferences.full_name or "Your Name",
-                "email": compose_request.userPreferences.email or "your.email@company.com",
-                "linkedin": compose_request.userPreferences.linkedin or "https://www.linkedin.com/in/yourprofile",
-                "mobile": compose_request.userPreferences.mobile or "+1 (555) 123-4567"
-            }
-            print(f"✅ Using saved user preferences: {selected_user_info}")
-        else:
-            # Fallback logic (same as before)
-            user_identity = compose_request.recipientContext or ""
-            if "pramodsbaviskar7@gmail.com" in user_identity or "pramod baviskar" in user_identity:
-                selected_user_info = USER_INFO
-            else:
-                selected_user_info = {
-                    "full_name": "Your Name",
-                    "email": "your.email@company.com",
-                    "linkedin": "https://www.linkedin.com/in/yourprofile",
-                    "mobile": "+1 (555) 123-4567"
-                }
-            print(f"📝 Using fallback user info: {selected_user_info}")
-        
-        # Build the system prompt with the determined user info
-        system_prompt = build_compose_prompt(compose_request, selected_user_info)
-        
-        # DEBUG: Log the system prompt to see if parameters are being used
-        print(f"📝 System prompt snippet: {system_prompt[:200]}...")
-        
-        # Create user message
-        user_message = f"Write an email about: {prompt_text}"
-        if compose_request.recipientContext:
-            user_message += f"\nRecipient: {compose_request.recipientContext}"
+        cache_key = get_compose_cache_key(compose_request, prompt_text)
+        if not compose_request.bypassCache:
+            cached_email = await compose_cache.get_async(cache_key)
+            if cached_email:
+                logger.info("Cache hit for compose request")
+                return ComposeResponse(**build_compose_response_data(cached_email, compose_request, prompt_text, cached=True))
         
-        # Prepare API request
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ]
-        
-        payload = {
-            "messages": messages,
-            "model": MODEL_CONFIG['model'],
-            "temperature": MODEL_CONFIG['temperature'], 
-            "max_tokens": MODEL_CONFIG['max_tokens']
-        }
-        
-        # Make API request
-        result = await make_groq_request(payload)
+        payload = build_compose_payload(compose_request, prompt_text)
+        size_class = get_completion_class("/api/compose", compose_request.dict())
         
-        if "choices" not in result or len(result["choices"]) == 0:
-            raise HTTPException(status_code=500, detail="Invalid API response")
-        
-        # 🔥 GET RAW AI RESPONSE
-        raw_email_content = result["choices"][0]["message"]["content"].strip()
-        print(f"🤖 Raw AI response: {raw_email_content[:200]}...")
-        
-        # 🔥 EXTRACT SUBJECT FROM AI RESPONSE
-        extracted_subject, clean_email_body = extract_subject_from_email(raw_email_content)
+        async def fetch_email() -> str:
+            # Make API request
+            result = await make_groq_request(payload, size_class=size_class)
+            
+            if "choices" not in result or len(result["choices"]) == 0:
+                raise HTTPException(status_code=500, detail="Invalid API response")
+            
+            # 🔥 GET RAW AI RESPONSE
+            raw_email_content = result["choices"][0]["message"]["content"].strip()
+            print(f"🤖 Raw AI response: {raw_email_content[:200]}...")
+            
+            compose_cache.set(cache_key, raw_email_content)
+            return raw_email_content
         
-        # 🔥 USE EXTRACTED SUBJECT OR FALLBACK
-        if extracted_subject:
-            final_subject = extracted_subject
-            print(f"✅ Using AI-extracted subject: '{final_subject}'")
+        if compose_request.bypassCache:
+            # Regenerate: always a fresh completion, which then replaces the cached one
+            raw_email_content = await fetch_email()
         else:
-            # Fallback to old method if extraction fails
-            final_subject = generate_subject_line(
-                prompt_text, 
-                compose_request.responseType,
-                compose_request.subjectLine
-            )
-            clean_email_body = raw_email_content  # Use original content if no subject extracted
-            print(f"🔄 Using fallback subject: '{final_subject}'")
-        
-        print("final_subject:", final_subject)
-        print("final_email_body length:", len(clean_email_body))
+            # Resubmits of the same form share one Groq call
+            raw_email_content = await llm_singleflight.do(f"compose:{cache_key}", fetch_email)
         
         # Prepare response
-        response_data = {
-            "subject": final_subject,  # 🔥 NOW USES AI-EXTRACTED SUBJECT
-            "body": clean_email_body,  # 🔥 CLEAN BODY WITH PROPER SIGNATURE
-            "cached": False,  # Always false now since no caching
-            "metadata": {
-                "tone": compose_request.tone,
-                "length": compose_request.length,
-                "language": compose_request.language,
-                "subjectSource": "ai_extracted" if extracted_subject else "fallback",
-                "signatureSource": "user_preferences" if (compose_request.userPreferences and compose_request.userPreferences.hasPreferences) else "template",
-                "word_count": len(clean_email_body.split()),
-                "character_count": len(clean_email_body),
-                "hasUserPreferences": bool(compose_request.userPreferences and compose_request.userPreferences.hasPreferences)
-            }
-        }
+        response_data = build_compose_response_data(raw_email_content, compose_request, prompt_text)
         
-        logger.info(f"Generated email successfully - Subject: {final_subject}, Body length: {len(clean_email_body)}")
+        logger.info(f"Generated email successfully - Subject: {response_data['subject']}, Body length: {len(response_data['body'])}")
         print(f"✅ Generated email with signature preferences")
         
         return ComposeResponse(**response_data)
@@ -1290,6 +4140,86 @@ async def compose_email(
         logger.error(f"Unexpected error in compose: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/api/compose/stream")
+async def compose_email_stream(request: Request, compose_request: ComposeRequest):
+    """
+    Streaming variant of /api/compose.
+    Emits a `subject` event once the first line arrives, `delta` events for the body
+    and a final `done` event carrying the same payload as the non-streaming endpoint.
+    """
+    prompt_text = sanitize_input(compose_request.prompt)
+    cache_key = get_compose_cache_key(compose_request, prompt_text)
+    cached_email = None if compose_request.bypassCache else await compose_cache.get_async(cache_key)
+    
+    async def event_stream():
+        if cached_email:
+            logger.info("Cache hit for streaming compose request")
+            response_data = build_compose_response_data(cached_email, compose_request, prompt_text, cached=True)
+            yield format_sse("subject", {"subject": response_data["subject"]})
+            yield format_sse("delta", {"content": response_data["body"]})
+            yield format_sse("done", response_data)
+            return
+        
+        payload = build_compose_payload(compose_request, prompt_text)
+        size_class = get_completion_class("/api/compose", compose_request.dict())
+        raw_chunks = []
+        header_buffer = ""
+        header_done = False
+        strip_leading = False
+        try:
+            async for delta in stream_groq_request(payload, size_class=size_class):
+                raw_chunks.append(delta)
+                
+                if not header_done:
+                    header_buffer += delta
+                    if "\n" not in header_buffer:
+                        continue
+                    # First line is complete - split the subject off before relaying the body
+                    first_line, delta = header_buffer.split("\n", 1)
+                    header_done = True
+                    subject, _ = extract_subject_from_email(first_line)
+                    if subject:
+                        yield format_sse("subject", {"subject": subject})
+                        strip_leading = True
+                    else:
+                        delta = header_buffer
+                
+                if strip_leading:
+                    delta = delta.lstrip()
+                    if not delta:
+                        continue
+                    strip_leading = False
+                
+                yield format_sse("delta", {"content": delta})
+        except GroqAPIError as e:
+            logger.error(f"Groq API error in compose stream: {e}")
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.message})
+            return
+        except HTTPException as e:
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.detail})
+            return
+        except Exception as e:
+            logger.error(f"Unexpected error in compose stream: {e}", exc_info=True)
+            yield format_sse("error", {"status_code": 500, "detail": "Internal server error"})
+            return
+        
+        raw_email_content = "".join(raw_chunks).strip()
+        if raw_email_content:
+            compose_cache.set(cache_key, raw_email_content)
+        if not header_done and raw_email_content:
+            # Single-line completion: nothing has been relayed yet
+            subject, body = extract_subject_from_email(raw_email_content)
+            if subject:
+                yield format_sse("subject", {"subject": subject})
+            if body:
+                yield format_sse("delta", {"content": body})
+        
+        response_data = build_compose_response_data(raw_email_content, compose_request, prompt_text)
+        logger.info(f"Streamed email successfully - Subject: {response_data['subject']}, Body length: {len(response_data['body'])}")
+        yield format_sse("done", response_data)
+    
+    return sse_response(event_stream())
+
 @app.get("/api/compose/templates")
 async def get_email_templates():
     """Get available email templates"""
@@ -1326,145 +4256,180 @@ async def get_email_templates():
     
     return {"templates": templates}
 
-@app.post("/generate")
-async def generate_reply(request: Request, prompt_request: PromptRequest, background_tasks: BackgroundTasks):
-    try:
-        # Sanitize inputs
-        prompt_text = sanitize_input(prompt_request.prompt)
-        custom_prompt = sanitize_input(prompt_request.customPrompt) if prompt_request.customPrompt else None
-        # Now you can access userPreferences
-        if prompt_request.userPreferences:
-            user_prefs = prompt_request.userPreferences
-            print(f"User preferences: {user_prefs}")
-            print(f"User email: {user_prefs.email if hasattr(user_prefs, 'email') else user_prefs.get('email')}")
-            print(f"User name: {user_prefs.full_name if hasattr(user_prefs, 'full_name') else user_prefs.get('full_name')}")
-        else:
-            print("No user preferences provided")
-        cache_key = get_cache_key(prompt_request.dict())
-        cached_response = response_cache.get(cache_key)
-        
-        if cached_response:
-            logger.info("Cache hit for request")
-            return {"reply": cached_response, "cached": True}
-        
-        # Determine user configuration - Use userPreferences if available
-        if prompt_request.userPreferences and prompt_request.userPreferences.get('hasPreferences'):
-            # Use userPreferences from the request
-            user_prefs = prompt_request.userPreferences
-            selected_user_info = {
-                "full_name": user_prefs.get('full_name') or "Your Name",
-                "email": user_prefs.get('email') or "your.email@company.com", 
-                "linkedin": user_prefs.get('linkedin') or "https://www.linkedin.com/in/yourprofile",
-                "mobile": user_prefs.get('mobile') or "+1 (555) 123-4567"
-            }
-        else:
-            # Fallback to existing logic
-            user_identity = prompt_request.receiverEmail or ""
-            logger.info(f"mail received:\n{user_identity}")
-            if user_identity and ("pramodsbaviskar7@gmail.com" in user_identity or "pramod baviskar" in user_identity):
-                selected_user_info = USER_INFO
-            else:
-                selected_user_info = {
-        "full_name": "Your Name",
-        "email": "your.email@company.com",
-        "linkedin": "https://www.linkedin.com/in/yourprofile",
-        "mobile": "+1 (555) 123-4567"
-    }
-        import textwrap
-
-        signature_template = textwrap.dedent(f"""\
-    {EMAIL_CONFIG['default_closing']},
-    {selected_user_info['full_name']}
-    {selected_user_info['email']}
-    {selected_user_info['linkedin']}
-    {selected_user_info['mobile']}""")
-        logger.info(f"signature_template :\n{signature_template}")
-
-        # Build messages
-        if prompt_request.useCustomPrompt and custom_prompt:
-            logger.info(f"signature_template inside custom_prompt:\n{signature_template}")
-            system_prompt = f"""You are writing an email reply. Follow the user's specific instructions to craft the response. 
-Write the email content directly without any meta-text, introductions, or explanations.
-Just write the email body as requested.
+# Few-shot (email, reply) pairs for /generate's auto mode; the examples sign off with a placeholder signature
+REPLY_FEW_SHOT_EXAMPLES = [
+    (
+        "Reply to: Hi, I'd like to schedule a meeting to discuss the project timeline.",
+        """Thank you for reaching out regarding the project timeline discussion. I would be happy to schedule a meeting with you.
 
-End your email with this signature:
+I'm available this week on Tuesday and Thursday afternoons, or any time on Friday. Please let me know what time works best for you, and I'll send a calendar invite.
 
-{signature_template}
+Looking forward to our discussion."""
+    ),
+    (
+        "Reply to: Thanks for your proposal. Can you provide more details about the pricing?",
+        """Thank you for your interest in our proposal. I'm glad to provide more detailed pricing information.
 
-Remember: Only output the email content directly. No instructions, no "Here is your reply:", just the email itself."""
-            
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Original email: {prompt_text}\n\nInstructions: {custom_prompt}"}
-            ]
-        else:
-            # Auto mode: Use default behavior with few-shot examples
-            system_prompt = f"""You're a helpful assistant that writes professional Gmail replies. 
-Always end your replies with a professional signature in this exact format:
+I'll prepare a comprehensive pricing breakdown that includes:
+- Individual service costs
+- Volume discounts available
+- Payment terms and options
 
-{signature_template}
+I'll have this ready for you by tomorrow afternoon. Would you prefer to receive this via email or would you like to schedule a brief call to go through it together?"""
+    ),
+]
 
-Important: Use this exact signature information in all replies. The name is {selected_user_info['full_name']}, email is {selected_user_info['email']}, LinkedIn is {selected_user_info['linkedin']}, and mobile is {selected_user_info['mobile']}."""
-            few_shot_examples = [
-                {
-                    "role": "user",
-                    "content": "Reply to: Hi, I'd like to schedule a meeting to discuss the project timeline."
-                },
-                {
-                    "role": "assistant",
-                    "content": f"""Thank you for reaching out regarding the project timeline discussion. I would be happy to schedule a meeting with you.
+REPLY_EXAMPLE_SIGNATURE = "[Closing],\n[Full Name]\n[Email]\n[LinkedIn]\n[Mobile]"
 
-I'm available this week on Tuesday and Thursday afternoons, or any time on Friday. Please let me know what time works best for you, and I'll send a calendar invite.
+# Static chat prefix per mode (custom_mode -> messages), identical for every user so Groq can cache it.
+# The sender's signature is added after it by render_reply_signature.
+REPLY_PROMPT_PREFIXES = {
+    True: [{
+        "role": "system",
+        "content": """You are writing an email reply. Follow the user's specific instructions to craft the response. 
+Write the email content directly without any meta-text, introductions, or explanations.
+Just write the email body as requested.
 
-Looking forward to our discussion.
+End your email with the signature given in the next system message.
 
-{signature_template}"""
-                },
-                {
-                    "role": "user",
-                    "content": "Reply to: Thanks for your proposal. Can you provide more details about the pricing?"
-                },
-                {
-                    "role": "assistant",
-                    "content": f"""Thank you for your interest in our proposal. I'm glad to provide more detailed pricing information.
+Remember: Only output the email content directly. No instructions, no "Here is your reply:", just the email itself."""
+    }],
+    False: [{
+        "role": "system",
+        "content": f"""You're a helpful assistant that writes professional Gmail replies. 
+Always end your replies with a professional signature in this format:
+
+{REPLY_EXAMPLE_SIGNATURE}
+
+The example replies below use these placeholders. The sender's exact signature is given in a system message right before the email to answer; use that exact signature information in place of the placeholders."""
+    }] + [
+        message
+        for example_email, example_reply in REPLY_FEW_SHOT_EXAMPLES
+        for message in (
+            {"role": "user", "content": example_email},
+            {"role": "assistant", "content": f"{example_reply}\n\n{REPLY_EXAMPLE_SIGNATURE}"}
+        )
+    ]
+}
 
-I'll prepare a comprehensive pricing breakdown that includes:
-- Individual service costs
-- Volume discounts available
-- Payment terms and options
+def render_reply_signature(custom_mode: bool, closing: str, full_name: str, email: str, linkedin: str, mobile: str) -> str:
+    """Per-user system message that follows the static reply prefix"""
+    signature_template = textwrap.dedent(f"""\
+{closing},
+{full_name}
+{email}
+{linkedin}
+{mobile}""")
+    logger.info(f"signature_template :\n{signature_template}")
 
-I'll have this ready for you by tomorrow afternoon. Would you prefer to receive this via email or would you like to schedule a brief call to go through it together?
+    if custom_mode:
+        return f"""End your email with this signature:
 
 {signature_template}"""
-                }
-            ]
+    
+    return f"""Sign this reply with this exact signature:
 
-            # Construct the messages with few-shot examples
-            messages = [{"role": "system", "content": system_prompt}]
-            messages.extend(few_shot_examples)
-            messages.append({"role": "user", "content": f"Reply to this email:\n\n{prompt_text}"})
-        
+{signature_template}
 
-        # Make API request
-        payload = {
-            "messages": messages,
-            "model": MODEL_CONFIG['model'],
-            "temperature": MODEL_CONFIG['temperature'], 
-            "max_tokens": MODEL_CONFIG['max_tokens']
+Important: Use this exact signature information. The name is {full_name}, email is {email}, LinkedIn is {linkedin}, and mobile is {mobile}."""
+
+def build_reply_messages(prompt_request: PromptRequest, prompt_text: str, custom_prompt: Optional[str]) -> list:
+    """Build the chat messages (system prompt, few-shot examples, email) for a reply"""
+    # Determine user configuration - Use userPreferences if available
+    if prompt_request.userPreferences and prompt_request.userPreferences.get('hasPreferences'):
+        # Use userPreferences from the request
+        user_prefs = prompt_request.userPreferences
+        selected_user_info = {
+            "full_name": user_prefs.get('full_name') or "Your Name",
+            "email": user_prefs.get('email') or "your.email@company.com", 
+            "linkedin": user_prefs.get('linkedin') or "https://www.linkedin.com/in/yourprofile",
+            "mobile": user_prefs.get('mobile') or "+1 (555) 123-4567"
         }
-        
-        result = await make_groq_request(payload)
+    else:
+        # Fallback to existing logic
+        user_identity = prompt_request.receiverEmail or ""
+        logger.info(f"mail received:\n{user_identity}")
+        if user_identity and ("pramodsbaviskar7@gmail.com" in user_identity or "pramod baviskar" in user_identity):
+            selected_user_info = USER_INFO
+        else:
+            selected_user_info = {
+    "full_name": "Your Name",
+    "email": "your.email@company.com",
+    "linkedin": "https://www.linkedin.com/in/yourprofile",
+    "mobile": "+1 (555) 123-4567"
+}
+
+    # Static prefix first, then the per-user signature (memoized) and the email itself
+    custom_mode = bool(prompt_request.useCustomPrompt and custom_prompt)
+    options = (
+        custom_mode, EMAIL_CONFIG['default_closing'], selected_user_info['full_name'],
+        selected_user_info['email'], selected_user_info['linkedin'], selected_user_info['mobile']
+    )
+    signature = prompt_memo.get_or_render(("reply",) + options, lambda: render_reply_signature(*options))
+    
+    messages = list(REPLY_PROMPT_PREFIXES[custom_mode])
+    messages.append({"role": "system", "content": signature.text})
+    if custom_mode:
+        messages.append({"role": "user", "content": f"Original email: {prompt_text}\n\nInstructions: {custom_prompt}"})
+    else:
+        messages.append({"role": "user", "content": f"Reply to this email:\n\n{prompt_text}"})
+    return messages
+async def run_generate_pipeline(prompt_request: PromptRequest) -> dict:
+    """Cache lookup, prompt build and Groq call behind /generate (also used for cache warming)"""
+    # Sanitize inputs
+    prompt_text = sanitize_input(prompt_request.prompt)
+    custom_prompt = sanitize_input(prompt_request.customPrompt) if prompt_request.customPrompt else None
+    # Now you can access userPreferences
+    if prompt_request.userPreferences:
+        user_prefs = prompt_request.userPreferences
+        print(f"User preferences: {user_prefs}")
+        print(f"User email: {user_prefs.email if hasattr(user_prefs, 'email') else user_prefs.get('email')}")
+        print(f"User name: {user_prefs.full_name if hasattr(user_prefs, 'full_name') else user_prefs.get('full_name')}")
+    else:
+        print("No user preferences provided")
+    request_data = prompt_request.dict()
+    cache_key, cache_namespace, cache_text = get_cache_identity(request_data)
+    near_scope = get_near_duplicate_scope(request_data, cache_namespace, cache_text)
+    cached = await response_cache.get_similar_async(cache_key, near_scope)
+    
+    if cached:
+        cached_response, similarity = cached
+        logger.info(f"Cache hit for request (similarity: {similarity})")
+        return {"reply": cached_response, "cached": True, "similarity": similarity}
+    
+    messages = build_reply_messages(prompt_request, prompt_text, custom_prompt)
+    size_class = get_completion_class("/generate", prompt_request.dict())
+
+    # Make API request
+    payload = {
+        "messages": messages,
+        "model": MODEL_CONFIG['model'],
+        "temperature": MODEL_CONFIG['temperature'], 
+        "max_tokens": completion_sizer.max_tokens_for(size_class)
+    }
+    
+    async def fetch_reply() -> str:
+        result = await make_groq_request(payload, size_class=size_class)
         
         if "choices" not in result or len(result["choices"]) == 0:
             raise HTTPException(status_code=500, detail="Invalid API response")
         
         reply = result["choices"][0]["message"]["content"].strip()
         
-        # Cache the result in background
-        background_tasks.add_task(response_cache.set, cache_key, reply)
-        
-        logger.info(f"Generated reply successfully (length: {len(reply)})")
-        return {"reply": reply, "cached": False}
+        # Cache before releasing followers so later requests hit immediately
+        response_cache.set(cache_key, reply, similar=near_scope)
+        return reply
+    
+    # Identical in-flight requests share one Groq call
+    reply = await llm_singleflight.do(cache_key, fetch_reply)
+    
+    logger.info(f"Generated reply successfully (length: {len(reply)})")
+    return {"reply": reply, "cached": False}
+
+@app.post("/generate")
+async def generate_reply(request: Request, prompt_request: PromptRequest, background_tasks: BackgroundTasks):
+    try:
+        return await run_generate_pipeline(prompt_request)
         
     except GroqAPIError as e:
         logger.error(f"Groq API error: {e}")
@@ -1472,33 +4437,136 @@ I'll have this ready for you by tomorrow afternoon. Would you prefer to receive
     except Exception as e:
         logger.error(f"Unexpected error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.post("/generate/stream")
+async def generate_reply_stream(request: Request, prompt_request: PromptRequest):
+    """
+    Streaming variant of /generate.
+    Emits `delta` events as tokens arrive and a final `done` event with the full reply.
+    """
+    prompt_text = sanitize_input(prompt_request.prompt)
+    custom_prompt = sanitize_input(prompt_request.customPrompt) if prompt_request.customPrompt else None
+    request_data = prompt_request.dict()
+    cache_key, cache_namespace, cache_text = get_cache_identity(request_data)
+    near_scope = get_near_duplicate_scope(request_data, cache_namespace, cache_text)
+    cached = await response_cache.get_similar_async(cache_key, near_scope)
     
-@app.post("/analyze-thread")
-async def analyze_email_thread(request: Request, thread_request: ThreadAnalysisRequest):
-    try:
-        email_chain = sanitize_input(thread_request.thread.get("completeThreadText", ""))
-        
-        if not email_chain:
-            raise HTTPException(status_code=400, detail="Email chain cannot be empty")
+    async def event_stream():
+        if cached:
+            cached_response, similarity = cached
+            logger.info(f"Cache hit for streaming request (similarity: {similarity})")
+            yield format_sse("done", {"reply": cached_response, "cached": True, "similarity": similarity})
+            return
         
-        # Check cache
-        cache_key = get_cache_key({"thread": email_chain})
-        cached_analysis = response_cache.get(cache_key)
+        messages = build_reply_messages(prompt_request, prompt_text, custom_prompt)
+        size_class = get_completion_class("/generate", prompt_request.dict())
+        payload = {
+            "messages": messages,
+            "model": MODEL_CONFIG['model'],
+            "temperature": MODEL_CONFIG['temperature'], 
+            "max_tokens": completion_sizer.max_tokens_for(size_class)
+        }
         
-        if cached_analysis:
-            return {"analysis": cached_analysis, "cached": True}
+        chunks = []
+        try:
+            async for delta in stream_groq_request(payload, size_class=size_class):
+                chunks.append(delta)
+                yield format_sse("delta", {"content": delta})
+        except GroqAPIError as e:
+            logger.error(f"Groq API error in stream: {e}")
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.message})
+            return
+        except HTTPException as e:
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.detail})
+            return
+        except Exception as e:
+            logger.error(f"Unexpected error in stream: {e}", exc_info=True)
+            yield format_sse("error", {"status_code": 500, "detail": "Internal server error"})
+            return
         
-        # Token limit check
-        token_count = count_tokens_cached(email_chain)
-        max_tokens = MODEL_CONFIG['max_tokens']
+        reply = "".join(chunks).strip()
+        response_cache.set(cache_key, reply, similar=near_scope)
         
-        if token_count > max_tokens:
-            if thread_request.autoTruncate:
-                email_chain = email_chain[-max_tokens * 3:]  # Rough truncation
-            else:
-                raise HTTPException(status_code=413, detail="Input too long")
+        logger.info(f"Streamed reply successfully (length: {len(reply)})")
+        yield format_sse("done", {"reply": reply, "cached": False})
+    
+    return sse_response(event_stream())
+    
+# Marker left where part of a message was cut to fit the token budget
+TRUNCATION_MARKER = "\n[... rest of this message truncated ...]\n"
+
+# Marker opening each further piece of a message too long for one map-reduce chunk
+CONTINUATION_MARKER = "[... message continued from the previous part ...]\n"
+
+def split_thread_messages(text: str) -> List[str]:
+    """Split a content.js thread at its separator lines, oldest first; any text before the
+    first separator is kept as its own segment"""
+    starts = [match.start() for match in THREAD_SEPARATOR_PATTERN.finditer(text)]
+    bounds = [0] + [start for start in starts if start > 0] + [len(text)]
+    return [text[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+def fit_thread_to_budget(text: str, budget: int, model: Optional[str] = None) -> Tuple[str, int, int]:
+    """Cut a content.js thread to `budget` tokens: drop whole oldest messages, then trim the
+    oldest kept one on a token boundary. Returns (text, elided messages, elided tokens)."""
+    segments = split_thread_messages(text)
+    
+    # One encode_batch pass; trimming slices these token lists instead of re-encoding
+    encoder = tokenizer_service.encoder(model)
+    encoded = encoder.encode_batch(segments, num_threads=tokenizer_service.threads, disallowed_special=())
+    total = sum(len(tokens) for tokens in encoded)
+    if total <= budget:
+        return text, 0, 0
+    
+    marker_tokens = len(encoder.encode(TRUNCATION_MARKER))
+    remaining = total
+    first = 0
+    elided_messages = 0
+    # Segments are oldest first; the text before the first separator isn't a message
+    while first < len(segments) - 1 and remaining - len(encoded[first]) + marker_tokens > budget:
+        remaining -= len(encoded[first])
+        elided_messages += THREAD_SEPARATOR_PATTERN.match(segments[first].lstrip("\n")) is not None
+        first += 1
+    
+    if remaining <= budget:
+        return "".join(segments[first:]), elided_messages, total - remaining
+    
+    # Keep the head of the oldest remaining message: its separator line and opening text
+    keep = max(0, len(encoded[first]) - (remaining + marker_tokens - budget))
+    kept_text = encoder.decode(encoded[first][:keep]) + TRUNCATION_MARKER + "".join(segments[first + 1:])
+    kept_tokens = remaining - len(encoded[first]) + keep
+    return kept_text, elided_messages, total - kept_tokens
+
+def chunk_thread(text: str, chunk_tokens: int, model: Optional[str] = None) -> List[str]:
+    """Pack consecutive messages into chunks of at most `chunk_tokens` tokens. A message longer
+    than a chunk is split on token boundaries, each further piece repeating its separator line."""
+    segments = split_thread_messages(text)
+    encoder = tokenizer_service.encoder(model)
+    encoded = encoder.encode_batch(segments, num_threads=tokenizer_service.threads, disallowed_special=())
+    
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for segment, tokens in zip(segments, encoded):
+        if current and current_tokens + len(tokens) > chunk_tokens:
+            chunks.append("".join(current))
+            current, current_tokens = [], 0
+        if len(tokens) <= chunk_tokens:
+            current.append(segment)
+            current_tokens += len(tokens)
+            continue
         
-        analysis_prompt = """
+        header = THREAD_SEPARATOR_PATTERN.match(segment.lstrip("\n"))
+        continuation = (f"{header.group(0)}\n" if header else "") + CONTINUATION_MARKER
+        piece_tokens = max(1, chunk_tokens - len(encoder.encode(continuation)))
+        chunks.append(encoder.decode(tokens[:chunk_tokens]))
+        for start in range(chunk_tokens, len(tokens), piece_tokens):
+            chunks.append(continuation + encoder.decode(tokens[start:start + piece_tokens]))
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+# System prompt for /analyze-thread
+THREAD_ANALYSIS_PROMPT = """
 You are an AI email analyst. Analyze the following email thread and respond with **only** a strict, valid JSON object.
 
 Your output must:
@@ -1550,32 +4618,233 @@ Return a single valid JSON object with this structure:
 }
 Do not include any additional content.
 """
-        
+
+# Merge pass of map-reduce analysis: one summary and sentiment from the per-part analyses
+THREAD_MERGE_PROMPT = """
+You are an AI email analyst. You are given the analyses of consecutive parts of ONE long email thread, oldest part first, as a JSON list. Combine them into the analysis of the whole thread and respond with **only** a strict, valid JSON object.
+
+Your output must:
+- Begin directly with '{' and end with '}'.
+- Contain **no extra characters** outside the JSON.
+- Include **no explanations**, **no headings**, and **no markdown formatting**.
+
+Instructions:
+1. Write a **concise, focused summary** (2-3 sentences maximum) of the whole thread that captures:
+   - The main purpose/request of the thread
+   - Key decision or outcome (if any)
+   - Current status or next steps (the latest parts matter most here)
+2. Give the overall sentiment of the whole thread and list the tone shifts in order, including shifts between parts.
+
+Return a single valid JSON object with this structure:
+{
+  "summary": string,
+  "sentiment_analysis": {
+    "overall": string,
+    "tone_shifts": list
+  }
+}
+Do not include any additional content.
+"""
+
+# Chat framing around the two messages plus the "Email Thread:" label
+THREAD_PROMPT_FRAMING_TOKENS = 16
+
+async def analysis_thread_budget(size_class: str) -> Tuple[int, int]:
+    """(max_tokens, thread token budget) for one analysis call of `size_class`: the context window
+    less the completion reservation, system prompt and framing"""
+    max_tokens = completion_sizer.max_tokens_for(size_class)
+    prompt_budget = MODEL_CONFIG['context_window'] - max_tokens
+    if config["THREAD_PROMPT_TOKEN_LIMIT"] > 0:
+        prompt_budget = min(prompt_budget, config["THREAD_PROMPT_TOKEN_LIMIT"])
+    system_tokens = tokenizer_service.static_count(THREAD_ANALYSIS_PROMPT) or await tokenizer_service.count_async(THREAD_ANALYSIS_PROMPT)
+    return max_tokens, prompt_budget - system_tokens - THREAD_PROMPT_FRAMING_TOKENS
+
+def parse_analysis_json(content: str) -> dict:
+    """The JSON object in a model reply, ignoring any text around it"""
+    json_match = re.search(r'\{.*\}', content.strip(), re.DOTALL)
+    if not json_match:
+        raise HTTPException(status_code=500, detail="No valid JSON in response")
+    return json.loads(json_match.group(0))
+
+def unique_items(items: List[Any]) -> List[Any]:
+    """Drop repeats (case-insensitive for strings), keeping first-seen order"""
+    seen = set()
+    unique = []
+    for item in items:
+        key = item.casefold().strip() if isinstance(item, str) else json.dumps(item, sort_keys=True, default=str)
+        if key not in seen:
+            seen.add(key)
+            unique.append(item)
+    return unique
+
+def merge_partial_analyses(partials: List[dict], merged: dict) -> dict:
+    """Combine per-part analyses: summary and sentiment from the merge pass (falling back to the
+    parts), topics and named entities as order-preserving unions so nothing is lost"""
+    sentiments = [part.get("sentiment_analysis") or {} for part in partials]
+    overall = Counter(str(sentiment.get("overall")) for sentiment in sentiments if sentiment.get("overall"))
+    merged_sentiment = merged.get("sentiment_analysis") or {}
+    
+    topics: "OrderedDict[str, dict]" = OrderedDict()
+    for part in partials:
+        for topic in (part.get("topics") or {}).get("main") or []:
+            if not isinstance(topic, dict) or not topic.get("label"):
+                continue
+            entry = topics.setdefault(str(topic["label"]).casefold().strip(), {"label": topic["label"], "subtopics": []})
+            entry["subtopics"] = unique_items(entry["subtopics"] + list(topic.get("subtopics") or []))
+    
+    entities: Dict[str, List[Any]] = {
+        name: [] for name in ("people", "companies", "dates", "mobile_numbers", "email_addresses", "locations")
+    }
+    for part in partials:
+        for name, values in (part.get("named_entities") or {}).items():
+            if isinstance(values, list):
+                entities[name] = entities.get(name, []) + values
+    
+    return {
+        "summary": merged.get("summary") or " ".join(str(part.get("summary", "")) for part in partials).strip(),
+        "sentiment_analysis": {
+            "overall": merged_sentiment.get("overall") or (overall.most_common(1)[0][0] if overall else "neutral"),
+            "tone_shifts": merged_sentiment.get("tone_shifts")
+            or [shift for sentiment in sentiments for shift in sentiment.get("tone_shifts") or []]
+        },
+        "topics": {"main": list(topics.values())},
+        "named_entities": {name: unique_items(values) for name, values in entities.items()}
+    }
+
+# Shared by every map-reduce analysis so large threads can't flood Groq together
+thread_map_semaphore = asyncio.Semaphore(max(1, config["THREAD_MAP_CONCURRENCY"]))
+
+async def analyze_thread_chunks(chunks: List[str], max_tokens: int) -> dict:
+    """Map: analyze every chunk concurrently (bounded fan-out). Reduce: one merge call."""
+    async def analyze_chunk(index: int, chunk: str) -> dict:
         payload = {
             "messages": [
-                {"role": "system", "content": analysis_prompt},
-                {"role": "user", "content": f"Email Thread:\n{email_chain}"}
+                {"role": "system", "content": THREAD_ANALYSIS_PROMPT},
+                {"role": "user", "content": f"Email Thread (part {index + 1} of {len(chunks)}):\n{chunk}"}
             ],
             "model": MODEL_CONFIG["model"],
             "temperature": 0.3,
             "max_tokens": max_tokens
         }
-        
-        result = await make_groq_request(payload)
-        analysis_str = result["choices"][0]["message"]["content"].strip()
-        
-        # Parse JSON
-        json_match = re.search(r'\{.*\}', analysis_str, re.DOTALL)
-        if not json_match:
-            raise HTTPException(status_code=500, detail="No valid JSON in response")
-        
-        analysis_dict = json.loads(json_match.group(0))
+        async with thread_map_semaphore:
+            result = await make_groq_request(payload, size_class="/analyze-thread:chunk")
+        return parse_analysis_json(result["choices"][0]["message"]["content"])
+    
+    partials = await asyncio.gather(*(analyze_chunk(index, chunk) for index, chunk in enumerate(chunks)))
+    
+    parts = [
+        {"part": index + 1, "summary": part.get("summary"), "sentiment_analysis": part.get("sentiment_analysis")}
+        for index, part in enumerate(partials)
+    ]
+    payload = {
+        "messages": [
+            {"role": "system", "content": THREAD_MERGE_PROMPT},
+            {"role": "user", "content": f"Part analyses:\n{json.dumps(parts, ensure_ascii=False)}"}
+        ],
+        "model": MODEL_CONFIG["model"],
+        "temperature": 0.3,
+        "max_tokens": completion_sizer.max_tokens_for("/analyze-thread:merge")
+    }
+    result = await make_groq_request(payload, size_class="/analyze-thread:merge")
+    return merge_partial_analyses(partials, parse_analysis_json(result["choices"][0]["message"]["content"]))
+
+async def run_analyze_pipeline(thread_request: ThreadAnalysisRequest) -> dict:
+    """Cache lookup, truncation or chunking and Groq calls behind /analyze-thread (also used for cache warming)"""
+    email_chain = sanitize_input(thread_request.thread.get("completeThreadText", ""))
+    
+    if not email_chain:
+        raise HTTPException(status_code=400, detail="Email chain cannot be empty")
+    
+    # Check cache
+    # Exact matches only: a near-duplicate thread may differ by the one message that matters
+    cache_key = get_cache_key({"thread": email_chain})
+    cached = await response_cache.get_similar_async(cache_key)
+    
+    if cached:
+        cached_analysis, similarity = cached
+        return {"analysis": cached_analysis, "cached": True, "similarity": similarity}
+    
+    max_tokens, thread_budget = await analysis_thread_budget("/analyze-thread")
+    token_count = await tokenizer_service.count_async(email_chain)
+    
+    # Threads over budget are analyzed in chunks unless the client opts out
+    map_reduce = thread_request.mapReduce
+    if map_reduce is None:
+        threshold = config["THREAD_MAP_REDUCE_TOKENS"]
+        map_reduce = token_count > thread_budget or 0 < threshold < token_count
+    
+    if map_reduce:
+        chunk_max_tokens, chunk_budget = await analysis_thread_budget("/analyze-thread:chunk")
+        # Greedy packing leaves any two neighbouring chunks over the chunk size, so chunks of
+        # 2 * tokens / (max - 2) or more never number more than max; beyond that the thread is cut
+        max_chunks = max(3, config["THREAD_MAP_MAX_CHUNKS"])
+        thread_budget = max(1, chunk_budget) * (max_chunks - 2) // 2
+    
+    truncation = None
+    if token_count > thread_budget:
+        if not thread_request.autoTruncate:
+            raise HTTPException(status_code=413, detail=f"Thread is {token_count} tokens; the limit is {thread_budget}")
+        email_chain, elided_messages, elided_tokens = await tokenizer_service.run(
+            fit_thread_to_budget, email_chain, thread_budget, MODEL_CONFIG['model']
+        )
+        truncation = {
+            "elided_messages": elided_messages,
+            "elided_tokens": elided_tokens,
+            "thread_tokens": token_count - elided_tokens,
+            "budget_tokens": thread_budget
+        }
+        logger.info(f"Thread truncated to fit {thread_budget} tokens: {truncation}")
+    
+    chunks = None
+    if map_reduce:
+        thread_tokens = token_count - (truncation or {}).get("elided_tokens", 0)
+        chunk_tokens = max(1, min(chunk_budget, max(config["THREAD_CHUNK_TOKENS"], math.ceil(2 * thread_tokens / (max_chunks - 2)))))
+        chunks = await tokenizer_service.run(chunk_thread, email_chain, chunk_tokens, MODEL_CONFIG['model'])
+        if len(chunks) < 2:
+            chunks = None
+    
+    payload = {
+        "messages": [
+            {"role": "system", "content": THREAD_ANALYSIS_PROMPT},
+            {"role": "user", "content": f"Email Thread:\n{email_chain}"}
+        ],
+        "model": MODEL_CONFIG["model"],
+        "temperature": 0.3,
+        "max_tokens": max_tokens
+    }
+    
+    async def fetch_analysis() -> dict:
+        if chunks is not None:
+            analysis_dict = await analyze_thread_chunks(chunks, chunk_max_tokens)
+        else:
+            result = await make_groq_request(payload, size_class="/analyze-thread")
+            analysis_dict = parse_analysis_json(result["choices"][0]["message"]["content"])
         
         # Cache result
         response_cache.set(cache_key, analysis_dict, ttl=600)  # 10 minute TTL
+        return analysis_dict
+    
+    # Identical in-flight analyses share one Groq call
+    analysis_dict = await llm_singleflight.do(cache_key, fetch_analysis)
+    
+    response = {"analysis": analysis_dict, "cached": False}
+    if truncation is not None:
+        response["truncation"] = truncation
+    if chunks is not None:
+        response["map_reduce"] = {
+            "chunks": len(chunks),
+            "chunk_tokens": chunk_tokens,
+            "thread_tokens": thread_tokens
+        }
+    return response
+
+@app.post("/analyze-thread")
+async def analyze_email_thread(request: Request, thread_request: ThreadAnalysisRequest):
+    try:
+        return await run_analyze_pipeline(thread_request)
         
-        return {"analysis": analysis_dict, "cached": False}
-        
+    except HTTPException:
+        raise
     except json.JSONDecodeError as e:
         logger.error(f"JSON parse error: {e}")
         raise HTTPException(status_code=500, detail="Failed to parse analysis")
@@ -1589,7 +4858,8 @@ async def health_check():
     """Health check endpoint without external API calls"""
     try:
         cache_stats = response_cache.stats()
-        circuit_stats = groq_circuit_breaker.get_stats()
+        circuit_stats = groq_router.breaker_stats()
+        concurrency_stats = groq_concurrency_limiter.get_stats()
         
         # Simple internal health checks
         health_status = {
@@ -1600,15 +4870,22 @@ async def health_check():
             "version": "2.0.0",
             "system": {
                 "cache_size": response_cache.size(),
-                "concurrent_requests_available": concurrent_requests._value,
+                "concurrent_requests_available": concurrency_stats["available"],
+                "concurrency_limit": concurrency_stats["limit"],
+                "in_flight_requests": concurrency_stats["in_flight"],
+                "queued_requests": concurrency_stats["queue_depth"],
                 "max_concurrent_requests": config["MAX_CONCURRENT_REQUESTS"]
             }
         }
         
-        # Check if circuit breaker is open (indicates issues)
-        if circuit_stats["state"] == "OPEN":
+        # Check if any upstream circuit breaker is open (indicates issues)
+        open_upstreams = [name for name, stats in circuit_stats.items() if stats["state"] == "OPEN"]
+        if open_upstreams:
             health_status["status"] = "degraded"
-            health_status["warning"] = "Circuit breaker is open - external API issues detected"
+            if len(open_upstreams) == len(circuit_stats):
+                health_status["warning"] = "Circuit breaker is open - external API issues detected"
+            else:
+                health_status["warning"] = f"Circuit breaker open for upstreams: {', '.join(open_upstreams)}"
         
         return health_status
         
@@ -1626,15 +4903,23 @@ async def health_check():
     
 @app.get("/metrics")
 async def get_metrics():
+    router_stats = groq_router.get_stats()
     return {
         "cache": response_cache.stats(),
+        "compose_cache": compose_cache.stats(),
         "token_cache": token_cache.stats(),
+        "tokenizer": tokenizer_service.get_stats(),
+        "prompt_memo": prompt_memo.get_stats(),
+        "prompt_cache": prompt_cache_monitor.get_stats(),
         "rate_limiter": rate_limiter.get_stats(),
-        "circuit_breaker": groq_circuit_breaker.get_stats(),
-        "concurrent_requests": {
-            "available": concurrent_requests._value,
-            "max": config["MAX_CONCURRENT_REQUESTS"]
-        }
+        "token_quota": token_quota_limiter.get_stats(),
+        "circuit_breaker": groq_router.breaker_stats(),
+        "concurrent_requests": groq_concurrency_limiter.get_stats(),
+        "retry_scheduler": groq_retry_scheduler.get_stats(),
+        "groq_rate_budget": {name: u["rate_budget"] for name, u in router_stats["upstreams"].items()},
+        "groq_router": router_stats,
+        "http_pool": groq_http_client.get_stats(),
+        "singleflight": llm_singleflight.get_stats()
     }
 
 @app.get("/")
@@ -1648,9 +4933,10 @@ async def root():
             "rate limiting", 
             "circuit breaker",
             "concurrent request limiting",
-            "input sanitization"
+            "input sanitization",
+            "server-sent event streaming"
         ],
-        "endpoints": ["/generate", "/analyze-thread", "/health", "/metrics"]
+        "endpoints": ["/generate", "/generate/stream", "/analyze-thread", "/api/compose", "/api/compose/stream", "/health", "/metrics"]
     }
 
 # Cache management endpoints
@@ -1658,59 +4944,108 @@ async def root():
 async def clear_cache():
     """Clear all caches (admin endpoint)"""
     response_cache.clear()
+    compose_cache.clear()
     token_cache.clear()
     return {"message": "All caches cleared", "timestamp": datetime.now().isoformat()}
 
 @app.get("/admin/cache/stats")
 async def detailed_cache_stats():
     """Get detailed cache statistics"""
+    response_cache_stats = response_cache.stats()
+    compose_cache_stats = compose_cache.stats()
+    token_cache_stats = token_cache.stats()
     return {
-        "response_cache": response_cache.stats(),
-        "token_cache": token_cache.stats(),
+        "response_cache": response_cache_stats,
+        "compose_cache": compose_cache_stats,
+        "token_cache": token_cache_stats,
         "cache_sizes": {
-            "response_cache_mb": response_cache.size() * 0.001,  # Rough estimate
-            "token_cache_mb": token_cache.size() * 0.0001
+            "response_cache_mb": round(response_cache_stats['bytes'] / (1024 * 1024), 3),
+            "compose_cache_mb": round(compose_cache_stats['bytes'] / (1024 * 1024), 3),
+            "token_cache_mb": round(token_cache_stats['bytes'] / (1024 * 1024), 3)
         }
     }
 
+@app.get("/admin/cache/mrc")
+async def cache_miss_ratio_curves():
+    """Estimated hit rate per candidate size and TTL, from sampled live traffic"""
+    curves = {}
+    for name, cache in (("response_cache", response_cache), ("token_cache", token_cache)):
+        if cache.mrc is None:
+            continue
+        curves[name] = {
+            "current": {
+                "max_size": cache.max_size,
+                "default_ttl": cache.default_ttl,
+                "observed_hit_rate": cache.stats()["hit_rate"]
+            },
+            **cache.mrc.curve()
+        }
+    return {"curves": curves, "timestamp": datetime.now().isoformat()}
+
+@app.get("/admin/prompts/footprint")
+async def prompt_footprint():
+    """Token footprint of every prompt fragment and compose option combination (admin endpoint)"""
+    global prompt_footprint_report
+    if prompt_footprint_report is None:
+        # Prompts are fixed at import, so the report only needs building once
+        prompt_footprint_report = await tokenizer_service.run(build_prompt_footprint)
+    return {**prompt_footprint_report, "memo": prompt_memo.get_stats()}
+
+@app.get("/admin/llm/max-tokens")
+async def completion_sizing_table():
+    """Learned max_tokens per request class (admin endpoint)"""
+    return {**completion_sizer.get_table(), "timestamp": datetime.now().isoformat()}
+
 # Add these endpoints to your FastAPI app to view cached data
 
 @app.get("/admin/cache/view")
-async def view_cache_contents():
-    """View all cached responses (admin endpoint)"""
-    cache_contents = {}
-    
-    with response_cache._lock:
-        for key, value in response_cache._cache.items():
-            # Get timestamp
-            timestamp = response_cache._timestamps.get(key, 0)
-            cache_contents[key] = {
-                "value": value[:200] + "..." if len(str(value)) > 200 else value,  # Truncate long values
-                "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
-                "size_chars": len(str(value)),
-                "expires_in_seconds": max(0, response_cache.default_ttl - (time.time() - timestamp))
+async def view_cache_contents(cursor: Optional[str] = None, limit: int = 50):
+    """View cached responses a page at a time in key order; pass next_cursor back as cursor (admin endpoint)"""
+    limit = max(1, min(limit, 500))
+    
+    def build_page() -> dict:
+        keys = sorted(response_cache.keys())
+        index = bisect.bisect_right(keys, cursor) if cursor else 0
+        cache_contents = {}
+        last_key = None
+        now = time.time()
+        while index < len(keys) and len(cache_contents) < limit:
+            last_key = keys[index]
+            index += 1
+            entry = response_cache.entry_info(last_key)
+            if entry is None:
+                continue
+            value_str = str(entry["value"])
+            cache_contents[last_key] = {
+                "value": value_str[:200] + "..." if len(value_str) > 200 else entry["value"],  # Truncate long values
+                "timestamp": datetime.fromtimestamp(entry["created_at"]).isoformat(),
+                "size_chars": len(value_str),
+                "size_bytes": entry["size_bytes"],
+                "expires_in_seconds": max(0, entry["expires_at"] - now)
             }
+        return {
+            "cache_size": len(keys),
+            "cache_contents": cache_contents,
+            "next_cursor": last_key if index < len(keys) else None
+        }
     
-    return {
-        "cache_size": len(cache_contents),
-        "cache_contents": cache_contents,
-        "cache_stats": response_cache.stats()
-    }
+    # Sorting and decoding run in a worker thread; shard locks are only held to copy keys
+    page = await asyncio.to_thread(build_page)
+    return {**page, "cache_stats": response_cache.stats()}
 
 @app.get("/admin/cache/search/{search_term}")
-async def search_cache(search_term: str):
-    """Search cached responses by content"""
-    matching_entries = {}
-    
-    with response_cache._lock:
-        for key, value in response_cache._cache.items():
-            if search_term.lower() in str(value).lower():
-                timestamp = response_cache._timestamps.get(key, 0)
-                matching_entries[key] = {
-                    "value": str(value),
-                    "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
-                    "expires_in_seconds": max(0, response_cache.default_ttl - (time.time() - timestamp))
-                }
+async def search_cache(search_term: str, limit: int = 100):
+    """Search cached responses by content (case-insensitive substring); the word index only narrows the candidates"""
+    now = time.time()
+    results = await asyncio.to_thread(response_cache.search, search_term, max(1, min(limit, 1000)))
+    matching_entries = {
+        key: {
+            "value": str(entry["value"]),
+            "timestamp": datetime.fromtimestamp(entry["created_at"]).isoformat(),
+            "expires_in_seconds": max(0, entry["expires_at"] - now)
+        }
+        for key, entry in results
+    }
     
     return {
         "search_term": search_term,
@@ -1721,49 +5056,49 @@ async def search_cache(search_term: str):
 @app.get("/admin/cache/key/{cache_key}")
 async def get_cache_by_key(cache_key: str):
     """Get specific cached response by key"""
-    cached_value = response_cache.get(cache_key)
+    entry = response_cache.entry_info(cache_key)
     
-    if cached_value is None:
+    if entry is None:
         raise HTTPException(status_code=404, detail="Cache key not found")
     
-    with response_cache._lock:
-        timestamp = response_cache._timestamps.get(cache_key, 0)
-    
     return {
         "cache_key": cache_key,
-        "value": cached_value,
-        "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
-        "expires_in_seconds": max(0, response_cache.default_ttl - (time.time() - timestamp)),
-        "size_chars": len(str(cached_value))
+        "value": entry["value"],
+        "timestamp": datetime.fromtimestamp(entry["created_at"]).isoformat(),
+        "expires_in_seconds": max(0, entry["expires_at"] - time.time()),
+        "size_chars": len(str(entry["value"]))
     }
 
 @app.get("/admin/cache/stats/detailed")
 async def detailed_cache_stats():
     """Get detailed cache statistics with size breakdown"""
-    with response_cache._lock:
+    
+    def build_stats() -> dict:
+        # Entry metadata only: no values are decoded or stringified
         cache_data = {}
-        total_size = 0
-        
-        for key, value in response_cache._cache.items():
-            size = len(str(value))
-            total_size += size
-            timestamp = response_cache._timestamps.get(key, 0)
-            
+        total_stored = 0
+        total_resident = 0
+        now = time.time()
+        for key, created_at, expires_at, size, stored_size in response_cache.snapshot_meta():
+            total_stored += stored_size
+            total_resident += size
             cache_data[key] = {
-                "size_chars": size,
-                "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
-                "age_seconds": int(time.time() - timestamp),
-                "expires_in_seconds": max(0, response_cache.default_ttl - (time.time() - timestamp))
+                "size_bytes": size,
+                "stored_bytes": stored_size,
+                "timestamp": datetime.fromtimestamp(created_at).isoformat(),
+                "age_seconds": int(now - created_at),
+                "expires_in_seconds": max(0, expires_at - now)
             }
+        return {
+            "total_stored_kb": round(total_stored / 1024, 2),
+            "resident_kb": round(total_resident / 1024, 2),
+            "entries": cache_data,
+            "oldest_entry": min(cache_data.values(), key=lambda x: x["timestamp"], default=None),
+            "newest_entry": max(cache_data.values(), key=lambda x: x["timestamp"], default=None)
+        }
     
-    return {
-        "cache_stats": response_cache.stats(),
-        "total_size_chars": total_size,
-        "total_size_kb": round(total_size / 1024, 2),
-        "entries": cache_data,
-        "oldest_entry": min(cache_data.values(), key=lambda x: x["timestamp"], default=None),
-        "newest_entry": max(cache_data.values(), key=lambda x: x["timestamp"], default=None)
-    }
+    details = await asyncio.to_thread(build_stats)
+    return {"cache_stats": response_cache.stats(), **details}
 
 # Cache management endpoints
 @app.delete("/admin/cache/key/{cache_key}")
@@ -1776,24 +5111,148 @@ async def delete_cache_key(cache_key: str):
     
     return {"message": f"Cache key {cache_key} deleted successfully"}
 
-@app.post("/admin/cache/warm")
-async def warm_cache():
-    """Warm cache with common requests (useful for testing)"""
-    sample_requests = [
-        "Thank you for your email. I'll get back to you soon.",
-        "I'd like to schedule a meeting to discuss this further.",
-        "Could you please provide more details about this request?"
-    ]
+# Cache snapshots
+def write_cache_snapshot(path: str) -> int:
+    """Export the response cache to `path` atomically; returns bytes written"""
+    written = 0
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        for chunk in response_cache.export_records():
+            f.write(chunk)
+            written += len(chunk)
+    os.replace(tmp_path, path)
+    return written
+
+def read_cache_snapshot(path: str) -> Dict[str, int]:
+    with open(path, "rb") as f:
+        return response_cache.import_records(f)
+
+@app.get("/admin/cache/export", dependencies=[Depends(require_admin)])
+async def export_cache():
+    """Stream a snapshot of the response cache"""
+    # A sync iterator is consumed in the threadpool, so shard copies never block the loop
+    return StreamingResponse(
+        response_cache.export_records(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": "attachment; filename=response_cache.snapshot"}
+    )
+
+@app.post("/admin/cache/import", dependencies=[Depends(require_admin)])
+async def import_cache(request: Request):
+    """Load a snapshot from the request body, or from CACHE_SNAPSHOT_PATH when the body is empty"""
+    body = await request.body()
+    try:
+        if body:
+            result = await asyncio.to_thread(response_cache.import_records, io.BytesIO(body))
+        elif config["CACHE_SNAPSHOT_PATH"] and os.path.exists(config["CACHE_SNAPSHOT_PATH"]):
+            result = await asyncio.to_thread(read_cache_snapshot, config["CACHE_SNAPSHOT_PATH"])
+        else:
+            raise HTTPException(status_code=400, detail="No snapshot body given and no snapshot file configured")
+    except (ValueError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cache snapshot: {e}")
+    
+    return {"message": f"Imported {result['loaded']} cache entries", **result}
+
+@app.post("/admin/cache/snapshot", dependencies=[Depends(require_admin)])
+async def snapshot_cache():
+    """Write the response cache to CACHE_SNAPSHOT_PATH"""
+    if not config["CACHE_SNAPSHOT_PATH"]:
+        raise HTTPException(status_code=400, detail="CACHE_SNAPSHOT_PATH is not configured")
+    
+    written = await asyncio.to_thread(write_cache_snapshot, config["CACHE_SNAPSHOT_PATH"])
+    return {"path": config["CACHE_SNAPSHOT_PATH"], "bytes": written, "entries": response_cache.size()}
+
+# Cache warming from a corpus of real requests
+def load_warm_corpus(path: str) -> List[Dict[str, Any]]:
+    """Read a JSON array or JSONL file of warm-up requests"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+async def replay_warm_request(item: Dict[str, Any], client: str, api_key: Optional[str]) -> str:
+    """Run one corpus entry through the real pipeline, charged to the caller's rate limit and
+    token quota like a live request; returns its outcome"""
+    if not isinstance(item, dict):
+        return "skipped"
+    payload = item.get("payload", item)
+    if not isinstance(payload, dict):
+        return "skipped"
+    endpoint = item.get("endpoint") or ("/analyze-thread" if "thread" in payload else "/generate")
+    if endpoint not in ("/generate", "/analyze-thread"):
+        return "skipped"
+    
+    bucket, limit, burst = resolve_rate_limit(endpoint, client, api_key)
+    if not rate_limiter.is_allowed(bucket, limit, burst, 60)[0]:
+        return "rate_limited"
+    
+    token_usage = None
+    quota, quota_burst = resolve_token_quota(api_key)
+    if quota > 0:
+        estimate = await estimate_body_tokens(json.dumps(payload).encode(), endpoint)
+        if not token_quota_limiter.is_allowed(client, quota, quota_burst, 60, estimate)[0]:
+            return "rate_limited"
+        # Each replay runs in its own task, so this tally is private to it
+        token_usage = {'calls': 0, 'reported': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        groq_usage_accumulator.set(token_usage)
+    
+    try:
+        if endpoint == "/generate":
+            result = await run_generate_pipeline(PromptRequest(**payload))
+        elif endpoint == "/analyze-thread":
+            result = await run_analyze_pipeline(ThreadAnalysisRequest(**payload))
+        else:
+            return "skipped"
+    except Exception as e:
+        logger.warning(f"Cache warm request to {endpoint} failed: {e}")
+        return "failed"
+    finally:
+        if token_usage is not None:
+            settle_token_usage(client, quota, min(estimate, quota_burst or quota), token_usage)
+    
+    return "already_cached" if result.get("cached") else "warmed"
+
+@app.post("/admin/cache/warm", dependencies=[Depends(require_admin)])
+async def warm_cache(request: Request, concurrency: int = None):
+    """Warm the cache by replaying requests (JSON body list, else CACHE_WARM_CORPUS_PATH) through the real pipeline"""
+    body = await request.body()
+    if body:
+        try:
+            corpus = json.loads(body)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Warm-up body must be a JSON list of requests")
+    elif config["CACHE_WARM_CORPUS_PATH"]:
+        try:
+            corpus = await asyncio.to_thread(load_warm_corpus, config["CACHE_WARM_CORPUS_PATH"])
+        except (OSError, json.JSONDecodeError) as e:
+            raise HTTPException(status_code=500, detail=f"Could not read warm-up corpus: {e}")
+    else:
+        raise HTTPException(status_code=400, detail="No warm-up requests given and no corpus configured")
+    
+    if not isinstance(corpus, list):
+        raise HTTPException(status_code=400, detail="Warm-up corpus must be a list of requests")
+    
+    # Bounded so warming never starves live traffic of Groq capacity; callers may only lower it
+    semaphore = asyncio.Semaphore(max(1, min(concurrency or config["CACHE_WARM_CONCURRENCY"], config["CACHE_WARM_CONCURRENCY"])))
+    client, api_key = get_client_identity(request, get_client_ip(request))
     
-    warmed_keys = []
-    for i, sample in enumerate(sample_requests):
-        cache_key = hashlib.md5(f"sample_{i}".encode()).hexdigest()
-        response_cache.set(cache_key, f"Sample response for: {sample}")
-        warmed_keys.append(cache_key)
+    async def replay(item: Dict[str, Any]) -> str:
+        async with semaphore:
+            return await replay_warm_request(item, client, api_key)
+    
+    start = time.time()
+    outcomes = Counter(await asyncio.gather(*(replay(item) for item in corpus)))
     
     return {
-        "message": f"Cache warmed with {len(sample_requests)} entries",
-        "warmed_keys": warmed_keys
+        "message": f"Cache warmed with {outcomes['warmed']} new entries",
+        "requests": len(corpus),
+        "warmed": outcomes["warmed"],
+        "already_cached": outcomes["already_cached"],
+        "failed": outcomes["failed"],
+        "skipped": outcomes["skipped"],
+        "rate_limited": outcomes["rate_limited"],
+        "duration_seconds": round(time.time() - start, 2)
     }
 
 # Startup and shutdown events
@@ -1804,6 +5263,25 @@ async def startup_event():
                 f"Max concurrent: {config['MAX_CONCURRENT_REQUESTS']}, "
                 f"Cache size: {config['CACHE_MAX_SIZE']}")
     
+    # Open the shared Groq connection pool
+    await groq_http_client.start()
+    
+    # Load encoders and count the fixed prompt text once, so budget checks never encode it
+    static_prompts = [THREAD_ANALYSIS_PROMPT, THREAD_MERGE_PROMPT, COMPOSE_PROMPT_PREFIX] + [
+        message["content"] for messages in REPLY_PROMPT_PREFIXES.values() for message in messages
+    ]
+    await asyncio.to_thread(tokenizer_service.preload, [MODEL_CONFIG['model']], static_prompts)
+    logger.info(f"Tokenizer ready: {tokenizer_service.get_stats()['models']}")
+    
+    # Restore the response cache from the last snapshot
+    snapshot_path = config["CACHE_SNAPSHOT_PATH"]
+    if snapshot_path and os.path.exists(snapshot_path):
+        try:
+            result = await asyncio.to_thread(read_cache_snapshot, snapshot_path)
+            logger.info(f"Loaded cache snapshot {snapshot_path}: {result}")
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Could not load cache snapshot {snapshot_path}: {e}")
+    
     # Start background cleanup task
     asyncio.create_task(cleanup_caches())
     logger.info("Background cleanup task started")
@@ -1811,8 +5289,20 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("RespondX API shutting down...")
-    # Clear caches to free memory
-    response_cache.clear()
+    # Close pooled Groq connections
+    await groq_http_client.close()
+    tokenizer_service.close()
+    # Persist the response cache for the next start
+    if config["CACHE_SNAPSHOT_PATH"]:
+        try:
+            written = await asyncio.to_thread(write_cache_snapshot, config["CACHE_SNAPSHOT_PATH"])
+            logger.info(f"Wrote cache snapshot ({written} bytes) to {config['CACHE_SNAPSHOT_PATH']}")
+        except OSError as e:
+            logger.warning(f"Could not write cache snapshot: {e}")
+    # Flush pending L2 writes, then clear caches to free memory (L2 is kept for the next start)
+    response_cache.close()
+    response_cache.clear(include_l2=False)
+    compose_cache.clear()
     token_cache.clear()
     logger.info("Caches cleared, shutdown complete")
 
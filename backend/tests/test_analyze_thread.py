@@ -0,0 +1,36 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+def make_thread(message_count: int, words_per_message: int) -> str:
+    """Thread text in the shape content.js sends"""
+    text = ""
+    for index in range(1, message_count + 1):
+        body = " ".join(f"word{index}x{n}" for n in range(words_per_message))
+        text += f"\n----- Email {index} from Alex Kim <alex@acme.com> (Mon, Jan {index} 2024) -----\n\n{body}\n\n"
+    return text
+
+def test_thread_over_budget_without_auto_truncate_returns_413(monkeypatch):
+    monkeypatch.setitem(main.config, "THREAD_PROMPT_TOKEN_LIMIT", 1500)
+    response = client.post("/analyze-thread", json={
+        "thread": {"completeThreadText": make_thread(20, 200)},
+        "autoTruncate": False,
+        "mapReduce": False
+    })
+    
+    assert response.status_code == 413
+    assert "the limit is" in response.json()["detail"]
+
+def test_thread_empty_after_sanitizing_returns_400():
+    response = client.post("/analyze-thread", json={"thread": {"completeThreadText": "<script>alert(1)</script>"}})
+    
+    assert response.status_code == 400
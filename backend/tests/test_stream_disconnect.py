@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+
+from starlette.requests import Request
+
+import main
+
+def http_scope(path: str) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), (b"host", b"testserver")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80)
+    }
+
+def test_body_replay_hands_off_to_server_after_body():
+    async def run():
+        messages = [
+            {"type": "http.request", "body": b'{"prompt": "hi"}', "more_body": False},
+            {"type": "http.disconnect"}
+        ]
+
+        async def receive():
+            return messages.pop(0)
+
+        request = Request(http_scope("/generate/stream"), receive)
+        body = await request.body()
+        main.with_body_replay(request, body)
+        return await request.receive(), await request.receive()
+
+    replayed, after = asyncio.run(run())
+
+    assert replayed == {"type": "http.request", "body": b'{"prompt": "hi"}', "more_body": False}
+    assert after == {"type": "http.disconnect"}
+
+def test_stream_with_token_quota_stops_on_client_disconnect(monkeypatch):
+    monkeypatch.setitem(main.config, "TOKEN_QUOTA_PER_MINUTE", 30000)
+    stream_closed = []
+
+    async def fake_stream(payload, size_class=None):
+        try:
+            yield "Hello"
+            # Groq would keep going; only the client disconnect should end this stream
+            await asyncio.sleep(30)
+            yield " there"
+        finally:
+            stream_closed.append(True)
+    monkeypatch.setattr(main, "stream_groq_request", fake_stream)
+
+    body = json.dumps({"prompt": "Can we move the meeting to Friday?"}).encode()
+
+    async def run():
+        first_delta_sent = asyncio.Event()
+        body_sent = []
+        messages = []
+
+        async def receive():
+            if not body_sent:
+                body_sent.append(True)
+                return {"type": "http.request", "body": body, "more_body": False}
+            await first_delta_sent.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+            if b"event: delta" in message.get("body", b""):
+                first_delta_sent.set()
+
+        await asyncio.wait_for(main.app(http_scope("/generate/stream"), receive, send), timeout=5)
+        return messages
+
+    messages = asyncio.run(run())
+
+    assert messages[0]["status"] == 200
+    assert "x-tokenquota-estimate" in {key.decode() for key, _ in messages[0]["headers"]}
+    assert stream_closed == [True]